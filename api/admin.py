@@ -12,7 +12,7 @@ from unfold.forms import AdminPasswordChangeForm, UserCreationForm, UserChangeFo
 # Remove the problematic import
 from unfold.decorators import display
 
-from .models import AppUser, Company, Building, Floor, Flat, Chat, Message, BuildingImage
+from .models import AppUser, Company, Building, Floor, Flat, Chat, Message, ArchivedMessage, BuildingImage
 
 # Register the custom user model with Unfold styling
 class AppUserAdmin(UserAdmin):
@@ -264,6 +264,10 @@ class MessageInline(admin.TabularInline):
     readonly_fields = ('sender_type', 'content', 'timestamp', 'is_read')
     can_delete = False
     
+    def get_queryset(self, request):
+        # is_read is derived from the chat's read watermarks
+        return super().get_queryset(request).select_related('chat')
+    
 class ChatAdmin(admin.ModelAdmin):
     list_display = ('id', 'get_participants', 'get_message_count', 'get_last_message_time')
     inlines = [MessageInline]
@@ -277,10 +281,7 @@ class ChatAdmin(admin.ModelAdmin):
     get_message_count.short_description = 'Messages'
     
     def get_last_message_time(self, obj):
-        last_msg = obj.messages.order_by('-timestamp').first()
-        if last_msg:
-            return last_msg.timestamp
-        return '-'
+        return obj.last_message_at or '-'
     get_last_message_time.short_description = 'Last Activity'
 
 # Building Image admin
@@ -307,4 +308,5 @@ admin.site.register(Floor, FloorAdmin)
 admin.site.register(Flat, FlatAdmin)
 admin.site.register(Chat, ChatAdmin)
 admin.site.register(Message)
+admin.site.register(ArchivedMessage)
 admin.site.register(BuildingImage, BuildingImageAdmin)
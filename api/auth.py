@@ -2,6 +2,9 @@ from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth import get_user_model
 
+from .chat_events import get_group_company_ids
+from .ratelimit import LoginThrottle
+
 User = get_user_model()
 
 
@@ -18,7 +21,10 @@ class EmailTokenObtainPairSerializer(TokenObtainPairSerializer):
         # Add custom claims
         token['email'] = user.email
         token['is_staff'] = user.is_staff
+        token['is_superuser'] = user.is_superuser
         token['name'] = user.get_full_name()
+        # Companies represented through company_<id> groups, the WebSocket routes on them
+        token['company_group_ids'] = get_group_company_ids(user)
         
         # Add company information if user is linked to a company
         if user.company:
@@ -36,3 +42,5 @@ class EmailTokenObtainPairView(TokenObtainPairView):
     Takes a set of user credentials (email/password) and returns an access and refresh JWT pair
     """
     serializer_class = EmailTokenObtainPairSerializer
+    # Limited per IP before the password is checked
+    throttle_classes = [LoginThrottle]
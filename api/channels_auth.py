@@ -0,0 +1,110 @@
+import time
+from urllib.parse import parse_qs
+
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, TokenError
+
+from .models import AppUser
+
+# Claims a token needs for ClaimsUser, see EmailTokenObtainPairSerializer.get_token
+REQUIRED_CLAIMS = ('is_superuser', 'company_group_ids')
+
+
+class ClaimsUser(TokenUser):
+    """
+    User built from the verified claims of an access token, without a database query.
+    company_id, company_group_ids, is_superuser and the other claims read as attributes.
+    """
+
+
+def denied_token_key(jti):
+    return f"auth:denied-jti:{jti}"
+
+
+def claims_changed_key(user_id):
+    return f"auth:claims-changed:{user_id}"
+
+
+def deny_token(token):
+    """
+    Revoke an access token for WebSocket and event stream auth until it expires.
+    The deny-list lives in the default cache, which has to be shared between
+    processes (e.g. Redis) for revocations to reach every worker.
+    """
+    timeout = max(int(token['exp'] - time.time()), 1)
+    cache.set(denied_token_key(token[api_settings.JTI_CLAIM]), True, timeout)
+
+
+def mark_claims_changed(user_id):
+    """
+    The user's company, groups or status changed: its tokens issued until now carry
+    stale claims and are resolved from the database until they expire
+    """
+    timeout = int(api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+    cache.set(claims_changed_key(user_id), time.time(), timeout)
+
+
+def get_token_from_scope(scope):
+    """
+    Read the JWT access token from the ?token= query parameter,
+    falling back to an 'Authorization: Bearer <token>' header
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    token = query.get('token', [None])[0]
+    if token:
+        return token
+
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode('utf-8').split()
+            if len(parts) == 2 and parts[0].lower() == 'bearer':
+                return parts[1]
+    return None
+
+
+async def get_user_from_token(token_str):
+    """
+    Validate JWT token and return user.
+    Revoked tokens are rejected. A token whose claims are still current yields a
+    ClaimsUser without touching the database, anything else is looked up with the async ORM.
+    """
+    if not token_str:
+        return AnonymousUser()
+
+    try:
+        token = AccessToken(token_str)
+    except TokenError:
+        return AnonymousUser()
+    user_id = token.payload.get(api_settings.USER_ID_CLAIM)
+    if not user_id:
+        return AnonymousUser()
+
+    # One cache round trip for both the deny-list and the claims check
+    jti_key, changed_key = denied_token_key(token.get(api_settings.JTI_CLAIM)), claims_changed_key(user_id)
+    cached = await cache.aget_many([jti_key, changed_key])
+    if cached.get(jti_key):
+        return AnonymousUser()
+
+    changed_at = cached.get(changed_key)
+    if all(claim in token for claim in REQUIRED_CLAIMS) and (changed_at is None or changed_at < token['iat']):
+        return ClaimsUser(token)
+
+    try:
+        return await AppUser.objects.select_related('company').aget(id=user_id, is_active=True)
+    except AppUser.DoesNotExist:
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope['user'] from a JWT access token for WebSocket connections
+    """
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        scope['token'] = get_token_from_scope(scope)
+        scope['user'] = await get_user_from_token(scope['token'])
+        return await super().__call__(scope, receive, send)
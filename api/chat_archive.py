@@ -0,0 +1,86 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ArchivedMessage, Message
+
+
+def get_archive_cutoff(days=None):
+    """Messages older than this are archived, CHAT_ARCHIVE_AFTER_DAYS by default"""
+    if days is None:
+        days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180)
+    return timezone.now() - timedelta(days=days)
+
+
+def get_retention_cutoff(days=None):
+    """Archived messages older than this are deleted, None when retention is disabled"""
+    if days is None:
+        days = getattr(settings, 'CHAT_RETENTION_DAYS', None)
+    if days is None:
+        return None
+    return timezone.now() - timedelta(days=days)
+
+
+def archivable_messages(cutoff):
+    """Live messages of inactive chats sent before cutoff"""
+    return Message.objects.filter(chat__is_active=False, timestamp__lt=cutoff)
+
+
+def archive_batch(ids):
+    """
+    Copy the given messages to the archive and delete them from the live table
+    in one short transaction. Returns the number of messages moved.
+    """
+    with transaction.atomic():
+        rows = list(Message.objects.filter(id__in=ids)
+                    .values('id', 'chat_id', 'sender_type', 'content', 'timestamp'))
+        ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows])
+        Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    return len(rows)
+
+
+def archive_messages(cutoff=None, batch_size=None, max_batches=None, pause=0):
+    """
+    Move old messages of inactive chats to ArchivedMessage, batch_size at a time.
+    Each batch is its own transaction, optionally followed by a pause, so the live
+    table is never locked for long. Returns the number of messages moved.
+    """
+    cutoff = cutoff or get_archive_cutoff()
+    batch_size = batch_size or getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 500)
+    moved = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        ids = list(archivable_messages(cutoff).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        moved += archive_batch(ids)
+        batches += 1
+        if pause:
+            time.sleep(pause)
+
+    return moved
+
+
+def purge_archived_messages(cutoff, batch_size=None, max_batches=None, pause=0):
+    """
+    Delete archived messages sent before cutoff, batch_size at a time.
+    Only the archive table is touched. Returns the number of messages deleted.
+    """
+    batch_size = batch_size or getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 500)
+    deleted = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        ids = list(ArchivedMessage.objects.filter(timestamp__lt=cutoff)
+                   .order_by('timestamp').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        count, _ = ArchivedMessage.objects.filter(id__in=ids).delete()
+        deleted += count
+        batches += 1
+        if pause:
+            time.sleep(pause)
+
+    return deleted
@@ -0,0 +1,87 @@
+"""
+MessagePack framing of the chat WebSocket, for clients that offer the chat.msgpack subprotocol.
+
+Frames carry the same events as the JSON protocol, as binary MessagePack maps with the
+short keys of KEYS (keys without one are kept) and timestamps as integer milliseconds
+since the epoch. JSON text frames stay the default, and the only protocol when the
+msgpack package is not installed.
+"""
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+SUBPROTOCOL = 'chat.msgpack'
+
+# Full key -> key on the wire, in both directions
+KEYS = {
+    'type': 't',
+    'event_id': 'e',
+    'events': 'ev',
+    'message': 'm',
+    'id': 'i',
+    'chat_id': 'c',
+    'sender_type': 's',
+    'content': 'b',
+    'timestamp': 'ts',
+    'is_read': 'r',
+    'updated_by': 'ub',
+    'updated_count': 'n',
+    'user_id': 'u',
+    'company_ids': 'ci',
+    'status': 'st',
+    'users': 'us',
+    'companies': 'cs',
+}
+FULL_KEYS = {short: key for key, short in KEYS.items()}
+
+# Keys whose values (ISO 8601 strings in the JSON protocol) are sent as epoch milliseconds
+TIMESTAMP_KEYS = {'timestamp'}
+
+
+def negotiate(subprotocols):
+    """The subprotocol to accept among those offered by the client, None for JSON"""
+    if msgpack is not None and SUBPROTOCOL in subprotocols:
+        return SUBPROTOCOL
+    return None
+
+
+def to_millis(value):
+    """Epoch milliseconds of a datetime or an ISO 8601 string"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return round(value.timestamp() * 1000)
+
+
+def compact(value):
+    """Shorten the keys and convert the timestamps of an event, recursively"""
+    if isinstance(value, dict):
+        return {
+            KEYS.get(key, key): to_millis(item) if key in TIMESTAMP_KEYS and item is not None else compact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [compact(item) for item in value]
+    return value
+
+
+def expand(value):
+    """Restore the full keys of a frame received from the client, recursively"""
+    if isinstance(value, dict):
+        return {FULL_KEYS.get(key, key): expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    return value
+
+
+def encode(content):
+    """Binary frame for an outgoing event"""
+    return msgpack.packb(compact(content))
+
+
+def decode(bytes_data):
+    """Frame received from the client. Raises ValueError if it is not valid MessagePack."""
+    return expand(msgpack.unpackb(bytes_data))
@@ -0,0 +1,69 @@
+"""
+Database access of ChatConsumer, as coroutines.
+
+Reads use Django's async ORM (afirst, async for). The ORM has no async transactions,
+so each write that needs one (send_message, mark_read) runs as a single hop to the
+sync thread, which also recycles old database connections, and anything that does
+not need the database (the broadcast) is done back on the event loop.
+"""
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db.models import OuterRef, Q, Subquery
+
+from .models import AppUser, Chat, Message
+from .chat_events import get_group_company_ids, group_send_many
+from .chat_service import (
+    message_event, message_groups, mark_read, other_side, send_message, watermark_field
+)
+
+
+class ChatData:
+    """Queries and writes of the chat WebSocket, ChatConsumer.data"""
+
+    async def get_user(self, user_id):
+        """The active user with its company, or None if it was deactivated or deleted"""
+        return await AppUser.objects.select_related('company').filter(id=user_id, is_active=True).afirst()
+
+    async def get_group_company_ids(self, user):
+        """chat_events.get_group_company_ids, users with token claims need no database hop"""
+        if getattr(user, 'company_group_ids', None) is not None:
+            return get_group_company_ids(user)
+        return await database_sync_to_async(get_group_company_ids)(user)
+
+    async def get_chat_access_map(self, user, company_ids):
+        """Participants and active flag of every chat the user or its companies take part in"""
+        chats = Chat.objects.filter(Q(user_id=user.id) | Q(company_id__in=company_ids))
+        return {
+            chat_id: {'user_id': user_id, 'company_id': company_id, 'is_active': is_active}
+            async for chat_id, user_id, company_id, is_active
+            in chats.values_list('id', 'user_id', 'company_id', 'is_active')
+        }
+
+    async def get_chat_access(self, chat_id):
+        """Participants and active flag of a single chat, or None"""
+        return await Chat.objects.filter(id=chat_id).values('user_id', 'company_id', 'is_active').afirst()
+
+    async def send_message(self, chat, sender_type, content):
+        """
+        Write the message in one thread hop and broadcast it from the event loop,
+        so the sync thread is not held while the channel layer delivers it
+        """
+        message = await database_sync_to_async(send_message)(chat, sender_type, content, broadcast=False)
+        channel_layer = get_channel_layer()
+        if channel_layer is not None:
+            await group_send_many(channel_layer, message_groups(chat), message_event(message))
+        return message
+
+    async def mark_read(self, chat_id, reader_type):
+        """
+        mark_read for a chat known by id. A chat already read up to its newest
+        message is answered by one async query, without a hop or a lock.
+        """
+        watermark = watermark_field(reader_type)
+        newest = (Message.objects.filter(chat=OuterRef('pk'), sender_type=other_side(reader_type))
+                  .order_by('-id').values('id')[:1])
+        row = await Chat.objects.filter(id=chat_id).annotate(last_id=Subquery(newest))\
+            .values(watermark, 'last_id').afirst()
+        if row is None or row['last_id'] is None or row['last_id'] <= row[watermark]:
+            return 0
+        return await database_sync_to_async(mark_read)(Chat(id=chat_id, **{watermark: row[watermark]}), reader_type)
@@ -0,0 +1,118 @@
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
+
+
+def company_group(company_id):
+    return f"company_{company_id}"
+
+
+def company_presence_group(company_id):
+    """Users with a chat with the company, told when its representatives come and go"""
+    return f"company_{company_id}_presence"
+
+
+def get_group_company_ids(user):
+    """
+    Company ids from the user's company_<id> auth group memberships.
+    Users authenticated from token claims carry them in the company_group_ids claim.
+    """
+    claimed = getattr(user, 'company_group_ids', None)
+    if claimed is not None:
+        return list(claimed)
+    company_ids = []
+    for group in user.groups.filter(name__startswith='company_'):
+        try:
+            company_ids.append(int(group.name.replace('company_', '')))
+        except ValueError:
+            continue
+    return company_ids
+
+
+def get_represented_company_ids(user):
+    """Companies the user answers chats for: its own company plus company_<id> groups"""
+    company_ids = set(get_group_company_ids(user))
+    if user.company_id:
+        company_ids.add(user.company_id)
+    return company_ids
+
+
+def subscription_groups(user_id, company_ids):
+    """Groups a connection of the user listens to: its own plus one per represented company"""
+    return {user_group(user_id)} | {company_group(company_id) for company_id in company_ids}
+
+
+def new_event_id():
+    return uuid.uuid4().hex
+
+
+async def group_send_many(channel_layer, groups, event):
+    """
+    Send an event to each distinct group once. All copies carry the same event_id,
+    which ChatConsumer uses to handle an event once per connection.
+    """
+    event = {**event, "event_id": new_event_id()}
+    for group in dict.fromkeys(groups):
+        await channel_layer.group_send(group, event)
+
+
+def group_send(group, event):
+    """
+    Send an event to a channel layer group from synchronous code.
+    Does nothing when no channel layer is configured.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(group, event)
+
+
+def group_send_on_commit(groups, event):
+    """
+    Send an event to several groups once the current transaction commits,
+    so consumers never see state that is rolled back
+    """
+    def _send():
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        async_to_sync(group_send_many)(channel_layer, groups, event)
+
+    transaction.on_commit(_send)
+
+
+def notify_user_access_changed(user_id):
+    """
+    Tell the user's open connections to re-resolve their company ids and chats
+    """
+    group_send_on_commit([user_group(user_id)], {
+        "type": "auth.invalidate",
+        "user_id": user_id,
+    })
+
+
+def notify_chat_access_changed(chat, deleted=False, previous=None):
+    """
+    Tell both sides of a chat that its participants or active flag changed.
+    previous is the chat's (user_id, company_id) before a reassignment: the
+    former participants are told as well, so they stop sending to it.
+    """
+    groups = [user_group(chat.user_id), company_group(chat.company_id)]
+    if previous is not None:
+        previous_user_id, previous_company_id = previous
+        groups += [group for group in (user_group(previous_user_id), company_group(previous_company_id))
+                   if group not in groups]
+    group_send_on_commit(groups, {
+        "type": "auth.chat.updated",
+        "chat_id": chat.id,
+        "user_id": chat.user_id,
+        "company_id": chat.company_id,
+        "is_active": chat.is_active,
+        "deleted": deleted,
+    })
@@ -0,0 +1,99 @@
+import re
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+
+from .models import Message
+
+# Text search configuration of the PostgreSQL index, see migration 0015_message_search
+SEARCH_CONFIG = 'english'
+SNIPPET_WORDS = 16
+
+
+def get_search_terms(query):
+    """
+    Split a search query into words. Operators and quotes are dropped so user input
+    can never be interpreted as FTS5 or tsquery syntax.
+    """
+    return re.findall(r'\w+', query or '')
+
+
+def get_search_backend():
+    """'sqlite' or 'postgresql' when a full-text index exists, otherwise None"""
+    if connection.vendor == 'postgresql':
+        return 'postgresql'
+    if connection.vendor == 'sqlite' and 'api_message_fts' in connection.introspection.table_names():
+        return 'sqlite'
+    return None
+
+
+def make_snippet(content, terms, words=SNIPPET_WORDS):
+    """Words of content around the first matching term, for backends without a full-text index"""
+    tokens = content.split()
+    lowered = [term.lower() for term in terms]
+    first = next((i for i, token in enumerate(tokens)
+                  if any(term in token.lower() for term in lowered)), 0)
+    start = max(first - words // 2, 0)
+    snippet = ' '.join(tokens[start:start + words])
+    if start > 0:
+        snippet = '...' + snippet
+    if start + words < len(tokens):
+        snippet += '...'
+    return snippet
+
+
+def search_messages(chats, q, limit=20):
+    """
+    Full-text search over the messages of the given chats queryset.
+    Every word has to match, the last letters of a word may be missing (prefix match).
+    Returns Message instances, best match first, each with a snippet attribute;
+    content is not loaded.
+    """
+    terms = get_search_terms(q)
+    if not terms:
+        return []
+
+    try:
+        chat_sql, chat_params = chats.order_by().values('id').query.sql_with_params()
+    except EmptyResultSet:
+        # e.g. Chat.objects.none() for users without a company
+        return []
+    backend = get_search_backend()
+
+    if backend == 'sqlite':
+        match = ' '.join('"%s"*' % term for term in terms)
+        return list(Message.objects.raw(
+            f"""
+            SELECT m.id, m.chat_id, m.sender_type, m.timestamp,
+                   snippet(api_message_fts, 0, '', '', '...', {SNIPPET_WORDS}) AS snippet
+            FROM api_message_fts JOIN api_message m ON m.id = api_message_fts.rowid
+            WHERE api_message_fts MATCH %s AND m.chat_id IN ({chat_sql})
+            ORDER BY api_message_fts.rank, m.id DESC
+            LIMIT %s
+            """,
+            [match, *chat_params, limit]
+        ))
+
+    if backend == 'postgresql':
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        return list(Message.objects.raw(
+            f"""
+            SELECT m.id, m.chat_id, m.sender_type, m.timestamp,
+                   ts_headline('{SEARCH_CONFIG}', m.content, q,
+                               'StartSel="", StopSel="", MaxWords={SNIPPET_WORDS}, MinWords=5') AS snippet
+            FROM api_message m, to_tsquery('{SEARCH_CONFIG}', %s) q
+            WHERE to_tsvector('{SEARCH_CONFIG}', m.content) @@ q AND m.chat_id IN ({chat_sql})
+            ORDER BY ts_rank(to_tsvector('{SEARCH_CONFIG}', m.content), q) DESC, m.id DESC
+            LIMIT %s
+            """,
+            [tsquery, *chat_params, limit]
+        ))
+
+    # No full-text index on this database: scan with LIKE
+    messages = Message.objects.filter(chat__in=chats)
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    messages = list(messages.order_by('-id')[:limit])
+    for message in messages:
+        message.snippet = make_snippet(message.content, terms)
+    return messages
@@ -1,5 +1,8 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import Chat, Message, Company
+from .chat_service import last_message_data
+from .chat_sync import InvalidSyncToken, read_sync_token
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -20,21 +23,14 @@ class ChatSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'user', 'created_at', 'updated_at', 'company_name']
     
     def get_last_message(self, obj):
-        """Get the most recent message in the chat"""
-        last_message = obj.messages.order_by('-timestamp').first()
-        if last_message:
-            return {
-                'content': last_message.content[:50] + '...' if len(last_message.content) > 50 else last_message.content,
-                'timestamp': last_message.timestamp,
-                'sender_type': last_message.sender_type
-            }
-        return None
+        """Get the most recent message in the chat from the preview stored on the chat"""
+        return last_message_data(obj)
     
     def get_unread_count(self, obj):
         """Get the count of unread messages for the user"""
         request = self.context.get('request')
-        if request and hasattr(request, 'user') and request.user.is_authenticated and request.user == obj.user:
-            return obj.messages.filter(is_read=False, sender_type='company').count()
+        if request and hasattr(request, 'user') and request.user.is_authenticated and request.user.id == obj.user_id:
+            return obj.unread_for_user
         return 0
 
 
@@ -57,16 +53,67 @@ class CompanyChatSerializer(serializers.ModelSerializer):
         return obj.user.username
     
     def get_last_message(self, obj):
-        """Get the most recent message in the chat"""
-        last_message = obj.messages.order_by('-timestamp').first()
-        if last_message:
-            return {
-                'content': last_message.content[:50] + '...' if len(last_message.content) > 50 else last_message.content,
-                'timestamp': last_message.timestamp,
-                'sender_type': last_message.sender_type
-            }
-        return None
+        """Get the most recent message in the chat from the preview stored on the chat"""
+        return last_message_data(obj)
     
     def get_unread_count(self, obj):
         """Get the count of unread messages for the company"""
-        return obj.messages.filter(is_read=False, sender_type='user').count()
+        return obj.unread_for_company
+
+
+class ChatCompanySerializer(serializers.ModelSerializer):
+    """Company as listed in a user's chat tab, with the user's chat annotated on it"""
+    has_chat = serializers.BooleanField(read_only=True)
+    chat_id = serializers.IntegerField(read_only=True, allow_null=True)
+    unread_count = serializers.IntegerField(read_only=True)
+    
+    class Meta:
+        model = Company
+        fields = ['id', 'name', 'description', 'has_chat', 'chat_id', 'unread_count']
+        read_only_fields = fields
+
+
+class ChatSyncSerializer(ChatSerializer):
+    """Chat as returned by delta sync, with both read watermarks for the message read flags"""
+    class Meta(ChatSerializer.Meta):
+        fields = ChatSerializer.Meta.fields + ['user_last_read_message_id', 'company_last_read_message_id']
+
+
+class CompanyChatSyncSerializer(CompanyChatSerializer):
+    """Company-side chat as returned by delta sync"""
+    class Meta(CompanyChatSerializer.Meta):
+        fields = CompanyChatSerializer.Meta.fields + ['company', 'user_last_read_message_id',
+                                                      'company_last_read_message_id']
+
+
+class ChatSyncQuerySerializer(serializers.Serializer):
+    """Query parameters of the delta sync endpoint"""
+    since = serializers.CharField(required=False, allow_blank=True)
+    side = serializers.ChoiceField(choices=['user', 'company'], default='user')
+
+    def validate_since(self, value):
+        if not value:
+            return None
+        try:
+            return read_sync_token(value)
+        except InvalidSyncToken:
+            raise serializers.ValidationError('Invalid sync token, sync again without since')
+
+
+class MessageSearchQuerySerializer(serializers.Serializer):
+    """Query parameters of the message search endpoints"""
+    q = serializers.CharField(max_length=200)
+    limit = serializers.IntegerField(min_value=1, required=False,
+                                     default=getattr(settings, 'CHAT_SEARCH_LIMIT', 20))
+    
+    def validate_limit(self, value):
+        return min(value, getattr(settings, 'CHAT_SEARCH_MAX_LIMIT', 50))
+
+
+class MessageSearchHitSerializer(serializers.Serializer):
+    """A message matching a search, with the matching part of its content"""
+    message_id = serializers.IntegerField(source='id')
+    chat_id = serializers.IntegerField()
+    sender_type = serializers.CharField()
+    timestamp = serializers.DateTimeField()
+    snippet = serializers.CharField()
@@ -0,0 +1,200 @@
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Chat, Message
+from .chat_events import user_group, company_group, group_send_on_commit
+
+
+def message_event_data(message):
+    """Convert message object to dictionary for channel layer events"""
+    return {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'sender_type': message.sender_type,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'is_read': message.is_read
+    }
+
+
+def message_preview(content):
+    """Shortened message content as shown in chat listings"""
+    return content[:50] + '...' if len(content) > 50 else content
+
+
+def last_message_data(chat):
+    """Last message of a chat as rendered in listings, read from the stored preview"""
+    if chat.last_message_at is None:
+        return None
+    return {
+        'content': chat.last_message_preview,
+        'timestamp': chat.last_message_at,
+        'sender_type': chat.last_message_sender_type
+    }
+
+
+def other_side(side):
+    """'user' for 'company' and the other way round"""
+    return 'company' if side == 'user' else 'user'
+
+
+def unread_field(reader_type):
+    """Name of the Chat counter holding the messages reader_type has not read"""
+    return f'unread_for_{reader_type}'
+
+
+def message_groups(chat):
+    """Channel layer groups of both sides of a chat"""
+    return [user_group(chat.user_id), company_group(chat.company_id)]
+
+
+def message_event(message):
+    """chat.message event broadcast for a new message"""
+    return {
+        "type": "chat.message",
+        "message": message_event_data(message)
+    }
+
+
+def send_message(chat, sender_type, content, broadcast=True):
+    """
+    Append a message to a chat and bump Chat.updated_at in one transaction.
+    The recipient's unread counter is incremented with an F() expression and the
+    last message preview is stored in the same UPDATE, which also stamps the chat
+    with the message's time as its change time for delta sync. Once committed, the message
+    is broadcast to the user_<id> and company_<id> channel layer groups, unless
+    broadcast is False and the caller sends message_event(message) itself.
+
+    chat only needs id, user_id and company_id, so callers holding those
+    can pass an unsaved Chat(id=..., user_id=..., company_id=...).
+    """
+    with transaction.atomic():
+        message = Message.objects.create(
+            chat=chat,
+            sender_type=sender_type,
+            content=content
+        )
+        counter = unread_field(other_side(sender_type))
+        last_message_fields = {
+            'last_message_id': message.id,
+            'last_message_preview': message_preview(content),
+            'last_message_at': message.timestamp,
+            'last_message_sender_type': sender_type,
+            'changed_at': message.timestamp,
+        }
+        Chat.objects.filter(id=chat.id).update(
+            updated_at=message.timestamp,
+            **{counter: F(counter) + 1},
+            **last_message_fields
+        )
+
+        if broadcast:
+            group_send_on_commit(message_groups(chat), message_event(message))
+
+    # Keep the caller's instance in sync with the row
+    chat.updated_at = message.timestamp
+    setattr(chat, counter, getattr(chat, counter) + 1)
+    for field, value in last_message_fields.items():
+        setattr(chat, field, value)
+    return message
+
+
+def watermark_field(reader_type):
+    """Name of the Chat field holding reader_type's read watermark"""
+    return f'{reader_type}_last_read_message_id'
+
+
+def mark_read(chat, reader_type):
+    """
+    Mark the messages sent to reader_type ('user' or 'company') as read by moving
+    the reader's watermark to the newest of them and zeroing its unread counter.
+    Message rows are not touched, so this writes at most one Chat row.
+    The chat row is locked first: a message committed before the lock is covered
+    by the watermark, one sent after it waits and is counted as unread again.
+    Returns the number of messages that were unread.
+    """
+    watermark = watermark_field(reader_type)
+    counter = unread_field(reader_type)
+    last_messages = (Message.objects.filter(chat_id=chat.id, sender_type=other_side(reader_type))
+                     .order_by('-id').values_list('id', flat=True))
+
+    # Watermarks only move forward, so a chat already read up to the newest message
+    # needs no lock
+    last_id = last_messages.first()
+    if last_id is None or last_id <= chat.last_read_message_id(reader_type):
+        return 0
+
+    with transaction.atomic():
+        row = Chat.objects.select_for_update().filter(id=chat.id).values(watermark, counter).first()
+        if row is None:
+            return 0
+        last_id = last_messages.first()
+        if last_id is None or last_id <= row[watermark]:
+            return 0
+        changed_at = timezone.now()
+        Chat.objects.filter(id=chat.id).update(**{watermark: last_id, counter: 0, 'changed_at': changed_at})
+
+    setattr(chat, watermark, last_id)
+    setattr(chat, counter, 0)
+    chat.changed_at = changed_at
+    return row[counter]
+
+
+def refresh_last_message(chat):
+    """
+    Rebuild the stored last message preview of a chat from the Message table,
+    for code that writes messages without going through send_message
+    """
+    message = Message.objects.filter(chat_id=chat.id).order_by('-timestamp', '-id').first()
+    fields = {
+        'last_message_id': message.id if message else None,
+        'last_message_preview': message_preview(message.content) if message else '',
+        'last_message_at': message.timestamp if message else None,
+        'last_message_sender_type': message.sender_type if message else '',
+        'changed_at': timezone.now(),
+    }
+    Chat.objects.filter(id=chat.id).update(**fields)
+    for field, value in fields.items():
+        setattr(chat, field, value)
+
+
+def unread_count_subquery(reader_type):
+    """Messages past reader_type's watermark counted from the Message table"""
+    return Coalesce(Subquery(
+        Message.objects.filter(chat=OuterRef('pk'), sender_type=other_side(reader_type),
+                               id__gt=OuterRef(watermark_field(reader_type)))
+        .order_by().values('chat').annotate(total=Count('id')).values('total'),
+        output_field=IntegerField()
+    ), 0)
+
+
+def reconcile_unread_counters(chats=None, dry_run=False):
+    """
+    Recount the unread counters of chats (all chats by default) from the Message table.
+    Returns a list of (chat_id, field, stored, actual) for every counter that drifted.
+    """
+    chats = Chat.objects.all() if chats is None else chats
+    drifted = []
+    rows = chats.annotate(
+        actual_for_user=unread_count_subquery('user'),
+        actual_for_company=unread_count_subquery('company'),
+    ).values_list('id', 'unread_for_user', 'actual_for_user', 'unread_for_company', 'actual_for_company')
+
+    for chat_id, for_user, actual_for_user, for_company, actual_for_company in rows.iterator():
+        updates = {}
+        if for_user != actual_for_user:
+            drifted.append((chat_id, 'unread_for_user', for_user, actual_for_user))
+            updates['unread_for_user'] = actual_for_user
+        if for_company != actual_for_company:
+            drifted.append((chat_id, 'unread_for_company', for_company, actual_for_company))
+            updates['unread_for_company'] = actual_for_company
+        if updates and not dry_run:
+            # Recount inside the update itself so messages written meanwhile are not lost
+            Chat.objects.filter(id=chat_id).update(changed_at=timezone.now(), **{
+                field: unread_count_subquery(field.replace('unread_for_', ''))
+                for field in updates
+            })
+
+    return drifted
@@ -0,0 +1,274 @@
+"""
+Server-Sent Events and long-poll fallbacks for clients that cannot hold a WebSocket.
+
+Both listen to the same channel layer groups as ChatConsumer and deliver the same
+chat.message and chat.read.updated events. They are async views: an open connection
+is a coroutine waiting on the channel layer, nothing polls the database.
+
+Clients resume where they left off: every chat.message comes with a delta sync cursor
+(the SSE event id, "cursor" in long-poll responses). Given one back (Last-Event-ID or
+?cursor=), the messages written since are replayed from the database before waiting,
+so nothing published between two requests is lost. Read updates are not replayed,
+/api/chat/sync/ returns the read watermarks.
+"""
+import asyncio
+import json
+from datetime import datetime
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+
+from .channels_auth import get_user_from_token
+from .chat_events import get_represented_company_ids, subscription_groups
+from .chat_service import message_event
+from .chat_sync import InvalidSyncToken, SyncCursor, read_sync_token, settled_time, take_pending
+from .models import Chat
+
+# Events forwarded to stream and long-poll clients
+STREAM_EVENTS = {'chat.message', 'chat.read.updated'}
+
+
+class SubscriptionClosed(Exception):
+    """The user's access changed, the client has to reconnect to re-resolve its groups"""
+
+
+class ChatSubscription:
+    """
+    A channel of its own on the channel layer, added to the user's groups for
+    as long as the async with block runs
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.channel_layer = get_channel_layer()
+        self.seen_event_ids = set()
+
+    async def __aenter__(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        for group in self.groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for group in self.groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def next_event(self, timeout):
+        """
+        The next event to deliver, or None when none arrives within timeout seconds.
+        Copies of one event received through several groups are delivered once.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                event = await asyncio.wait_for(self.channel_layer.receive(self.channel_name), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+            if event['type'] == 'auth.invalidate':
+                raise SubscriptionClosed()
+            if event['type'] not in STREAM_EVENTS:
+                continue
+            event_id = event.get('event_id')
+            if event_id is not None:
+                if event_id in self.seen_event_ids:
+                    continue
+                self.seen_event_ids.add(event_id)
+            return event
+
+
+def get_token_from_request(request):
+    """
+    Read the JWT access token from an 'Authorization: Bearer <token>' header,
+    falling back to ?token= since EventSource cannot set headers
+    """
+    parts = request.headers.get('Authorization', '').split()
+    if len(parts) == 2 and parts[0].lower() == 'bearer':
+        return parts[1]
+    return request.GET.get('token')
+
+
+@database_sync_to_async
+def get_user_subscription(user):
+    """The user's channel layer groups and its chats on both sides, for replays"""
+    company_ids = get_represented_company_ids(user)
+    chats = Chat.objects.filter(Q(user_id=user.id) | Q(company_id__in=company_ids))
+    return subscription_groups(user.id, company_ids), chats
+
+
+@database_sync_to_async
+def replay(chats, cursor, limit=None):
+    """chat.message events of the messages the cursor has not delivered, and whether more are left"""
+    messages, has_more = take_pending(chats, cursor, limit)
+    return [message_event(message) for message in messages], has_more
+
+
+def deliver_live(cursor, event):
+    """
+    Record a chat.message received from the channel layer in the cursor.
+    False if it was already replayed.
+    """
+    message = event['message']
+    timestamp = datetime.fromisoformat(message['timestamp'])
+    if cursor.is_delivered(message['id'], timestamp):
+        return False
+    cursor.deliver(message['id'], timestamp)
+    # Everything written before the settled time was either replayed or arrives live
+    cursor.settle(settled_time())
+    return True
+
+
+async def authenticate(request):
+    """The user of the request's access token, or None"""
+    user = await get_user_from_token(get_token_from_request(request))
+    if isinstance(user, AnonymousUser):
+        return None
+    return user
+
+
+def format_sse(event, cursor=None):
+    """An SSE event, with the cursor as its id: EventSource sends it back as Last-Event-ID"""
+    data = json.dumps(event, cls=DjangoJSONEncoder)
+    lines = [f"event: {event['type']}", f"data: {data}"]
+    if cursor is not None:
+        lines.insert(0, f"id: {cursor.token()}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def format_sse_cursor(cursor, comment=None):
+    """An id without data: moves EventSource's Last-Event-ID without firing an event"""
+    lines = [f"id: {cursor.token()}"]
+    if comment:
+        lines.append(f": {comment}")
+    return '\n'.join(lines) + '\n\n'
+
+
+async def sse_events(groups, chats, cursor):
+    """
+    Event stream for one client, replaying what it missed since cursor first.
+    Ends after CHAT_STREAM_MAX_SECONDS or when the user's access changes,
+    EventSource then reconnects on its own.
+    """
+    keepalive = getattr(settings, 'CHAT_STREAM_KEEPALIVE', 15)
+    max_seconds = getattr(settings, 'CHAT_STREAM_MAX_SECONDS', 300)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_seconds
+
+    yield 'retry: 3000\n\n'
+    async with ChatSubscription(groups) as subscription:
+        # Subscribed before the replay: whatever is written from now on arrives live
+        if cursor is None:
+            cursor = SyncCursor(settled_time())
+            yield format_sse_cursor(cursor)
+        else:
+            has_more = True
+            while has_more:
+                events, has_more = await replay(chats, cursor)
+                # Only the last event of a page carries the cursor, an interrupted page is replayed again
+                for i, event in enumerate(events, 1):
+                    yield format_sse(event, cursor if i == len(events) else None)
+
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                event = await subscription.next_event(min(keepalive, remaining))
+            except SubscriptionClosed:
+                break
+            if event is None:
+                # Comment line, keeps proxies from closing an idle connection
+                cursor.settle(settled_time())
+                yield format_sse_cursor(cursor, 'keepalive')
+            elif event['type'] == 'chat.message':
+                if deliver_live(cursor, event):
+                    yield format_sse(event, cursor)
+            else:
+                yield format_sse(event)
+
+
+@require_GET
+async def chat_event_stream(request):
+    """
+    GET /api/chat/events/stream/?token=<access token>
+    text/event-stream of chat.message and chat.read.updated events. Messages written
+    since the Last-Event-ID header (or ?cursor=) are replayed first; an id that is not
+    a cursor of this server starts a new stream.
+    """
+    user = await authenticate(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication credentials were not provided or are invalid'},
+                            status=401)
+
+    try:
+        cursor = read_sync_token(request.headers.get('Last-Event-ID') or request.GET.get('cursor', ''))
+    except InvalidSyncToken:
+        cursor = None
+
+    groups, chats = await get_user_subscription(user)
+    response = StreamingHttpResponse(sse_events(groups, chats, cursor), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Tell nginx not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_GET
+async def chat_event_poll(request):
+    """
+    GET /api/chat/events/poll/?timeout=<seconds>&cursor=<cursor>
+    Returns {"events": [...], "cursor": "..."}: the messages written since cursor if there
+    are any, else the events arriving within timeout seconds (empty on timeout).
+    Events arriving right after the first one are returned with it.
+    Pass the returned cursor to the next poll.
+    """
+    user = await authenticate(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication credentials were not provided or are invalid'},
+                            status=401)
+
+    max_timeout = getattr(settings, 'CHAT_LONG_POLL_MAX_TIMEOUT', 55)
+    try:
+        timeout = float(request.GET.get('timeout', getattr(settings, 'CHAT_LONG_POLL_TIMEOUT', 25)))
+    except ValueError:
+        return JsonResponse({'error': 'timeout must be a number of seconds'}, status=400)
+    timeout = min(max(timeout, 0), max_timeout)
+    cursor = None
+    if request.GET.get('cursor'):
+        try:
+            cursor = read_sync_token(request.GET['cursor'])
+        except InvalidSyncToken:
+            return JsonResponse({'error': 'Invalid cursor, poll again without cursor'}, status=400)
+
+    batch_window = getattr(settings, 'CHAT_WS_BATCH_WINDOW', 0.01)
+    max_batch = getattr(settings, 'CHAT_WS_MAX_BATCH', 50)
+    groups, chats = await get_user_subscription(user)
+    events = []
+    async with ChatSubscription(groups) as subscription:
+        # Subscribed before the replay: whatever is written from now on arrives live
+        if cursor is None:
+            cursor = SyncCursor(settled_time())
+        else:
+            events, _ = await replay(chats, cursor)
+
+        if not events:
+            try:
+                wait = timeout
+                while len(events) < max_batch:
+                    event = await subscription.next_event(wait)
+                    if event is None:
+                        break
+                    if event['type'] != 'chat.message' or deliver_live(cursor, event):
+                        events.append(event)
+                    wait = batch_window if events else timeout
+            except SubscriptionClosed:
+                pass
+
+    return JsonResponse({'events': events, 'cursor': cursor.token()}, encoder=DjangoJSONEncoder)
@@ -0,0 +1,126 @@
+"""
+Delta sync positions for chats and messages.
+
+Changes are ordered by the time they were written: Message.timestamp (then id) for
+messages, Chat.changed_at for chats. Nothing is shared between unrelated chats, but a
+write stamped at t may commit shortly after one stamped later. A SyncCursor therefore
+only settles up to CHAT_SYNC_SETTLE_SECONDS before now and remembers the messages it
+has handed out since, so late commits are still delivered and nothing is sent twice.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+from .models import Message
+
+SYNC_TOKEN_SALT = 'api.chat_sync'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class InvalidSyncToken(Exception):
+    """The token was not issued by this server, the client has to sync from scratch"""
+
+
+def get_sync_limit():
+    """Most messages returned by one sync response"""
+    return getattr(settings, 'CHAT_SYNC_MAX_MESSAGES', 500)
+
+
+def settled_time():
+    """Writes stamped before this time have committed"""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'CHAT_SYNC_SETTLE_SECONDS', 2))
+
+
+def to_micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+class SyncCursor:
+    """
+    Position in the message stream: every message written at or before `at` has been
+    delivered, and so have the ones in `seen` (id -> timestamp, all written after `at`)
+    """
+
+    def __init__(self, at, seen=None):
+        self.at = at
+        self.seen = dict(seen or {})
+
+    def deliver(self, message_id, timestamp):
+        self.seen[message_id] = timestamp
+
+    def is_delivered(self, message_id, timestamp):
+        return timestamp <= self.at or message_id in self.seen
+
+    def settle(self, upto):
+        """Move the position to upto, once every message written up to it has been delivered"""
+        if upto > self.at:
+            self.at = upto
+            self.seen = {message_id: timestamp for message_id, timestamp in self.seen.items() if timestamp > upto}
+
+    def pending(self, chats):
+        """Messages of the chats queryset not delivered yet, oldest first"""
+        return (Message.objects.filter(chat__in=chats, timestamp__gt=self.at).exclude(id__in=list(self.seen))
+                .order_by('timestamp', 'id'))
+
+    def token(self):
+        """Opaque token the client passes back to resume from this position"""
+        seen = [[message_id, to_micros(timestamp)] for message_id, timestamp in sorted(self.seen.items())]
+        return signing.dumps([to_micros(self.at), seen], salt=SYNC_TOKEN_SALT, compress=True)
+
+    @classmethod
+    def from_token(cls, token):
+        try:
+            at, seen = signing.loads(token, salt=SYNC_TOKEN_SALT)
+            return cls(from_micros(at), {message_id: from_micros(timestamp) for message_id, timestamp in seen})
+        except (signing.BadSignature, TypeError, ValueError, OverflowError):
+            raise InvalidSyncToken()
+
+
+def read_sync_token(token):
+    """SyncCursor a token was issued for"""
+    return SyncCursor.from_token(token)
+
+
+def take_pending(chats, cursor, limit=None):
+    """
+    Up to limit messages of the chats the cursor has not delivered, and whether more are left.
+    The cursor records them as delivered and moves past them.
+    """
+    limit = limit or get_sync_limit()
+    settled = settled_time()
+    messages = list(cursor.pending(chats).select_related('chat')[:limit + 1])
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    for message in messages:
+        cursor.deliver(message.id, message.timestamp)
+    if has_more:
+        # Messages written at the same microsecond as the last one may be left for the next page
+        cursor.settle(min(messages[-1].timestamp - timedelta(microseconds=1), settled))
+    else:
+        cursor.settle(settled)
+    return messages, has_more
+
+
+def sync_chats(chats, cursor=None, limit=None):
+    """
+    Changes to the given chats queryset since cursor.
+    Returns (chats, messages, cursor, has_more): the chats whose row changed, the
+    messages created, the cursor to resume from and whether messages were left out
+    because of limit. A chat may be returned again by the next sync, clients upsert them.
+
+    Without cursor every chat is returned and no messages: clients load history
+    through the messages endpoints and sync from the returned cursor onwards.
+    """
+    if cursor is None:
+        return list(chats), [], SyncCursor(settled_time()), False
+
+    changed_chats = list(chats.filter(changed_at__gt=cursor.at))
+    messages, has_more = take_pending(chats, cursor, limit)
+    return changed_chats, messages, cursor, has_more
@@ -7,27 +7,32 @@ This is for reference only - it's not part of the Django backend.
 # Example flow for a user interacting with the chat system:
 
 # 1. User views the list of companies they can chat with
-# GET /api/chat/companies-list/
-# Response:
-# [
-#   {
-#     "id": 1,
-#     "name": "Acme Properties",
-#     "description": "Leading real estate developer",
-#     "has_chat": false,
-#     "chat_id": null,
-#     "unread_count": 0
-#   },
-#   {
-#     "id": 2,
-#     "name": "City Developments",
-#     "description": "Urban property specialists",
-#     "has_chat": true,
-#     "chat_id": 3,
-#     "unread_count": 2
-#   },
-#   ...
-# ]
+# GET /api/chat/companies-list/?page=1&search=acme
+# Response (paginated, ?search= filters by company name):
+# {
+#   "count": 12,
+#   "next": "http://example.com/api/chat/companies-list/?page=2",
+#   "previous": null,
+#   "results": [
+#     {
+#       "id": 1,
+#       "name": "Acme Properties",
+#       "description": "Leading real estate developer",
+#       "has_chat": false,
+#       "chat_id": null,
+#       "unread_count": 0
+#     },
+#     {
+#       "id": 2,
+#       "name": "City Developments",
+#       "description": "Urban property specialists",
+#       "has_chat": true,
+#       "chat_id": 3,
+#       "unread_count": 2
+#     },
+#     ...
+#   ]
+# }
 
 # 2. User starts a new chat with a company (NEW ENDPOINT)
 # POST /api/chats/start/1/
@@ -78,25 +83,33 @@ This is for reference only - it's not part of the Django backend.
 
 # 4. User views messages in the chat
 # GET /api/chats/5/messages/
+# Returns the newest page of messages, oldest first. Load older history with
+# ?before=<next_before>&limit=30 and poll for newer messages with ?after=<next_after>
 # Response:
-# [
-#   {
-#     "id": 10,
-#     "chat": 5,
-#     "sender_type": "user",
-#     "content": "Hello! I'm interested in your property on Main Street.",
-#     "timestamp": "2025-07-11T14:31:00Z",
-#     "is_read": false
-#   },
-#   {
-#     "id": 11,
-#     "chat": 5,
-#     "sender_type": "company",
-#     "content": "Thank you for your interest! Which property are you referring to?",
-#     "timestamp": "2025-07-11T14:35:00Z",
-#     "is_read": true  # Marked as read when user views the messages
-#   }
-# ]
+# {
+#   "results": [
+#     {
+#       "id": 10,
+#       "chat": 5,
+#       "sender_type": "user",
+#       "content": "Hello! I'm interested in your property on Main Street.",
+#       "timestamp": "2025-07-11T14:31:00Z",
+#       "is_read": false
+#     },
+#     {
+#       "id": 11,
+#       "chat": 5,
+#       "sender_type": "company",
+#       "content": "Thank you for your interest! Which property are you referring to?",
+#       "timestamp": "2025-07-11T14:35:00Z",
+#       "is_read": true  # Marked as read when user views the messages
+#     }
+#   ],
+#   "has_more": false,  # Whether another page exists in the requested direction
+#   "direction": "before",
+#   "next_before": 10,
+#   "next_after": 11
+# }
 
 # 5. User checks for unread messages across all chats
 #GET /api/chats/unread_count/
@@ -181,6 +194,22 @@ This is for reference only - it's not part of the Django backend.
 #   "messages_marked_read": 1
 # }
 
+# 4. Company rep searches the messages of their chats
+# GET /api/company-chats/search/?q=parking&limit=20
+# (company owners can also use GET /api/chat/company-owner/chats/search/?q=parking)
+# Response (best match first):
+# {
+#   "results": [
+#     {
+#       "message_id": 9,
+#       "chat_id": 5,
+#       "sender_type": "user",
+#       "timestamp": "2025-07-11T14:30:00Z",
+#       "snippet": "...confirm the address again and let me know if there's parking available nearby?"
+#     }
+#   ]
+# }
+
 # --------
 # Flutter Code Examples
 # --------
@@ -274,13 +303,31 @@ Future<void> sendCompanyReply(int chatId, String content) async {
 
 // Example 4: WebSocket connection for real-time messaging
 void connectToWebSocket() {
-  final wsUrl = Uri.parse('ws://$baseUrl/ws/chat/?token=$accessToken');
+  // batch=1: bursts of events arrive as one frame, without it every event is its own frame
+  final wsUrl = Uri.parse('ws://$baseUrl/ws/chat/?token=$accessToken&batch=1');
   final channel = WebSocketChannel.connect(wsUrl);
   
   // Listen for incoming messages
   channel.stream.listen((message) {
     final data = jsonDecode(message);
     
+    // Bursts of events arrive as one frame: {"type": "batch", "events": [...]}
+    final events = data['type'] == 'batch' ? data['events'] : [data];
+    for (final event in events) {
+      handleEvent(event);
+    }
+  }, 
+  onError: (error) {
+    print('WebSocket error: $error');
+    // Attempt to reconnect
+  },
+  onDone: () {
+    // Close code 4008 means the connection fell behind: reconnect and reload the chats
+    print('WebSocket connection closed: ${channel.closeCode}');
+    // Attempt to reconnect
+  });
+  
+  void handleEvent(Map<String, dynamic> data) {
     switch (data['type']) {
       case 'chat.message':
         print('New message received: ${data['message']['content']}');
@@ -290,19 +337,25 @@ void connectToWebSocket() {
         print('Messages marked as read in chat: ${data['chat_id']}');
         // Update read status in UI
         break;
+      case 'chat.typing':
+        print('${data['sender_type']} is typing in chat: ${data['chat_id']}');
+        // Show a typing indicator for a few seconds
+        break;
+      case 'presence.state':
+        print('Online now: users ${data['users']}, companies ${data['companies']}');
+        break;
+      case 'presence.update':
+        print('User ${data['user_id']} is ${data['status']}');
+        break;
+      case 'ping':
+        // Heartbeat: a client that stays silent for 60 seconds is disconnected (4009)
+        channel.sink.add(jsonEncode({'type': 'pong'}));
+        break;
       case 'error':
         print('Error: ${data['content']}');
         break;
     }
-  }, 
-  onError: (error) {
-    print('WebSocket error: $error');
-    // Attempt to reconnect
-  },
-  onDone: () {
-    print('WebSocket connection closed');
-    // Attempt to reconnect
-  });
+  }
   
   // Send a message
   void sendWebSocketMessage(int chatId, String content) {
@@ -313,18 +366,102 @@ void connectToWebSocket() {
     }));
   }
   
-  // Mark messages as read
-  void markMessagesAsRead(int chatId, String senderType) {
+  // Mark the messages the other side sent us as read (our side comes from the token)
+  void markMessagesAsRead(int chatId) {
     channel.sink.add(jsonEncode({
       'type': 'chat.read',
-      'chat_id': chatId,
-      'sender_type': senderType
+      'chat_id': chatId
     }));
   }
   
+  // Tell the other side we are typing (call on every keystroke, the server coalesces)
+  void sendTyping(int chatId) {
+    channel.sink.add(jsonEncode({
+      'type': 'chat.typing',
+      'chat_id': chatId
+    }));
+  }
+  
+  // Stay online: ping more often than every 30 seconds
+  final presenceTimer = Timer.periodic(Duration(seconds: 20), (_) {
+    channel.sink.add(jsonEncode({'type': 'presence.ping'}));
+  });
+  
   // Close the WebSocket when done
   void closeWebSocket() {
+    presenceTimer.cancel();
     channel.sink.close();
   }
 }
+
+// Example 4b: Binary MessagePack frames (package:msgpack_dart), fewer bytes on metered connections.
+// Same events with short keys ('t' type, 'c' chat_id, 'b' content, 'm' message, 'ev' batch events,
+// see api/chat_codec.py) and timestamps as epoch milliseconds. Servers without msgpack answer
+// without the subprotocol: keep using JSON then.
+void connectToWebSocketMsgpack() {
+  final wsUrl = Uri.parse('ws://$baseUrl/ws/chat/?token=$accessToken');
+  final channel = IOWebSocketChannel.connect(wsUrl, protocols: ['chat.msgpack']);
+
+  channel.stream.listen((frame) {
+    final data = frame is String ? jsonDecode(frame) : deserialize(frame);
+    final events = (data['t'] ?? data['type']) == 'batch' ? (data['ev'] ?? data['events']) : [data];
+    for (final event in events) {
+      print('Event: ${event['t'] ?? event['type']}');
+    }
+  });
+
+  channel.sink.add(serialize({'t': 'chat.message', 'c': 3, 'b': 'Hello!'}));
+}
+
+// Example 5: Long-poll fallback when WebSockets are blocked
+// (browsers can use EventSource on /api/chat/events/stream/?token=... instead,
+// it resumes from the last event id on its own)
+Future<void> pollChatEvents() async {
+  String? cursor;
+  while (true) {
+    // The cursor of the previous poll: messages sent in between are returned first
+    final query = cursor == null ? '' : '&cursor=${Uri.encodeQueryComponent(cursor)}';
+    final response = await http.get(
+      Uri.parse('$baseUrl/api/chat/events/poll/?timeout=25$query'),
+      headers: {'Authorization': 'Bearer $accessToken'},
+    );
+    if (response.statusCode == 400) {
+      cursor = null;
+      continue;
+    }
+    if (response.statusCode != 200) {
+      print('Polling stopped: ${response.body}');
+      break;
+    }
+    // Same events as on the WebSocket, empty when the timeout passed without any
+    final data = jsonDecode(response.body);
+    for (final event in data['events']) {
+      print('Event: ${event['type']}');
+    }
+    cursor = data['cursor'];
+  }
+}
+
+// Example 6: Catch up after the app returns from the background
+// syncToken is kept on the device; null on first launch downloads the chat list once
+Future<String> syncChats(String? syncToken) async {
+  var hasMore = true;
+  while (hasMore) {
+    final query = syncToken == null ? '' : '?since=${Uri.encodeQueryComponent(syncToken)}';
+    final response = await http.get(
+      Uri.parse('$baseUrl/api/chat/sync/$query'),
+      headers: {'Authorization': 'Bearer $accessToken'},
+    );
+    if (response.statusCode == 400) {
+      // Token no longer valid: start over with a full sync
+      return syncChats(null);
+    }
+    final data = jsonDecode(response.body);
+    // Store changed chats (unread counts, last message, read watermarks) and new messages locally
+    print('${data['chats'].length} chats and ${data['messages'].length} messages changed');
+    syncToken = data['token'];
+    hasMore = data['has_more'];
+  }
+  return syncToken!;
+}
 '''
@@ -1,63 +1,88 @@
-from rest_framework import viewsets, generics, status, permissions
+from rest_framework import viewsets, generics, status, permissions, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Count, Q
-from django.utils import timezone
+from rest_framework.views import APIView
+from django.db.models import BooleanField, ExpressionWrapper, F, FilteredRelation, Q
+from django.db.models.functions import Coalesce
 
-from .models import Chat, Message, Company, AppUser
-from .chat_serializers import ChatSerializer, MessageSerializer, CompanyChatSerializer
+from .models import Chat, Company
+from .chat_serializers import (
+    ChatSerializer, MessageSerializer, CompanyChatSerializer, ChatCompanySerializer,
+    MessageSearchQuerySerializer, MessageSearchHitSerializer,
+    ChatSyncQuerySerializer, ChatSyncSerializer, CompanyChatSyncSerializer
+)
 from .permissions import IsOwnerOrAdmin
+from .chat_service import send_message, mark_read
+from .pagination import MessageCursorPagination
+from .chat_search import search_messages
+from .ratelimit import ChatSendThrottle
+from .chat_sync import sync_chats
+from .chat_events import get_represented_company_ids
 
 
 class CompanyChatListView(generics.ListAPIView):
-    """List all companies for chat functionality"""
-    queryset = Company.objects.all()
-    serializer_class = ChatSerializer
+    """
+    List all companies for chat functionality.
+    Each company is joined to the current user's chat with it in a single query,
+    paginated and searchable by name (?search=).
+    """
+    serializer_class = ChatCompanySerializer
     permission_classes = [permissions.IsAuthenticated]
+    filter_backends = [filters.SearchFilter]
+    search_fields = ['name']
     
     def get_queryset(self):
         # Handle Swagger schema generation
         if getattr(self, 'swagger_fake_view', False):
             return Company.objects.none()
             
-        # Annotate companies with chat info for the current user
+        # Left join each company to the current user's chat with it (at most one, see
+        # Chat.unique_together) and take the chat id and unread counter from the join
         user = self.request.user
-        companies = Company.objects.all()
-        
-        # For each company, we'll annotate with whether there's an active chat
-        # and the count of unread messages
-        for company in companies:
-            try:
-                chat = Chat.objects.get(user=user, company=company)
-                company.has_chat = True
-                company.chat_id = chat.id
-                company.unread_count = Message.objects.filter(
-                    chat=chat, 
-                    is_read=False, 
-                    sender_type='company'
-                ).count()
-            except Chat.DoesNotExist:
-                company.has_chat = False
-                company.chat_id = None
-                company.unread_count = 0
-                
-        return companies.order_by('name')
+        return Company.objects.annotate(
+            user_chat=FilteredRelation('chats', condition=Q(chats__user=user)),
+        ).annotate(
+            chat_id=F('user_chat__id'),
+            has_chat=ExpressionWrapper(Q(user_chat__id__isnull=False), output_field=BooleanField()),
+            unread_count=Coalesce(F('user_chat__unread_for_user'), 0),
+        ).order_by('name', 'id')
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        result = []
-        
-        for company in queryset:
-            result.append({
-                'id': company.id,
-                'name': company.name,
-                'description': company.description,
-                'has_chat': getattr(company, 'has_chat', False),
-                'chat_id': getattr(company, 'chat_id', None),
-                'unread_count': getattr(company, 'unread_count', 0)
-            })
-        
-        return Response(result)
+
+class ChatSyncView(APIView):
+    """
+    Delta sync for clients coming back from the background.
+    GET /api/chat/sync/?since=<token> returns the chats and messages changed since
+    the token and a new token to pass next time, in one response:
+    {"chats": [...], "messages": [...], "token": "...", "has_more": false}
+    Without since, all chats are returned (no messages) along with a first token.
+    While has_more is true, call again with the new token right away.
+    ?side=company syncs the chats of the companies the user answers for.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        params = ChatSyncQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        side = params.validated_data['side']
+        user = request.user
+
+        if side == 'company':
+            chats = Chat.objects.filter(company_id__in=get_represented_company_ids(user)).select_related('user')
+            serializer_class = CompanyChatSyncSerializer
+        else:
+            chats = Chat.objects.filter(user=user).select_related('company')
+            serializer_class = ChatSyncSerializer
+
+        changed_chats, messages, cursor, has_more = sync_chats(
+            chats.order_by('-updated_at'), params.validated_data.get('since')
+        )
+
+        return Response({
+            'chats': serializer_class(changed_chats, many=True, context={'request': request}).data,
+            'messages': MessageSerializer(messages, many=True).data,
+            'token': cursor.token(),
+            'has_more': has_more,
+        })
 
 
 class ChatViewSet(viewsets.ModelViewSet):
@@ -96,16 +121,7 @@ class ChatViewSet(viewsets.ModelViewSet):
         initial_message = None
         content = request.data.get('content')
         if content:
-            initial_message = Message.objects.create(
-                chat=chat,
-                sender_type='user',
-                content=content,
-                is_read=False
-            )
-            
-            # Update chat timestamp if a new message was sent
-            chat.updated_at = timezone.now()
-            chat.save()
+            initial_message = send_message(chat, 'user', content)
         
         # Return the chat and optionally the initial message
         chat_serializer = self.get_serializer(chat)
@@ -119,19 +135,24 @@ class ChatViewSet(viewsets.ModelViewSet):
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
-        """Get all messages for a specific chat"""
+        """
+        Get a page of messages for a specific chat.
+        Use ?before=<id>&limit= for older history and ?after=<id> for newer messages,
+        add ?include_archived=1 to reach messages that were moved to the archive.
+        """
         chat = self.get_object()
-        messages = chat.messages.all().order_by('timestamp')
         
         # Mark all unread messages as read when user views them
-        if request.user == chat.user:
-            unread_messages = messages.filter(is_read=False, sender_type='company')
-            unread_messages.update(is_read=True)
+        if request.user.id == chat.user_id:
+            mark_read(chat, 'user')
         
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        paginator = MessageCursorPagination()
+        archived = chat.archived_messages.all() if paginator.include_archived(request) else None
+        page = paginator.paginate_queryset(chat.messages.all(), request, view=self, archived=archived)
+        serializer = MessageSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
     
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['post'], throttle_classes=[ChatSendThrottle])
     def send_message(self, request, pk=None):
         """Send a new message in the chat"""
         chat = self.get_object()
@@ -141,17 +162,8 @@ class ChatViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Message content is required'}, 
                            status=status.HTTP_400_BAD_REQUEST)
         
-        # Create the message
-        message = Message.objects.create(
-            chat=chat,
-            sender_type='user',  # Since this is sent by the app user
-            content=content,
-            is_read=False
-        )
-        
-        # Update the chat's updated_at timestamp
-        chat.updated_at = timezone.now()
-        chat.save()
+        # Create the message and update the chat's updated_at timestamp
+        message = send_message(chat, 'user', content)  # Since this is sent by the app user
         
         serializer = MessageSerializer(message)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -165,7 +177,7 @@ class ChatViewSet(viewsets.ModelViewSet):
             return Response([], status=status.HTTP_401_UNAUTHORIZED)
             
         unread_counts = Chat.objects.filter(user=request.user)\
-            .annotate(unread=Count('messages', filter=Q(messages__is_read=False, messages__sender_type='company')))\
+            .annotate(unread=F('unread_for_user'))\
             .values('id', 'company__name', 'unread')
         
         return Response(unread_counts)
@@ -186,13 +198,13 @@ class CompanyChatViewSet(viewsets.ModelViewSet):
         
         # If user is superadmin, they can see all chats for all companies
         if user.is_superuser:
-            return Chat.objects.all().order_by('-updated_at')
+            return Chat.objects.select_related('user').order_by('-updated_at')
         
         # Check for company assignment in user profile
         # This would need to be implemented based on how you want to associate users with companies
         # For example, if you add a company field to the AppUser model
         if hasattr(user, 'company') and user.company:
-            return Chat.objects.filter(company=user.company).order_by('-updated_at')
+            return Chat.objects.filter(company=user.company).select_related('user').order_by('-updated_at')
         
         # Alternative: check if user is in a group named after a company
         company_groups = user.groups.filter(name__startswith='company_')
@@ -207,12 +219,13 @@ class CompanyChatViewSet(viewsets.ModelViewSet):
                     continue
             
             if company_ids:
-                return Chat.objects.filter(company__id__in=company_ids).order_by('-updated_at')
+                return Chat.objects.filter(company__id__in=company_ids).select_related('user')\
+                    .order_by('-updated_at')
         
         # Return empty queryset if user doesn't represent any company
         return Chat.objects.none()
     
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['post'], throttle_classes=[ChatSendThrottle])
     def reply(self, request, pk=None):
         """Send a reply from the company to the user"""
         chat = self.get_object()
@@ -236,17 +249,8 @@ class CompanyChatViewSet(viewsets.ModelViewSet):
             return Response({'error': 'You are not authorized to reply on behalf of this company'}, 
                           status=status.HTTP_403_FORBIDDEN)
         
-        # Create the message
-        message = Message.objects.create(
-            chat=chat,
-            sender_type='company',  # Since this is sent by the company
-            content=content,
-            is_read=False
-        )
-        
-        # Update the chat's updated_at timestamp
-        chat.updated_at = timezone.now()
-        chat.save()
+        # Create the message and update the chat's updated_at timestamp
+        message = send_message(chat, 'company', content)  # Since this is sent by the company
         
         # Prepare response with both message and updated chat data
         message_serializer = MessageSerializer(message)
@@ -261,9 +265,20 @@ class CompanyChatViewSet(viewsets.ModelViewSet):
     def mark_as_read(self, request, pk=None):
         """Mark all user messages as read by the company"""
         chat = self.get_object()
-        unread_count = Message.objects.filter(chat=chat, is_read=False, sender_type='user').update(is_read=True)
+        unread_count = mark_read(chat, 'company')
         
         return Response({
             'success': True,
             'messages_marked_read': unread_count
         })
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full-text search over the messages of the chats this user can see.
+        ?q=<words>&limit= returns the best matching messages with a snippet each.
+        """
+        params = MessageSearchQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        hits = search_messages(self.get_queryset(), **params.validated_data)
+        return Response({'results': MessageSearchHitSerializer(hits, many=True).data})
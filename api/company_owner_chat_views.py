@@ -2,12 +2,18 @@ from rest_framework import generics, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.db.models import Count, Q
-from django.utils import timezone
+from django.db.models import Q, Sum
 
 from .models import Chat, Message, Company, AppUser
-from .chat_serializers import ChatSerializer, MessageSerializer, CompanyChatSerializer
+from .chat_serializers import (
+    ChatSerializer, MessageSerializer, CompanyChatSerializer,
+    MessageSearchQuerySerializer, MessageSearchHitSerializer
+)
 from .permissions import IsOwnerOrAdmin
+from .chat_service import send_message, mark_read, last_message_data
+from .pagination import MessageCursorPagination
+from .chat_search import search_messages
+from .ratelimit import ChatSendThrottle
 
 class CompanyOwnerChatListView(generics.ListAPIView):
     """
@@ -24,8 +30,8 @@ class CompanyOwnerChatListView(generics.ListAPIView):
         if not hasattr(user, 'company') or not user.company:
             return Chat.objects.none()
         
-        # Return all chats for the user's company
-        return Chat.objects.filter(company=user.company).order_by('-updated_at')
+        # Return all chats for the user's company, with the user shown on each row
+        return Chat.objects.filter(company=user.company).select_related('user').order_by('-updated_at')
 
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
@@ -34,11 +40,9 @@ class CompanyOwnerChatListView(generics.ListAPIView):
         # Add additional statistics
         total_chats = queryset.count()
         active_chats = queryset.filter(is_active=True).count()
-        unread_messages = Message.objects.filter(
-            chat__in=queryset,
-            sender_type='user',
-            is_read=False
-        ).count()
+        # Only chats with unread messages, served by the partial chat_company_unread_idx on PostgreSQL
+        unread_messages = queryset.filter(unread_for_company__gt=0)\
+            .aggregate(total=Sum('unread_for_company'))['total'] or 0
         
         return Response({
             'chats': serializer.data,
@@ -47,6 +51,17 @@ class CompanyOwnerChatListView(generics.ListAPIView):
             'unread_messages': unread_messages
         })
 
+class CompanyOwnerChatSearchView(CompanyOwnerChatListView):
+    """
+    Full-text search over the messages of the company owner's chats.
+    ?q=<words>&limit= returns the best matching messages with a snippet each.
+    """
+    def list(self, request, *args, **kwargs):
+        params = MessageSearchQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        hits = search_messages(self.get_queryset(), **params.validated_data)
+        return Response({'results': MessageSearchHitSerializer(hits, many=True).data})
+
 class CompanyOwnerChatDetailView(generics.RetrieveAPIView):
     """
     Retrieve a specific chat for the company owner.
@@ -62,22 +77,29 @@ class CompanyOwnerChatDetailView(generics.RetrieveAPIView):
             return Chat.objects.none()
         
         # Return the chat only if it belongs to the user's company
-        return Chat.objects.filter(company=user.company)
+        return Chat.objects.filter(company=user.company).select_related('user')
     
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
+        
+        # Mark messages from user as read first, so the chat and its messages are
+        # returned as read
+        unread_count = mark_read(instance, 'company')
         serializer = self.get_serializer(instance)
         
-        # Get messages for this chat
-        messages = Message.objects.filter(chat=instance).order_by('timestamp')
+        # Get a page of messages for this chat (?before=<id>&limit= / ?after=<id>,
+        # ?include_archived=1 for messages moved to the archive)
+        paginator = MessageCursorPagination()
+        archived = instance.archived_messages.all() if paginator.include_archived(request) else None
+        messages = paginator.paginate_queryset(instance.messages.all(), request, view=self, archived=archived)
         message_serializer = MessageSerializer(messages, many=True)
-        
-        # Mark messages from user as read
-        unread_count = messages.filter(sender_type='user', is_read=False).update(is_read=True)
+        chat_data = serializer.data
+        messages_data = message_serializer.data
         
         return Response({
-            'chat': serializer.data,
-            'messages': message_serializer.data,
+            'chat': chat_data,
+            'messages': messages_data,
+            'messages_pagination': paginator.get_pagination_data(),
             'messages_marked_read': unread_count
         })
 
@@ -86,6 +108,7 @@ class CompanyOwnerSendMessageView(APIView):
     Send a message from the company owner to a user.
     """
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [ChatSendThrottle]
     
     def post(self, request, chat_id):
         user = request.user
@@ -108,17 +131,8 @@ class CompanyOwnerSendMessageView(APIView):
             return Response({'error': 'Message content is required'},
                           status=status.HTTP_400_BAD_REQUEST)
         
-        # Create the message
-        message = Message.objects.create(
-            chat=chat,
-            sender_type='company',  # Message from company
-            content=content,
-            is_read=False
-        )
-        
-        # Update the chat's timestamp
-        chat.updated_at = timezone.now()
-        chat.save()
+        # Create the message and update the chat's timestamp
+        message = send_message(chat, 'company', content)  # Message from company
         
         # Return the message data
         serializer = MessageSerializer(message)
@@ -143,23 +157,17 @@ class CompanyOwnerGetUserListView(generics.ListAPIView):
         return AppUser.objects.filter(id__in=user_ids)
     
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
+        if not hasattr(request.user, 'company') or not request.user.company:
+            return Response([])
+        
+        # One query: each chat carries its user, unread counter and last message preview
+        chats = (Chat.objects.filter(company=request.user.company)
+                 .select_related('user')
+                 .order_by('-updated_at'))
         
         users_with_chats = []
-        for user in queryset:
-            # Get the chat for this user with the company
-            chat = Chat.objects.get(user=user, company=request.user.company)
-            
-            # Get unread message count
-            unread_count = Message.objects.filter(
-                chat=chat, 
-                sender_type='user',
-                is_read=False
-            ).count()
-            
-            # Get last message
-            last_message = Message.objects.filter(chat=chat).order_by('-timestamp').first()
-            
+        for chat in chats:
+            user = chat.user
             users_with_chats.append({
                 'user_id': user.id,
                 'username': user.username,
@@ -167,16 +175,8 @@ class CompanyOwnerGetUserListView(generics.ListAPIView):
                 'full_name': f"{user.first_name} {user.last_name}".strip(),
                 'chat_id': chat.id,
                 'last_active': chat.updated_at,
-                'unread_messages': unread_count,
-                'last_message': {
-                    'content': last_message.content[:50] + '...' if last_message and len(last_message.content) > 50 else 
-                              (last_message.content if last_message else None),
-                    'timestamp': last_message.timestamp if last_message else None,
-                    'sender_type': last_message.sender_type if last_message else None
-                } if last_message else None
+                'unread_messages': chat.unread_for_company,
+                'last_message': last_message_data(chat)
             })
         
-        # Sort by last active time
-        users_with_chats.sort(key=lambda x: x['last_active'], reverse=True)
-        
         return Response(users_with_chats)
@@ -1,49 +1,91 @@
+import asyncio
+import math
+import time
+from collections import deque
+from urllib.parse import parse_qs
+
+from channels.consumer import get_handler_name
+from channels.db import aclose_old_connections
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.utils import timezone
-from rest_framework_simplejwt.tokens import AccessToken, TokenError
-from .models import AppUser, Chat, Message
+from django.db import IntegrityError
+from .models import Chat
+from .chat_service import other_side
+from .chat_events import user_group, company_group, company_presence_group, group_send_many, subscription_groups
+from .chat_data import ChatData
+from . import chat_codec, presence, ratelimit
+
+
+# Events that may be dropped for a slow connection, the next one supersedes them
+EPHEMERAL_EVENTS = {'chat.typing', 'presence.update'}
 
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
+    # Remembered event ids per connection, for dropping copies received through another group
+    max_seen_events = 256
+    # All database access goes through this, see api.chat_data
+    data = ChatData()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seen_event_ids = set()
+        self.recent_event_ids = deque()
+        self.slow_consumer = False
+        self.subprotocol = None
+        self.batching = False
+        self.last_received = time.monotonic()
+
     async def connect(self):
         """
         Called when the websocket is handshaking as part of initial connection.
-        Validates the token and sets up channel groups.
+        The user is authenticated from the JWT by JWTAuthMiddleware.
+        Resolves the authorization context and sets up channel groups.
         """
-        # Get the user token from the query string
-        self.token = self.scope["query_string"].decode("utf-8").split("=")[-1]
-        self.user = await self.get_user_from_token(self.token)
-        
+        self.user = self.scope.get("user")
+
         # If no user (invalid token), close connection
         if not self.user or isinstance(self.user, AnonymousUser):
             await self.close(code=4001)  # 4001: Authentication failed
             return
-            
-        # If a user is found, accept the connection
-        await self.accept()
-        
-        # Add user to their personal channel group
-        await self.channel_layer.group_add(
-            f"user_{self.user.id}",
-            self.channel_name
-        )
-        
-        # If user is associated with a company, add to company channel group
-        if hasattr(self.user, 'company') and self.user.company:
-            await self.channel_layer.group_add(
-                f"company_{self.user.company.id}",
-                self.channel_name
-            )
-            
-        # Check if the user is in any company groups (for representatives)
-        company_groups = await database_sync_to_async(self.get_user_company_groups)(self.user)
-        for company_id in company_groups:
-            await self.channel_layer.group_add(
-                f"company_{company_id}",
-                self.channel_name
-            )
+
+        # Resolve once which companies the user represents and which chats it may send to.
+        # The context lives as long as the connection and is refreshed by auth.* events.
+        self.company_ids = set()
+        self.chat_access = {}
+        await self.load_context()
+
+        # If a user is found, accept the connection. Clients that offer the chat.msgpack
+        # subprotocol get binary MessagePack frames instead of JSON, see api.chat_codec.
+        self.subprotocol = chat_codec.negotiate(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=self.subprotocol)
+
+        # Batch frames only go to clients that understand them: ?batch=1, or MessagePack
+        # clients, whose protocol had batches from the start
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.batching = query.get('batch', [''])[0] in ('1', 'true') or self.subprotocol == chat_codec.SUBPROTOCOL
+
+        # Outgoing frames go through a bounded queue drained by a single writer
+        self.send_queue = asyncio.Queue(maxsize=getattr(settings, 'CHAT_WS_SEND_QUEUE_SIZE', 100))
+        self.sender_task = asyncio.ensure_future(self.send_loop())
+
+        # Pings the client when it goes quiet and closes the connection once it stays silent
+        if getattr(settings, 'CHAT_WS_IDLE_TIMEOUT', 60):
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat_loop())
+
+        # Join the personal group and one group per represented company.
+        # Joined groups are recorded, so each is joined once and left on disconnect.
+        self.joined_groups = set()
+        await self.sync_groups()
+
+        # Announce the user to the other side of its chats and tell it who is online.
+        # Presence lives in memory only and is never written to the database.
+        presence.connections[self.user.id] += 1
+        presence.mark_online(self.user.id, self.company_ids)
+        self.tracks_presence = True
+        if presence.should_announce(self.user.id) or presence.connections[self.user.id] == 1:
+            await self.broadcast_presence('online')
+        await self.send_presence_state()
 
     async def disconnect(self, close_code):
         """
@@ -51,39 +93,203 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         Remove user from channel groups.
         """
         if hasattr(self, 'user') and self.user and not isinstance(self.user, AnonymousUser):
-            # Remove from user group
-            await self.channel_layer.group_discard(
-                f"user_{self.user.id}",
-                self.channel_name
-            )
-            
-            # Remove from company group if applicable
-            if hasattr(self.user, 'company') and self.user.company:
-                await self.channel_layer.group_discard(
-                    f"company_{self.user.company.id}",
-                    self.channel_name
-                )
-                
-            # Remove from company groups from user's group memberships
-            company_groups = await database_sync_to_async(self.get_user_company_groups)(self.user)
-            for company_id in company_groups:
-                await self.channel_layer.group_discard(
-                    f"company_{company_id}",
-                    self.channel_name
-                )
+            await self.leave()
+
+        for task in (getattr(self, 'sender_task', None), getattr(self, 'heartbeat_task', None)):
+            if task is not None:
+                task.cancel()
+
+    async def leave(self):
+        """
+        Leave the groups recorded in joined_groups and go offline. Runs on disconnect and
+        when an idle connection is reaped, whichever comes first; the second does nothing.
+        """
+        groups, self.joined_groups = getattr(self, 'joined_groups', set()), set()
+        tracks_presence, self.tracks_presence = getattr(self, 'tracks_presence', False), False
+
+        # Leave every group joined on connect or since
+        for group in groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+        # This process stops vouching for the user with its last connection here.
+        # Whether the user is offline depends on the entries of other processes.
+        if tracks_presence:
+            presence.connections[self.user.id] -= 1
+            if presence.connections[self.user.id] <= 0:
+                del presence.connections[self.user.id]
+                presence.mark_offline(self.user.id)
+                await self.broadcast_presence('offline')
+
+    async def heartbeat_loop(self):
+        """
+        Send {"type": "ping"} every CHAT_WS_PING_INTERVAL seconds while the client is silent.
+        A client that sends nothing, pongs included, for CHAT_WS_IDLE_TIMEOUT seconds is
+        considered gone (e.g. a half-open mobile socket): its groups and presence are
+        dropped right away and the connection is closed with 4009.
+        """
+        interval = getattr(settings, 'CHAT_WS_PING_INTERVAL', 25)
+        timeout = getattr(settings, 'CHAT_WS_IDLE_TIMEOUT', 60)
+        while True:
+            idle = time.monotonic() - self.last_received
+            if idle >= timeout:
+                break
+            if idle >= interval:
+                await self.send_json({'type': 'ping'})
+                await asyncio.sleep(min(interval, timeout - idle))
+            else:
+                await asyncio.sleep(min(interval, timeout) - idle)
+        await self.leave()
+        await self.close(code=4009)  # 4009: Idle timeout
+
+    async def dispatch(self, message):
+        """
+        Drop channel layer events this connection has already handled.
+        An event sent to several groups reaches a connection in more than one of them
+        once per group, they all carry the same event_id.
+
+        Unlike AsyncConsumer.dispatch, old database connections are not closed before
+        every event: that costs a sync thread hop per frame and per fanned-out event,
+        even though most handlers never query. self.data recycles them on its writes.
+        """
+        event_id = message.get('event_id')
+        if event_id is not None:
+            if event_id in self.seen_event_ids:
+                return
+            self.seen_event_ids.add(event_id)
+            self.recent_event_ids.append(event_id)
+            if len(self.recent_event_ids) > self.max_seen_events:
+                self.seen_event_ids.discard(self.recent_event_ids.popleft())
+
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None:
+            raise ValueError(f"No handler for message type {message['type']}")
+        await handler(message)
+
+    def wanted_groups(self):
+        """
+        The personal group plus one group per company the user represents, and the
+        presence group of every company the user chats with
+        """
+        return subscription_groups(self.user.id, self.company_ids) | {
+            company_presence_group(access['company_id'])
+            for access in self.chat_access.values() if access['user_id'] == self.user.id
+        }
+
+    async def sync_groups(self):
+        """Join and leave groups until the joined ones match wanted_groups()"""
+        wanted = self.wanted_groups()
+        for group in self.joined_groups - wanted:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in wanted - self.joined_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.joined_groups = wanted
+
+    async def fan_out(self, groups, event):
+        """
+        Send an event to each distinct group once. All copies share one event_id,
+        so a connection that is in several of the groups handles it once.
+        """
+        await group_send_many(self.channel_layer, groups, event)
+
+    async def send_json(self, content, close=False):
+        """
+        Queue a frame for the writer task. When the queue is full the connection is too
+        slow to keep up: ephemeral events are dropped, anything else closes it with 4008
+        so the client reconnects and catches up from the API.
+        """
+        send_queue = getattr(self, 'send_queue', None)
+        if send_queue is None or close:
+            await self.send_frame(content, close=close)
+            return
+        if self.slow_consumer:
+            return
+        try:
+            send_queue.put_nowait(content)
+        except asyncio.QueueFull:
+            if content.get('type') in EPHEMERAL_EVENTS:
+                return
+            self.slow_consumer = True
+            self.sender_task.cancel()
+            await self.close(code=4008)  # 4008: Too slow, events were lost
+
+    async def send_loop(self):
+        """
+        Writer task: sends queued frames in order. For connections that opted into
+        batching, frames queued within the batch window are sent together as one
+        {"type": "batch", "events": [...]} frame; others get one frame per event.
+        """
+        batch_window = getattr(settings, 'CHAT_WS_BATCH_WINDOW', 0.01)
+        max_batch = getattr(settings, 'CHAT_WS_MAX_BATCH', 50)
+        while True:
+            batch = [await self.send_queue.get()]
+            if not self.batching:
+                await self.send_frame(batch[0])
+                continue
+            if batch_window:
+                await asyncio.sleep(batch_window)
+            while len(batch) < max_batch and not self.send_queue.empty():
+                batch.append(self.send_queue.get_nowait())
+            if len(batch) == 1:
+                await self.send_frame(batch[0])
+            else:
+                await self.send_frame({'type': 'batch', 'events': batch})
+
+    async def send_frame(self, content, close=False):
+        """Write one frame to the socket, as MessagePack if the connection negotiated it"""
+        if self.subprotocol == chat_codec.SUBPROTOCOL:
+            await self.send(bytes_data=chat_codec.encode(content), close=close)
+        else:
+            await super().send_json(content, close=close)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """
+        Binary frames of a chat.msgpack connection are decoded as MessagePack,
+        text frames are JSON whichever protocol was negotiated.
+        Any frame counts as a sign of life for the heartbeat and keeps the user online,
+        so clients answering the server's pings stay present without presence.ping.
+        """
+        self.last_received = time.monotonic()
+        if getattr(self, 'tracks_presence', False):
+            await self.handle_presence_ping()
+        if bytes_data is None or self.subprotocol != chat_codec.SUBPROTOCOL:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+            return
+        try:
+            content = chat_codec.decode(bytes_data)
+        except ValueError:
+            content = None
+        if not isinstance(content, dict):
+            await self.send_json({
+                'type': 'error',
+                'content': "Invalid MessagePack frame"
+            })
+            return
+        await self.receive_json(content, **kwargs)
 
     async def receive_json(self, content):
         """
         Called when a message is received from the client.
         """
         message_type = content.get('type')
-        
+
         if message_type == 'chat.message':
             # Handle new message
             await self.handle_new_message(content)
         elif message_type == 'chat.read':
             # Handle marking messages as read
             await self.handle_read_messages(content)
+        elif message_type == 'chat.typing':
+            # Handle typing indicator
+            await self.handle_typing(content)
+        elif message_type == 'presence.ping':
+            # Receiving it was enough, every frame keeps the user online
+            pass
+        elif message_type == 'ping':
+            # Heartbeat from the client
+            await self.send_json({'type': 'pong'})
+        elif message_type == 'pong':
+            # Answer to the server's ping, receiving it was enough
+            pass
         else:
             # Unknown message type
             await self.send_json({
@@ -95,106 +301,173 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         """Handle a new message from client"""
         chat_id = content.get('chat_id')
         message_content = content.get('content')
-        
+
         if not chat_id or not message_content:
             await self.send_json({
                 'type': 'error',
                 'content': "Missing chat_id or message content"
             })
             return
-            
-        # Determine sender type (user or company)
-        sender_type = 'user'  # Default
-        if (hasattr(self.user, 'company') and self.user.company) or \
-           await database_sync_to_async(self.get_user_company_groups)(self.user):
-            # Check if user has permission to send as company for this chat
-            chat = await self.get_chat(chat_id)
-            if chat and (self.user.is_superuser or 
-                       (hasattr(self.user, 'company') and self.user.company == chat.company) or
-                       self.user.groups.filter(name=f'company_{chat.company.id}').exists()):
-                sender_type = 'company'
-                
-        # Create the message in database
+
+        # Same chat_send limits as the REST endpoints, checked before any query
+        wait = await ratelimit.acheck('chat_send', self.user.id, ratelimit.get_scope_ip(self.scope))
+        if wait:
+            await self.send_json({
+                'type': 'error',
+                'content': "Too many messages, try again later",
+                'retry_after': math.ceil(wait)
+            })
+            return
+
+        # Determine sender type (user or company) from the cached context
+        access = await self.get_chat_access(chat_id)
+        sender_type = self.get_sender_type(access)
+        if sender_type is None:
+            await self.send_json({
+                'type': 'error',
+                'content': "You are not allowed to send messages to this chat"
+            })
+            return
+        if not access['is_active']:
+            await self.send_json({
+                'type': 'error',
+                'content': "Cannot send message to inactive chat"
+            })
+            return
+
+        # Create the message in database, the chat service broadcasts it
+        # to the user and company groups once committed
         message = await self.create_message(
             chat_id=chat_id,
             sender_type=sender_type,
             content=message_content
         )
-        
+
         if not message:
             await self.send_json({
                 'type': 'error',
                 'content': "Failed to create message"
             })
             return
-            
-        # Get serialized message data
-        message_data = await self.get_message_data(message)
-        
-        # Broadcast message to appropriate groups
-        chat = await self.get_chat(chat_id)
-        if chat:
-            # Send to user's channel
-            await self.channel_layer.group_send(
-                f"user_{chat.user.id}",
-                {
-                    "type": "chat.message",
-                    "message": message_data
-                }
-            )
-            
-            # Send to company's channel
-            await self.channel_layer.group_send(
-                f"company_{chat.company.id}",
-                {
-                    "type": "chat.message",
-                    "message": message_data
-                }
-            )
 
     async def handle_read_messages(self, content):
-        """Mark messages as read"""
+        """
+        Mark the messages sent to this connection's side of a chat as read.
+        The reader is the side the connection holds in the chat, like the REST views:
+        sender_type is optional and, if given, must name the other side.
+        """
         chat_id = content.get('chat_id')
         sender_type = content.get('sender_type')
-        
-        if not chat_id or not sender_type:
+
+        if not chat_id:
             await self.send_json({
                 'type': 'error',
-                'content': "Missing chat_id or sender_type"
+                'content': "Missing chat_id"
             })
             return
-            
+
+        access = await self.get_chat_access(chat_id)
+        reader_type = self.get_sender_type(access)
+        if reader_type is None:
+            await self.send_json({
+                'type': 'error',
+                'content': "You are not allowed to access this chat"
+            })
+            return
+        if sender_type is not None and sender_type != other_side(reader_type):
+            await self.send_json({
+                'type': 'error',
+                'content': f"Invalid sender_type: {sender_type}, only messages sent to you can be marked as read"
+            })
+            return
+        sender_type = other_side(reader_type)
+
         # Mark messages as read
-        updated_count = await self.mark_messages_as_read(chat_id, sender_type)
-        
+        updated_count = await self.mark_messages_as_read(chat_id, reader_type)
+
         # Acknowledge the operation
         await self.send_json({
             'type': 'chat.read.confirmed',
             'chat_id': chat_id,
             'updated_count': updated_count
         })
-        
+
         # Notify other clients about read status change
-        chat = await self.get_chat(chat_id)
-        if chat:
-            notification = {
-                "type": "chat.read.updated",
-                "chat_id": chat_id,
-                "updated_by": self.user.id,
-                "sender_type": sender_type
-            }
-            
-            # Send to user's channel
-            await self.channel_layer.group_send(
-                f"user_{chat.user.id}",
-                notification
-            )
-            
-            # Send to company's channel
-            await self.channel_layer.group_send(
-                f"company_{chat.company.id}",
-                notification
-            )
+        notification = {
+            "type": "chat.read.updated",
+            "chat_id": chat_id,
+            "updated_by": self.user.id,
+            "sender_type": sender_type
+        }
+
+        # Send to both sides of the chat
+        await self.fan_out([user_group(access['user_id']), company_group(access['company_id'])], notification)
+
+    async def handle_typing(self, content):
+        """Tell both sides of a chat that this user is typing, at most once per interval"""
+        chat_id = content.get('chat_id')
+        access = await self.get_chat_access(chat_id)
+        sender_type = self.get_sender_type(access)
+        if sender_type is None:
+            await self.send_json({
+                'type': 'error',
+                'content': "You are not allowed to access this chat"
+            })
+            return
+
+        # A burst of keystrokes is coalesced into one broadcast per interval
+        if not presence.should_broadcast_typing(int(chat_id), sender_type):
+            return
+
+        event = {
+            "type": "chat.typing",
+            "chat_id": int(chat_id),
+            "user_id": self.user.id,
+            "sender_type": sender_type
+        }
+        await self.fan_out([user_group(access['user_id']), company_group(access['company_id'])], event)
+
+    async def handle_presence_ping(self):
+        """Refresh the user's presence, rebroadcasting it only when remote stores need it"""
+        presence.mark_online(self.user.id, self.company_ids)
+        if presence.should_announce(self.user.id):
+            await self.broadcast_presence('online')
+
+    def presence_groups(self):
+        """
+        Groups reaching the other side of every chat this user takes part in, one per
+        counterpart: the companies it chats with, and for the companies it represents
+        their presence group rather than each of their users
+        """
+        groups = {company_presence_group(company_id) for company_id in self.company_ids}
+        for access in self.chat_access.values():
+            if access['user_id'] == self.user.id:
+                groups.add(company_group(access['company_id']))
+        return groups
+
+    async def broadcast_presence(self, status):
+        """Send a presence.update ('online' or 'offline') to the other side of the user's chats"""
+        event = {
+            "type": "presence.update",
+            "user_id": self.user.id,
+            "company_ids": sorted(self.company_ids),
+            "status": status,
+            "origin": presence.ORIGIN
+        }
+        await self.fan_out(self.presence_groups(), event)
+
+    async def send_presence_state(self):
+        """Send the client which users and companies of its chats are online right now"""
+        user_ids = {access['user_id'] for access in self.chat_access.values()
+                    if access['company_id'] in self.company_ids}
+        company_ids = {access['company_id'] for access in self.chat_access.values()
+                       if access['user_id'] == self.user.id}
+        user_ids.discard(self.user.id)
+        await self.send_json({
+            'type': 'presence.state',
+            'users': presence.online_user_ids(user_ids),
+            'companies': presence.online_company_ids(company_ids)
+        })
 
     async def chat_message(self, event):
         """
@@ -209,103 +482,118 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         Forward the notification to the client.
         """
         await self.send_json(event)
-        
-    @database_sync_to_async
-    def get_user_from_token(self, token_str):
-        """Validate JWT token and return user"""
-        if not token_str:
-            return AnonymousUser()
-            
-        try:
-            # Validate the token
-            token = AccessToken(token_str)
-            user_id = token.payload.get('user_id')
-            
-            # Get the user from the ID in token payload
-            if user_id:
-                return AppUser.objects.get(id=user_id)
-                
-        except (TokenError, AppUser.DoesNotExist):
-            pass
-            
-        return AnonymousUser()
-        
-    def get_user_company_groups(self, user):
-        """Return company IDs from user group memberships"""
-        company_ids = []
-        for group in user.groups.filter(name__startswith='company_'):
-            try:
-                company_id = int(group.name.replace('company_', ''))
-                company_ids.append(company_id)
-            except ValueError:
-                continue
-                
-        return company_ids
 
-    @database_sync_to_async
-    def get_chat(self, chat_id):
-        """Get chat by ID"""
-        try:
-            return Chat.objects.get(id=chat_id)
-        except Chat.DoesNotExist:
+    async def chat_typing(self, event):
+        """
+        Called when someone is typing in a chat of this user.
+        Other connections of the process coalesce against it too.
+        """
+        presence.note_typing(event['chat_id'], event['sender_type'])
+        if event['user_id'] != self.user.id:
+            await self.send_json(event)
+
+    async def presence_update(self, event):
+        """
+        Called when the other side of one of the user's chats comes online or goes offline.
+        Mirrors the update into this process's presence store and forwards it. An offline
+        update only drops the sending process's entry, it is forwarded once no process
+        has the user online any more.
+        """
+        origin = event.get('origin', presence.ORIGIN)
+        if event['status'] == 'online':
+            presence.mark_online(event['user_id'], event['company_ids'], origin)
+        elif presence.mark_offline(event['user_id'], origin):
+            return
+        if event['user_id'] != self.user.id:
+            await self.send_json(event)
+
+    async def auth_invalidate(self, event):
+        """
+        Called when the user's company or group memberships changed.
+        Re-resolve the context and follow the company groups it implies.
+        """
+        user = await self.data.get_user(self.user.id)
+        if user is None:
+            await self.close(code=4003)  # 4003: Access revoked
+            return
+        self.user = user
+        await self.load_context()
+        presence.mark_online(self.user.id, self.company_ids)
+        await self.sync_groups()
+
+    async def auth_chat_updated(self, event):
+        """
+        Called when a chat's participants or active flag changed.
+        Only the cached entry for that chat is refreshed, and the presence groups
+        it implies are followed.
+        """
+        chat_id = event['chat_id']
+        if event.get('deleted'):
+            self.chat_access.pop(chat_id, None)
+        else:
+            self.chat_access[chat_id] = {
+                'user_id': event['user_id'],
+                'company_id': event['company_id'],
+                'is_active': event['is_active'],
+            }
+        await self.sync_groups()
+
+    def get_sender_type(self, access):
+        """
+        Return the sender type this connection uses in a chat, or None if it may not send.
+        Company representatives and superusers reply as the company.
+        """
+        if access is None:
             return None
-    
-    @database_sync_to_async
-    def create_message(self, chat_id, sender_type, content):
-        """Create a new message in the database"""
+        if self.user.is_superuser or access['company_id'] in self.company_ids:
+            return 'company'
+        if access['user_id'] == self.user.id:
+            return 'user'
+        return None
+
+    async def get_chat_access(self, chat_id):
+        """
+        Return the cached access entry for a chat, resolving chats created after connect once.
+        Missing chats are not cached, so ids made up by the client cannot grow the cache.
+        """
         try:
-            chat = Chat.objects.get(id=chat_id)
-            
-            # Only proceed if chat is active
-            if not chat.is_active:
-                return None
-                
-            # Create message
-            message = Message.objects.create(
-                chat=chat,
-                sender_type=sender_type,
-                content=content,
-                is_read=False
-            )
-            
-            # Update chat's updated_at timestamp
-            chat.updated_at = timezone.now()
-            chat.save()
-            
-            return message
-            
-        except Chat.DoesNotExist:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
             return None
-    
-    @database_sync_to_async
-    def get_message_data(self, message):
-        """Convert message object to dictionary for JSON response"""
-        return {
-            'id': message.id,
-            'chat_id': message.chat_id,
-            'sender_type': message.sender_type,
-            'content': message.content,
-            'timestamp': message.timestamp.isoformat(),
-            'is_read': message.is_read
-        }
-    
-    @database_sync_to_async
-    def mark_messages_as_read(self, chat_id, sender_type):
-        """Mark messages of the specified sender_type in the chat as read"""
+        if chat_id not in self.chat_access:
+            access = await self.data.get_chat_access(chat_id)
+            if access is None:
+                return None
+            self.chat_access[chat_id] = access
+            if access['user_id'] == self.user.id:
+                await self.sync_groups()
+        return self.chat_access[chat_id]
+
+    async def load_context(self):
+        """
+        Resolve the user's company ids and the chats it may send to.
+        Runs on connect and on auth changes, which is also when stale database
+        connections are closed for the reads in between.
+        """
+        await aclose_old_connections()
+        self.group_company_ids = await self.data.get_group_company_ids(self.user)
+        self.company_ids = set(self.group_company_ids)
+        if getattr(self.user, 'company_id', None):
+            self.company_ids.add(self.user.company_id)
+        self.chat_access = await self.data.get_chat_access_map(self.user, self.company_ids)
+
+    async def create_message(self, chat_id, sender_type, content):
+        """Create a new message in the database through the chat service"""
+        # Access and the active flag were already checked against the cached context
+        access = self.chat_access[int(chat_id)]
+        chat = Chat(id=int(chat_id), user_id=access['user_id'], company_id=access['company_id'])
         try:
-            chat = Chat.objects.get(id=chat_id)
-            
-            # Filter messages by sender_type and update
-            unread_messages = Message.objects.filter(
-                chat=chat,
-                sender_type=sender_type,
-                is_read=False
-            )
-            
-            count = unread_messages.count()
-            unread_messages.update(is_read=True)
-            
-            return count
-            
-        except Chat.DoesNotExist:
-            return 0
+            return await self.data.send_message(chat, sender_type, content)
+        except IntegrityError:
+            # The chat was deleted since the context was resolved
+            self.chat_access.pop(int(chat_id), None)
+            return None
+
+    async def mark_messages_as_read(self, chat_id, reader_type):
+        """Mark the messages sent to reader_type in the chat as read"""
+        return await self.data.mark_read(int(chat_id), reader_type)
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.urls import reverse
+from rest_framework import serializers
+
+from .image_utils import get_image_limits, probe_image, check_image_limits, downscale_image
+
+
+class ValidatedImageField(serializers.ImageField):
+    """
+    ImageField that runs the shared image validation stage.
+    The header is probed first so format and pixel limits from settings.IMAGE_LIMITS
+    are enforced before the image is decoded, then oversize originals are downscaled.
+
+    With negotiated=True the URL points at the format negotiating image view
+    instead of the raw media file.
+    """
+    def __init__(self, *args, image_kind='default', negotiated=False, **kwargs):
+        self.image_kind = image_kind
+        self.negotiated = negotiated
+        super().__init__(*args, **kwargs)
+
+    def to_representation(self, value):
+        if not (self.negotiated and getattr(settings, 'IMAGE_NEGOTIATION_ENABLED', True)):
+            return super().to_representation(value)
+        if not value:
+            return None
+
+        url = reverse('negotiated-image', args=[value.name])
+        request = self.context.get('request', None)
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+    def to_internal_value(self, data):
+        limits = get_image_limits(self.image_kind)
+
+        if hasattr(data, 'seek'):
+            probe = probe_image(data)
+            errors = check_image_limits(probe, limits)
+            if errors:
+                raise serializers.ValidationError(errors)
+        else:
+            probe = None
+
+        upload = super().to_internal_value(data)
+        return downscale_image(upload, limits, probe=probe)
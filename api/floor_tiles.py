@@ -0,0 +1,226 @@
+import hashlib
+import io
+import logging
+import math
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+# Build states kept in the cache while a pyramid is queued or after its build failed
+TILES_PENDING = 'pending'
+TILES_FAILED = 'failed'
+
+
+def get_tile_size():
+    return getattr(settings, 'FLOOR_PLAN_TILE_SIZE', 256)
+
+
+def get_tile_format():
+    return getattr(settings, 'FLOOR_PLAN_TILE_FORMAT', 'png')
+
+
+def get_tile_version(floor):
+    """
+    Short hash of the plan image name. A new upload gets a new name and therefore
+    a new version, which is what allows tiles to be cached as immutable.
+    """
+    if not floor.plan_image:
+        return None
+    return hashlib.sha1(floor.plan_image.name.encode('utf-8')).hexdigest()[:12]
+
+
+def get_tiles_dir(floor, version=None):
+    return posixpath.join('floor_tiles', str(floor.pk), version or get_tile_version(floor))
+
+
+def get_descriptor_path(floor, version=None):
+    return posixpath.join(get_tiles_dir(floor, version), 'image.dzi')
+
+
+def get_tile_path(floor, version, z, x, y):
+    return posixpath.join(get_tiles_dir(floor, version), str(z), f'{x}_{y}.{get_tile_format()}')
+
+
+def get_max_level(width, height):
+    """
+    Deep-zoom level of the full resolution image. Level 0 is a single pixel.
+    """
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def get_build_state_key(floor_id, version):
+    return f"floor_tiles:{floor_id}:{version}"
+
+
+def get_build_state(floor):
+    """TILES_PENDING, TILES_FAILED or None for the floor's current plan"""
+    version = get_tile_version(floor)
+    return version and cache.get(get_build_state_key(floor.pk, version))
+
+
+def tiles_ready(floor):
+    """
+    The descriptor is written last, so its presence means the pyramid is complete
+    """
+    version = get_tile_version(floor)
+    return version is not None and default_storage.exists(get_descriptor_path(floor, version))
+
+
+def build_descriptor(width, height):
+    """
+    DZI XML descriptor for an image of the given size
+    """
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+        f'Format="{get_tile_format()}" Overlap="0" TileSize="{get_tile_size()}">\n'
+        f'  <Size Width="{width}" Height="{height}"/>\n'
+        '</Image>\n'
+    )
+
+
+def open_plan(floor, save_format):
+    """
+    Decode the floor plan in a mode the tile format can store.
+    Only the decoded bitmap is kept, the source is dropped as soon as it is converted.
+    """
+    with floor.plan_image.open('rb') as plan_file:
+        image = Image.open(plan_file)
+        image.load()
+    if image.mode in ('L', 'RGB') or (image.mode in ('LA', 'RGBA') and save_format != 'JPEG'):
+        return image
+    return image.convert('RGB' if save_format == 'JPEG' else 'RGBA')
+
+
+def build_floor_tiles(floor, force=False):
+    """
+    Cut the floor plan into a deep-zoom tile pyramid.
+    Tiles are stored as floor_tiles/<floor>/<version>/<z>/<x>_<y>.<format>
+    next to an image.dzi descriptor. Returns the number of tiles written.
+
+    The full resolution level is cut from the decoded plan, so a build holds one
+    full bitmap (up to 4 bytes per pixel) plus the next level, a quarter of it;
+    each level is then reduced from the previous one and replaces it.
+    FLOOR_PLAN_TILE_WORKERS bounds how many builds hold that memory at once.
+    """
+    version = get_tile_version(floor)
+    if version is None or (tiles_ready(floor) and not force):
+        return 0
+
+    tile_size = get_tile_size()
+    tile_format = get_tile_format()
+    save_format = 'JPEG' if tile_format in ('jpg', 'jpeg') else tile_format.upper()
+
+    written = 0
+    level_image = open_plan(floor, save_format)
+    width, height = level_image.size
+
+    # Walk from full resolution down, halving the previous level each time
+    for z in range(get_max_level(width, height), -1, -1):
+        level_width, level_height = level_image.size
+        for x in range(math.ceil(level_width / tile_size)):
+            for y in range(math.ceil(level_height / tile_size)):
+                box = (x * tile_size, y * tile_size,
+                       min((x + 1) * tile_size, level_width),
+                       min((y + 1) * tile_size, level_height))
+                buffer = io.BytesIO()
+                level_image.crop(box).save(buffer, format=save_format)
+                path = get_tile_path(floor, version, z, x, y)
+                if default_storage.exists(path):
+                    default_storage.delete(path)
+                default_storage.save(path, ContentFile(buffer.getvalue()))
+                written += 1
+
+        if z > 0:
+            # 2x2 box average, output size rounded up like the level sizes
+            level_image = level_image.reduce(2)
+
+    descriptor_path = get_descriptor_path(floor, version)
+    if default_storage.exists(descriptor_path):
+        default_storage.delete(descriptor_path)
+    default_storage.save(descriptor_path, ContentFile(build_descriptor(width, height).encode('utf-8')))
+    delete_old_versions(floor, version)
+    return written
+
+
+def delete_tree(path):
+    """Delete a storage directory and everything below it"""
+    directories, files = default_storage.listdir(path)
+    for name in files:
+        default_storage.delete(posixpath.join(path, name))
+    for name in directories:
+        delete_tree(posixpath.join(path, name))
+    default_storage.delete(path)
+
+
+def delete_old_versions(floor, version):
+    """
+    Remove the pyramids of plans the floor no longer has. The plan stored now is
+    re-read, a newer upload may be tiling concurrently and its pyramid is kept.
+    """
+    from .models import Floor
+
+    floor_dir = posixpath.join('floor_tiles', str(floor.pk))
+    current = Floor.objects.filter(pk=floor.pk).first()
+    keep = {version, current and get_tile_version(current)}
+    try:
+        directories, _ = default_storage.listdir(floor_dir)
+    except FileNotFoundError:
+        return
+    for name in directories:
+        if name not in keep:
+            delete_tree(posixpath.join(floor_dir, name))
+
+
+def _build_floor_tiles_task(floor_id, version):
+    from .models import Floor
+
+    close_old_connections()
+    state_key = get_build_state_key(floor_id, version)
+    try:
+        floor = Floor.objects.filter(pk=floor_id).first()
+        # A plan replaced while queued is tiled by the build scheduled for the new one
+        if floor and get_tile_version(floor) == version:
+            build_floor_tiles(floor)
+        cache.delete(state_key)
+    except Exception:
+        logger.exception("Failed to build tiles for floor %s", floor_id)
+        # Not retried on every poll, only once the failure expires
+        cache.set(state_key, TILES_FAILED, getattr(settings, 'FLOOR_PLAN_TILE_RETRY_AFTER', 3600))
+    finally:
+        close_old_connections()
+
+
+def schedule_floor_tiles(floor):
+    """
+    Build the tile pyramid in a background thread once the current transaction commits.
+    A plan version is queued once: nothing is queued while its build is pending or
+    after it failed. Returns whether a build was queued.
+    At most FLOOR_PLAN_TILE_WORKERS plans are decoded at a time, others wait in the queue.
+    """
+    global _executor
+    version = get_tile_version(floor)
+    # Pending until the build ends; expires in case the process dies with it queued
+    pending_timeout = getattr(settings, 'FLOOR_PLAN_TILE_PENDING_TIMEOUT', 3600)
+    if version is None or not cache.add(get_build_state_key(floor.pk, version), TILES_PENDING, pending_timeout):
+        return False
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'FLOOR_PLAN_TILE_WORKERS', 1),
+            thread_name_prefix='floor-tiles'
+        )
+
+    floor_id = floor.pk
+    transaction.on_commit(lambda: _executor.submit(_build_floor_tiles_task, floor_id, version))
+    return True
@@ -0,0 +1,116 @@
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, features
+
+# Modern formats in order of preference: (extension, mime type, Pillow format, Pillow feature)
+MODERN_FORMATS = [
+    ('avif', 'image/avif', 'AVIF', 'avif'),
+    ('webp', 'image/webp', 'WEBP', 'webp'),
+]
+
+# Only these originals are converted, anything else is always served as uploaded
+CONVERTIBLE_FORMATS = {'JPEG', 'MPO', 'PNG'}
+
+# Part of the variant names, bumped when conversion changes so old variants are not served
+VARIANT_VERSION = 2
+
+ORIGINAL_CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+}
+
+
+def _feature_available(feature):
+    try:
+        return features.check(feature)
+    except ValueError:
+        # Older Pillow releases do not know about the feature at all
+        return False
+
+
+def get_available_formats():
+    """
+    Modern formats enabled in settings that this Pillow build can encode
+    """
+    enabled = getattr(settings, 'IMAGE_NEGOTIATION_FORMATS', ['avif', 'webp'])
+    return [fmt for fmt in MODERN_FORMATS if fmt[0] in enabled and _feature_available(fmt[3])]
+
+
+def parse_accept(accept_header):
+    """
+    Return {mime type: q} for the explicitly listed types of an Accept header.
+    Wildcards are ignored, a client has to name a modern format to receive it.
+    """
+    accepted = {}
+    for part in (accept_header or '').split(','):
+        pieces = [piece.strip() for piece in part.split(';')]
+        mime_type = pieces[0].lower()
+        if not mime_type or '*' in mime_type:
+            continue
+        q = 1.0
+        for param in pieces[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[mime_type] = q
+    return accepted
+
+
+def choose_format(accept_header):
+    """
+    Pick the best modern format advertised by the client, or None for the original
+    """
+    accepted = parse_accept(accept_header)
+    for fmt in get_available_formats():
+        if accepted.get(fmt[1], 0) > 0:
+            return fmt
+    return None
+
+
+def get_variant_name(name, extension):
+    """
+    Converted files are cached next to the original, e.g. photo.jpg.v2.webp
+    """
+    return f'{name}.v{VARIANT_VERSION}.{extension}'
+
+
+def get_or_create_variant(name, fmt):
+    """
+    Return the storage name of the original converted to fmt, creating it on first use.
+    Returns None when the original cannot or should not be converted.
+    """
+    extension, mime_type, pillow_format, feature = fmt
+    variant_name = get_variant_name(name, extension)
+    if default_storage.exists(variant_name):
+        return variant_name
+
+    with default_storage.open(name, 'rb') as original, Image.open(original) as img:
+        if img.format not in CONVERTIBLE_FORMATS:
+            return None
+        # The modern formats carry no EXIF orientation, apply it to the pixels instead
+        img = ImageOps.exif_transpose(img)
+        # A CMYK profile does not describe the RGB pixels it is converted to
+        icc_profile = img.info.get('icc_profile') if img.mode != 'CMYK' else None
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        buffer = io.BytesIO()
+        img.save(buffer, format=pillow_format, icc_profile=icc_profile,
+                 quality=getattr(settings, 'IMAGE_NEGOTIATION_QUALITY', 80))
+
+    saved_name = default_storage.save(variant_name, ContentFile(buffer.getvalue()))
+    if saved_name != variant_name:
+        # Another request converted the same image concurrently, keep its copy
+        default_storage.delete(saved_name)
+    return variant_name
+
+
+def get_original_content_type(name):
+    return ORIGINAL_CONTENT_TYPES.get(name.rsplit('.', 1)[-1].lower(), 'application/octet-stream')
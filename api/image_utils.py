@@ -0,0 +1,201 @@
+import io
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.utils.deconstruct import deconstructible
+from PIL import Image, UnidentifiedImageError
+
+
+DEFAULT_IMAGE_LIMITS = {
+    'max_pixels': 40_000_000,
+    'downscale_megapixels': 16,
+    'formats': ['JPEG', 'MPO', 'PNG', 'GIF', 'WEBP'],
+}
+
+# Probe result for images Pillow refuses to open as decompression bombs
+OVERSIZED_IMAGE = ('', 0, 0)
+
+
+def get_upload_workers():
+    """
+    Number of threads used when probing or writing a batch of uploaded images
+    """
+    return getattr(settings, 'IMAGE_UPLOAD_MAX_WORKERS', 4)
+
+
+def get_image_limits(kind='default'):
+    """
+    Return the limits configured for an image kind in settings.IMAGE_LIMITS,
+    falling back to the 'default' entry and then to DEFAULT_IMAGE_LIMITS
+    """
+    configured = getattr(settings, 'IMAGE_LIMITS', {})
+    limits = dict(DEFAULT_IMAGE_LIMITS)
+    limits.update(configured.get('default', {}))
+    limits.update(configured.get(kind, {}))
+    return limits
+
+
+def probe_image(upload):
+    """
+    Read only the header of an uploaded image.
+    Returns a (format, width, height) tuple, OVERSIZED_IMAGE if Pillow flags it as a
+    decompression bomb (over twice Image.MAX_IMAGE_PIXELS, Pillow's default is kept),
+    or None if the file is not an image. Pixel data is never decoded here, the limits
+    of each image kind are applied to the size by check_image_limits.
+    """
+    upload.seek(0)
+    try:
+        with Image.open(upload) as img:
+            width, height = img.size
+            return img.format, width, height
+    except Image.DecompressionBombError:
+        return OVERSIZED_IMAGE
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+    finally:
+        upload.seek(0)
+
+
+def probe_images(uploads):
+    """
+    Probe a batch of uploads concurrently, preserving input order
+    """
+    if len(uploads) <= 1:
+        return [probe_image(upload) for upload in uploads]
+
+    with ThreadPoolExecutor(max_workers=get_upload_workers()) as executor:
+        return list(executor.map(probe_image, uploads))
+
+
+def save_uploads(storage, named_uploads):
+    """
+    Write (name, upload) pairs to storage using a bounded thread pool.
+    Returns the stored names in input order. If any write fails, the files
+    already written are removed before the error is re-raised.
+    """
+    def _save(item):
+        name, upload = item
+        upload.seek(0)
+        return storage.save(name, upload)
+
+    saved = []
+    with ThreadPoolExecutor(max_workers=get_upload_workers()) as executor:
+        futures = [executor.submit(_save, item) for item in named_uploads]
+        error = None
+        for future in futures:
+            try:
+                saved.append(future.result())
+            except Exception as e:
+                error = error or e
+
+    if error is not None:
+        delete_stored_files(storage, saved)
+        raise error
+
+    return saved
+
+
+def delete_stored_files(storage, names):
+    """
+    Best-effort removal of files written during a failed batch
+    """
+    for name in names:
+        try:
+            storage.delete(name)
+        except OSError:
+            continue
+
+
+def check_image_limits(probe, limits):
+    """
+    Check a probe result against a limits dict.
+    Returns a list of error messages, empty when the image is acceptable.
+    """
+    if probe is None:
+        return ["Upload a valid image. The file you uploaded was either not an image or a corrupted image."]
+    if probe is OVERSIZED_IMAGE:
+        return [f"Image is too large. It should not exceed {limits['max_pixels'] / 1_000_000:g} megapixels."]
+
+    image_format, width, height = probe
+    errors = []
+    if image_format not in limits['formats']:
+        errors.append(f"Unsupported image format {image_format}. "
+                      f"Allowed formats: {', '.join(limits['formats'])}.")
+    if width * height > limits['max_pixels']:
+        errors.append(f"Image is too large ({width}x{height}). "
+                      f"It should not exceed {limits['max_pixels'] / 1_000_000:g} megapixels.")
+    return errors
+
+
+@deconstructible
+class ImageLimitsValidator:
+    """
+    Model field validator that enforces settings.IMAGE_LIMITS for an image kind.
+    Only the image header is read, so oversized images are rejected before decoding.
+    """
+    def __init__(self, kind='default'):
+        self.kind = kind
+
+    def __call__(self, value):
+        # Files already in storage were validated when they were uploaded
+        if not value or getattr(value, '_committed', False):
+            return
+        errors = check_image_limits(probe_image(value), get_image_limits(self.kind))
+        if errors:
+            raise ValidationError(errors)
+
+    def __eq__(self, other):
+        return isinstance(other, ImageLimitsValidator) and self.kind == other.kind
+
+
+def downscale_image(upload, limits, probe=None):
+    """
+    Downscale an image larger than limits['downscale_megapixels'].
+    JPEG images use Pillow's draft mode so the decoder itself scales down by up to
+    8x and the full-size bitmap is never held in memory. Other formats cannot be
+    decoded at a lower resolution: they are decoded at full size, which
+    limits['max_pixels'] bounds (up to 4 bytes per pixel), and then reduced.
+    Returns the original upload when no downscaling is needed, otherwise a new
+    ContentFile with the same name.
+    """
+    probe = probe or probe_image(upload)
+    if probe is None or probe is OVERSIZED_IMAGE:
+        return upload
+
+    image_format, width, height = probe
+    max_pixels = limits['downscale_megapixels'] * 1_000_000
+    if width * height <= max_pixels:
+        return upload
+
+    scale = math.sqrt(max_pixels / (width * height))
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+    upload.seek(0)
+    with Image.open(upload) as img:
+        # Animated images would lose their frames, keep them as uploaded
+        if getattr(img, 'is_animated', False):
+            upload.seek(0)
+            return upload
+
+        exif = img.info.get('exif')
+        if image_format in ('JPEG', 'MPO'):
+            img.draft('RGB', target)
+        img.thumbnail(target, Image.LANCZOS)
+
+        save_format = 'JPEG' if image_format == 'MPO' else image_format
+        save_kwargs = {}
+        if save_format == 'JPEG':
+            save_kwargs['quality'] = 90
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+        if exif:
+            save_kwargs['exif'] = exif
+
+        buffer = io.BytesIO()
+        img.save(buffer, format=save_format, **save_kwargs)
+
+    upload.seek(0)
+    return ContentFile(buffer.getvalue(), name=upload.name)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from api.chat_archive import archivable_messages, archive_messages, get_archive_cutoff
+
+
+class Command(BaseCommand):
+    help = "Move old messages of inactive chats from the live Message table to the archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            help="Archive messages older than this many days (default: CHAT_ARCHIVE_AFTER_DAYS)")
+        parser.add_argument('--batch-size', type=int,
+                            help="Messages moved per transaction (default: CHAT_ARCHIVE_BATCH_SIZE)")
+        parser.add_argument('--max-batches', type=int,
+                            help="Stop after this many batches, for runs with a time budget")
+        parser.add_argument('--sleep', type=float, default=0,
+                            help="Seconds to pause between batches")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many messages would be archived")
+
+    def handle(self, *args, **options):
+        cutoff = get_archive_cutoff(options['days'])
+
+        if options['dry_run']:
+            count = archivable_messages(cutoff).count()
+            self.stdout.write(f"{count} messages sent before {cutoff:%Y-%m-%d} would be archived")
+            return
+
+        moved = archive_messages(cutoff, batch_size=options['batch_size'],
+                                 max_batches=options['max_batches'], pause=options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f"{moved} messages archived"))
@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+import time
+import uuid
+
+from channels.db import aclose_old_connections, database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import re_path
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.channels_auth import JWTAuthMiddleware
+from api.chat_data import ChatData
+from api.chat_events import get_group_company_ids
+from api.chat_service import mark_read, send_message
+from api.consumers import ChatConsumer
+from api.models import AppUser, Chat, Company
+
+
+class ThreadPoolChatData(ChatData):
+    """
+    The consumer's data access before api.chat_data: every call is a
+    database_sync_to_async hop and broadcasts are sent from the sync thread
+    """
+
+    @database_sync_to_async
+    def get_user(self, user_id):
+        return AppUser.objects.select_related('company').filter(id=user_id, is_active=True).first()
+
+    @database_sync_to_async
+    def get_group_company_ids(self, user):
+        return get_group_company_ids(user)
+
+    @database_sync_to_async
+    def get_chat_access_map(self, user, company_ids):
+        chats = Chat.objects.filter(Q(user_id=user.id) | Q(company_id__in=company_ids))
+        return {
+            chat_id: {'user_id': user_id, 'company_id': company_id, 'is_active': is_active}
+            for chat_id, user_id, company_id, is_active
+            in chats.values_list('id', 'user_id', 'company_id', 'is_active')
+        }
+
+    @database_sync_to_async
+    def get_chat_access(self, chat_id):
+        return Chat.objects.filter(id=chat_id).values('user_id', 'company_id', 'is_active').first()
+
+    @database_sync_to_async
+    def send_message(self, chat, sender_type, content):
+        return send_message(chat, sender_type, content)
+
+    @database_sync_to_async
+    def mark_read(self, chat_id, reader_type):
+        return mark_read(Chat(id=chat_id), reader_type)
+
+
+class ThreadPoolChatConsumer(ChatConsumer):
+    """ChatConsumer with the thread pool data access and Channels' per-event connection cleanup"""
+    data = ThreadPoolChatData()
+
+    async def dispatch(self, message):
+        await aclose_old_connections()
+        await super().dispatch(message)
+
+
+CONSUMERS = {
+    'async': ChatConsumer,
+    'thread': ThreadPoolChatConsumer,
+}
+
+
+def unpack(frame):
+    return frame['events'] if frame.get('type') == 'batch' else [frame]
+
+
+@contextlib.contextmanager
+def test_database(use_configured_db=False):
+    """
+    Run the block on a throwaway database created like the test runner's, so
+    benchmark fixtures never reach the configured one unless use_configured_db is set
+    """
+    if use_configured_db:
+        yield
+        return
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+class Command(BaseCommand):
+    help = ("Measure chat messages per second through ChatConsumer in this process (one worker), "
+            "with the async data access and with the thread pool one it replaced. "
+            "Runs on a throwaway test database and the configured channel layer; with "
+            "--use-configured-db the users, company and chats it creates there are deleted afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=20,
+                            help="Users sending concurrently, each over its own WebSocket")
+        parser.add_argument('--messages', type=int, default=50,
+                            help="Messages sent by each user")
+        parser.add_argument('--mode', choices=['both', *CONSUMERS], default='both',
+                            help="Consumer data access to benchmark")
+        parser.add_argument('--use-configured-db', action='store_true',
+                            help="Benchmark against the configured database instead of a test database")
+
+    def handle(self, *args, **options):
+        with test_database(options['use_configured_db']):
+            self.benchmark(options)
+
+    def benchmark(self, options):
+        modes = list(CONSUMERS) if options['mode'] == 'both' else [options['mode']]
+        company, representative, senders = self.create_fixtures(options['connections'])
+        try:
+            results = {}
+            for mode in modes:
+                # Without rate limits, the senders would be throttled long before the consumer
+                with override_settings(RATE_LIMITS={}):
+                    seconds, lost = asyncio.run(self.run(CONSUMERS[mode], company, representative, senders,
+                                                         options['messages']))
+                total = len(senders) * options['messages']
+                results[mode] = total / seconds
+                self.stdout.write(f"{mode:>6}: {total} messages in {seconds:.2f}s, "
+                                  f"{results[mode]:.0f} messages/s per worker")
+                if lost:
+                    self.stdout.write(self.style.WARNING(
+                        f"        {lost} messages never reached the representative (channel layer full)"
+                    ))
+            if len(results) == 2:
+                self.stdout.write(self.style.SUCCESS(
+                    f"async data access: {results['async'] / results['thread']:.2f}x the thread pool throughput"
+                ))
+        finally:
+            AppUser.objects.filter(pk__in=[user.pk for user in [representative, *senders]]).delete()
+            company.delete()
+
+    def create_fixtures(self, count):
+        """A company with a representative and count users, each with a chat with it"""
+        tag = uuid.uuid4().hex[:8]
+        company = Company.objects.create(name=f"bench-{tag}")
+        representative = AppUser.objects.create(username=f"bench-{tag}-rep", email=f"rep@bench-{tag}.invalid",
+                                                company=company)
+        senders = []
+        for i in range(count):
+            user = AppUser.objects.create(username=f"bench-{tag}-{i}", email=f"{i}@bench-{tag}.invalid")
+            Chat.objects.create(user=user, company=company)
+            senders.append(user)
+        return company, representative, senders
+
+    async def run(self, consumer_class, company, representative, senders, messages):
+        """
+        Seconds until every user has sent its messages and seen each of them delivered,
+        and the number of messages the representative never received
+        """
+        application = JWTAuthMiddleware(URLRouter([re_path(r'^ws/chat/$', consumer_class.as_asgi())]))
+        chat_ids = {user_id: chat_id async for user_id, chat_id
+                    in Chat.objects.filter(company=company).values_list('user_id', 'id')}
+
+        async def connect(user):
+            # Opted into batch frames like production clients
+            token = AccessToken.for_user(user)
+            communicator = WebsocketCommunicator(application, f'/ws/chat/?token={token}&batch=1')
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f"Connection of {user.username} was refused")
+            return communicator
+
+        async def send_all(user, communicator):
+            for i in range(messages):
+                await communicator.send_json_to({'type': 'chat.message', 'chat_id': chat_ids[user.id],
+                                                 'content': f"message {i}"})
+                # Wait for the broadcast of this message before sending the next one
+                delivered = False
+                while not delivered:
+                    frame = await communicator.receive_json_from(timeout=10)
+                    delivered = any(event['type'] == 'chat.message' for event in unpack(frame))
+
+        async def drain(communicator, expected, sent):
+            # The representative receives every message, as the company side of each chat.
+            # A channel layer at capacity drops group messages, so stop once sending is
+            # over and nothing arrives for a second.
+            received = 0
+            while received < expected:
+                try:
+                    frame = await communicator.receive_json_from(timeout=1)
+                except asyncio.TimeoutError:
+                    if sent.is_set():
+                        break
+                    continue
+                received += sum(event['type'] == 'chat.message' for event in unpack(frame))
+            return received
+
+        async def send(sent):
+            await asyncio.gather(*(send_all(user, communicator)
+                                   for user, communicator in zip(senders, communicators)))
+            sent.set()
+            return time.perf_counter() - started
+
+        inbox = await connect(representative)
+        communicators = [await connect(user) for user in senders]
+        sent = asyncio.Event()
+        started = time.perf_counter()
+        seconds, received = await asyncio.gather(send(sent), drain(inbox, len(senders) * messages, sent))
+
+        for communicator in [inbox, *communicators]:
+            # Connections that fell behind were already closed by the server (4008)
+            if not communicator.future.done():
+                await communicator.disconnect()
+        return seconds, len(senders) * messages - received
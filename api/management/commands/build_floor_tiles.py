@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Floor
+from api.floor_tiles import build_floor_tiles
+
+
+class Command(BaseCommand):
+    help = "Build deep-zoom tile pyramids for floor plan images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--floor', type=int, action='append', dest='floors',
+                            help="Only tile the given floor id (can be repeated)")
+        parser.add_argument('--force', action='store_true',
+                            help="Rebuild pyramids that already exist")
+
+    def handle(self, *args, **options):
+        floors = Floor.objects.exclude(plan_image='').exclude(plan_image__isnull=True)
+        if options['floors']:
+            floors = floors.filter(pk__in=options['floors'])
+
+        for floor in floors.iterator():
+            try:
+                written = build_floor_tiles(floor, force=options['force'])
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f"Floor {floor.pk}: {str(e)}"))
+                continue
+            if written:
+                self.stdout.write(self.style.SUCCESS(f"Floor {floor.pk}: {written} tiles written"))
+            else:
+                self.stdout.write(f"Floor {floor.pk}: tiles already up to date")
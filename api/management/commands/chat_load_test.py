@@ -0,0 +1,259 @@
+import asyncio
+import json
+import random
+import time
+import tracemalloc
+import uuid
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+from api.auth import EmailTokenObtainPairSerializer
+from api.channels_auth import JWTAuthMiddleware
+from api.models import AppUser, Chat, Company
+from api.routing import websocket_urlpatterns
+from .bench_chat_consumer import test_database, unpack
+
+
+def percentile(values, p):
+    """p-th percentile of values, nearest rank"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(seconds):
+    """p50 / p95 / p99 / max of a list of seconds, in milliseconds"""
+    return ' / '.join(f"{percentile(seconds, p) * 1000:.1f}" for p in (50, 95, 99, 100)) + ' ms'
+
+
+class QueryCounter:
+    """
+    Counts the queries of every database connection opened while it is installed,
+    whichever thread runs them (the consumer's queries run on the sync thread)
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class LoadClient:
+    """One simulated WebSocket client, a user or a company representative"""
+
+    def __init__(self, application, token, sender_type, chat_ids):
+        self.communicator = WebsocketCommunicator(application, f'/ws/chat/?token={token}&batch=1')
+        self.sender_type = sender_type
+        self.chat_ids = chat_ids
+        self.latencies = []
+        self.sent = {'send': 0, 'read': 0, 'typing': 0}
+        self.errors = 0
+        self.close_code = None
+
+    async def connect(self):
+        """Seconds until the connection is accepted and its presence state received"""
+        started = time.perf_counter()
+        connected, code = await self.communicator.connect(timeout=30)
+        if not connected:
+            self.close_code = code
+            return None
+        await self.communicator.receive_output(timeout=30)
+        return time.perf_counter() - started
+
+    async def receive(self):
+        """Record the delivery latency of every load test message this client receives"""
+        while True:
+            output = await self.communicator.receive_output(timeout=3600)
+            if output['type'] == 'websocket.close':
+                self.close_code = output.get('code')
+                return
+            received = time.perf_counter()
+            for event in unpack(json.loads(output['text'])):
+                if event['type'] == 'chat.message':
+                    _, sent = event['message']['content'].split(' ', 1)
+                    self.latencies.append(received - float(sent))
+                elif event['type'] == 'error':
+                    self.errors += 1
+
+    async def act(self, duration, rate, weights):
+        """Send, read and typing frames at rate per second (Poisson arrivals) for duration seconds"""
+        deadline = time.perf_counter() + duration
+        actions = list(weights)
+        while True:
+            # An arrival past the deadline ends the workload at the deadline, not at the arrival
+            delay = random.expovariate(rate)
+            remaining = deadline - time.perf_counter()
+            await asyncio.sleep(max(min(delay, remaining), 0))
+            if delay >= remaining or self.close_code is not None:
+                return
+            action = random.choices(actions, weights=[weights[a] for a in actions])[0]
+            chat_id = random.choice(self.chat_ids)
+            if action == 'send':
+                frame = {'type': 'chat.message', 'chat_id': chat_id, 'content': f"load {time.perf_counter()}"}
+            elif action == 'read':
+                other = 'company' if self.sender_type == 'user' else 'user'
+                frame = {'type': 'chat.read', 'chat_id': chat_id, 'sender_type': other}
+            else:
+                frame = {'type': 'chat.typing', 'chat_id': chat_id}
+            await self.communicator.send_json_to(frame)
+            self.sent[action] += 1
+
+    async def disconnect(self):
+        if not self.communicator.future.done():
+            await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = ("Load test ChatConsumer: open many concurrent WebSocket connections in this process "
+            "over an in-memory channel layer, drive a send / read / typing workload and report "
+            "connect latency, message fan-out latency, memory per connection and DB queries per "
+            "message. Runs on a throwaway test database; with --use-configured-db the users, "
+            "companies and chats it creates there are deleted afterwards. The in-memory layer scans every channel on each receive and "
+            "group_send, so runs with thousands of connections also measure that scan.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000,
+                            help="User connections, each with one chat")
+        parser.add_argument('--companies', type=int, default=50,
+                            help="Companies, each with one representative connected, chats are spread over them")
+        parser.add_argument('--duration', type=float, default=30,
+                            help="Seconds the workload runs after all connections are open")
+        parser.add_argument('--rate', type=float, default=0.5,
+                            help="Frames per second sent by each connection")
+        parser.add_argument('--send', type=float, default=1, help="Relative weight of chat.message frames")
+        parser.add_argument('--read', type=float, default=0.5, help="Relative weight of chat.read frames")
+        parser.add_argument('--typing', type=float, default=2, help="Relative weight of chat.typing frames")
+        parser.add_argument('--connect-concurrency', type=int, default=100,
+                            help="Connections opened at the same time")
+        parser.add_argument('--capacity', type=int, default=1000,
+                            help="In-memory channel layer capacity per channel")
+        parser.add_argument('--use-configured-db', action='store_true',
+                            help="Load the configured database instead of a test database")
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['companies'] < 1:
+            raise CommandError("--users and --companies must be at least 1")
+        weights = {action: options[action] for action in ('send', 'read', 'typing') if options[action] > 0}
+        if not weights:
+            raise CommandError("At least one of --send, --read and --typing must be positive")
+        with test_database(options['use_configured_db']):
+            self.load_test(weights, options)
+
+    def load_test(self, weights, options):
+        self.stdout.write(f"Creating {options['users']} users and {options['companies']} companies...")
+        companies, users, clients = self.create_fixtures(options['users'], options['companies'])
+        channel_layers = {'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': options['capacity']},
+        }}
+        try:
+            # Every simulated client shares one address, rate limits would throttle the run
+            with override_settings(CHANNEL_LAYERS=channel_layers, RATE_LIMITS={}):
+                asyncio.run(self.run(clients, weights, options))
+        finally:
+            AppUser.objects.filter(pk__in=[user.pk for user in users]).delete()
+            Company.objects.filter(pk__in=[company.pk for company in companies]).delete()
+
+    def create_fixtures(self, user_count, company_count):
+        """
+        Users, companies with one representative each and one chat per user, inserted in bulk.
+        Returns them with the (token, sender_type, chat_ids) of every client.
+        """
+        tag = uuid.uuid4().hex[:8]
+        password = make_password(None)
+        companies = Company.objects.bulk_create(
+            [Company(name=f"load-{tag}-{i}") for i in range(company_count)]
+        )
+        representatives = AppUser.objects.bulk_create([
+            AppUser(username=f"load-{tag}-rep-{i}", email=f"rep-{i}@load-{tag}.invalid",
+                    password=password, company=company)
+            for i, company in enumerate(companies)
+        ])
+        users = AppUser.objects.bulk_create([
+            AppUser(username=f"load-{tag}-{i}", email=f"{i}@load-{tag}.invalid", password=password)
+            for i in range(user_count)
+        ])
+        chats = Chat.objects.bulk_create([
+            Chat(user=user, company=companies[i % company_count]) for i, user in enumerate(users)
+        ])
+
+        def token(user):
+            return str(EmailTokenObtainPairSerializer.get_token(user).access_token)
+
+        company_chats = {company.id: [] for company in companies}
+        for chat in chats:
+            company_chats[chat.company_id].append(chat.id)
+        clients = [(token(user), 'user', [chat.id]) for user, chat in zip(users, chats)]
+        clients += [(token(rep), 'company', company_chats[rep.company_id])
+                    for rep in representatives if company_chats[rep.company_id]]
+        return companies, representatives + users, clients
+
+    async def run(self, fixtures, weights, options):
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        clients = [LoadClient(application, *fixture) for fixture in fixtures]
+
+        # Connect phase, with Python allocations traced for the memory estimate
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        connect_latencies = []
+        batch_size = options['connect_concurrency']
+        for i in range(0, len(clients), batch_size):
+            results = await asyncio.gather(*(client.connect() for client in clients[i:i + batch_size]))
+            connect_latencies.extend(seconds for seconds in results if seconds is not None)
+        connect_seconds = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        connected = [client for client in clients if client.close_code is None]
+        self.stdout.write(f"Connected {len(connected)}/{len(clients)} in {connect_seconds:.1f}s, "
+                          f"connect latency p50/p95/p99/max {latency_summary(connect_latencies)}")
+        self.stdout.write(f"Python memory per connection (server and in-process client): "
+                          f"{memory / max(len(connected), 1) / 1024:.1f} KiB")
+
+        # Workload phase
+        readers = [asyncio.ensure_future(client.receive()) for client in connected]
+        queries_before = counter.count
+        started = time.perf_counter()
+        await asyncio.gather(*(client.act(options['duration'], options['rate'], weights) for client in connected))
+        workload_seconds = time.perf_counter() - started
+        # Let in-flight deliveries arrive
+        await asyncio.sleep(2)
+        queries = counter.count - queries_before
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        for client in connected:
+            await client.disconnect()
+        connection_created.disconnect(counter.install)
+
+        sent = {action: sum(client.sent[action] for client in connected) for action in ('send', 'read', 'typing')}
+        latencies = [seconds for client in connected for seconds in client.latencies]
+        closed = sum(client.close_code is not None for client in connected)
+        self.stdout.write(f"Workload {workload_seconds:.1f}s: {sent['send']} messages "
+                          f"({sent['send'] / workload_seconds:.0f}/s), {sent['read']} reads, "
+                          f"{sent['typing']} typing frames")
+        self.stdout.write(f"Fan-out: {len(latencies)} deliveries, latency p50/p95/p99/max "
+                          f"{latency_summary(latencies)}")
+        self.stdout.write(f"Database: {queries} queries, "
+                          f"{queries / max(sent['send'], 1):.1f} per message (reads included)")
+        errors = sum(client.errors for client in connected)
+        if closed or errors:
+            self.stdout.write(self.style.WARNING(
+                f"{closed} connections closed by the server during the workload, {errors} error frames"
+            ))
@@ -0,0 +1,89 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.models import Chat, Message
+
+
+def chat_queries(chat_id, user_id, company_id):
+    """
+    The hot chat queries in the shape the views and chat service issue them,
+    each with the indexes its plan is expected to use
+    """
+    since = timezone.now() - timedelta(hours=1)
+    return [
+        ("company inbox",
+         Chat.objects.filter(company_id=company_id).order_by('-updated_at')[:10],
+         {'chat_company_updated_idx'}),
+        ("user inbox",
+         Chat.objects.filter(user_id=user_id).order_by('-updated_at')[:10],
+         {'chat_user_updated_idx'}),
+        # SQLite cannot match a partial index against a bound parameter and falls back to the inbox index
+        ("company unread total",
+         Chat.objects.filter(company_id=company_id, unread_for_company__gt=0).values('unread_for_company'),
+         {'chat_company_unread_idx'} if connection.vendor == 'postgresql' else {'chat_company_updated_idx'}),
+        ("history, newest page",
+         Message.objects.filter(chat_id=chat_id).order_by('-id')[:31],
+         {'message_chat_id_idx'}),
+        ("history, before cursor",
+         Message.objects.filter(chat_id=chat_id, id__lt=1000).order_by('-id')[:31],
+         {'message_chat_id_idx'}),
+        ("newest message from a side",
+         Message.objects.filter(chat_id=chat_id, sender_type='user').order_by('-id').values('id')[:1],
+         {'message_chat_sender_idx'}),
+        ("unread past watermark",
+         Message.objects.filter(chat_id=chat_id, sender_type='user', id__gt=0).order_by().values('id'),
+         {'message_chat_sender_idx'}),
+        ("sync, changed chats",
+         Chat.objects.filter(user_id=user_id, changed_at__gt=since),
+         {'chat_user_changed_idx'}),
+        ("company sync, changed chats",
+         Chat.objects.filter(company_id=company_id, changed_at__gt=since),
+         {'chat_company_changed_idx'}),
+        ("sync, new messages",
+         Message.objects.filter(chat_id=chat_id, timestamp__gt=since).order_by('timestamp', 'id'),
+         {'message_chat_timestamp_idx'}),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Print EXPLAIN plans of the chat inbox, history and unread queries and check their indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int,
+                            help="Chat id to plan the queries for (default: the most recent chat)")
+        parser.add_argument('--check', action='store_true',
+                            help="Fail if a query does not use its expected index")
+        parser.add_argument('--no-seqscan', action='store_true',
+                            help="PostgreSQL only: disable sequential scans, so small tables "
+                                 "still show whether an index is usable")
+
+    def handle(self, *args, **options):
+        chat = Chat.objects.filter(pk=options['chat']) if options['chat'] else Chat.objects.all()
+        chat = chat.values('id', 'user_id', 'company_id').first()
+        if chat is None:
+            # The planner does not need rows, any ids will do
+            chat = {'id': 1, 'user_id': 1, 'company_id': 1}
+
+        missing = []
+        with transaction.atomic():
+            if options['no_seqscan'] and connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            for name, queryset, expected in chat_queries(chat['id'], chat['user_id'], chat['company_id']):
+                plan = queryset.explain()
+                used = {index for index in expected if index in plan}
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                self.stdout.write(plan)
+                if used:
+                    self.stdout.write(self.style.SUCCESS(f"uses {', '.join(sorted(used))}"))
+                else:
+                    missing.append(name)
+                    self.stdout.write(self.style.WARNING(f"expected {', '.join(sorted(expected))}"))
+                self.stdout.write('')
+
+        if missing and options['check']:
+            raise CommandError(f"Queries not using their index: {', '.join(missing)}")
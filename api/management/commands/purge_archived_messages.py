@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import ArchivedMessage
+from api.chat_archive import get_retention_cutoff, purge_archived_messages
+
+
+class Command(BaseCommand):
+    help = "Delete archived chat messages older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            help="Delete archived messages older than this many days (default: CHAT_RETENTION_DAYS)")
+        parser.add_argument('--batch-size', type=int,
+                            help="Messages deleted per statement (default: CHAT_ARCHIVE_BATCH_SIZE)")
+        parser.add_argument('--max-batches', type=int,
+                            help="Stop after this many batches, for runs with a time budget")
+        parser.add_argument('--sleep', type=float, default=0,
+                            help="Seconds to pause between batches")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many messages would be deleted")
+
+    def handle(self, *args, **options):
+        cutoff = get_retention_cutoff(options['days'])
+        if cutoff is None:
+            raise CommandError("No retention period: pass --days or set CHAT_RETENTION_DAYS")
+
+        if options['dry_run']:
+            count = ArchivedMessage.objects.filter(timestamp__lt=cutoff).count()
+            self.stdout.write(f"{count} archived messages sent before {cutoff:%Y-%m-%d} would be deleted")
+            return
+
+        deleted = purge_archived_messages(cutoff, batch_size=options['batch_size'],
+                                          max_batches=options['max_batches'], pause=options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f"{deleted} archived messages deleted"))
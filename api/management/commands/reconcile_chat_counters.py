@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Chat
+from api.chat_service import reconcile_unread_counters
+
+
+class Command(BaseCommand):
+    help = "Recount the denormalized unread counters on Chat from the Message table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, action='append', dest='chats',
+                            help="Only reconcile the given chat id (can be repeated)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report drifted counters without fixing them")
+
+    def handle(self, *args, **options):
+        chats = Chat.objects.all()
+        if options['chats']:
+            chats = chats.filter(pk__in=options['chats'])
+
+        drifted = reconcile_unread_counters(chats, dry_run=options['dry_run'])
+        for chat_id, field, stored, actual in drifted:
+            self.stdout.write(f"Chat {chat_id}: {field} was {stored}, actual {actual}")
+
+        action = "found" if options['dry_run'] else "fixed"
+        self.stdout.write(self.style.SUCCESS(f"{len(drifted)} drifted counters {action}"))
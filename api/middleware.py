@@ -1,20 +1,42 @@
 import json
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
 
 class JWTDebugMiddleware:
     """
-    Middleware to help with debugging JWT tokens in development
+    Middleware to help with debugging JWT tokens in development.
+    Supports both sync and async requests so async views (the chat event
+    stream and long-poll) are not pushed onto a thread for their whole duration.
     """
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        self.log_request(request)
+        response = self.get_response(request)
+        self.log_response(response)
+        return response
+
+    async def __acall__(self, request):
+        self.log_request(request)
+        response = await self.get_response(request)
+        self.log_response(response)
+        return response
+
+    def log_request(self, request):
         if settings.DEBUG and 'Authorization' in request.headers:
             # Just log that we found an Authorization header
             print(f"[JWT Debug] Authorization header found: {request.headers.get('Authorization')[:15]}...")
-        
-        response = self.get_response(request)
-        
+
+    def log_response(self, response):
         # Debug JWT tokens in responses during development
         if settings.DEBUG and hasattr(response, 'data') and ('access' in response.data or 'refresh' in response.data):
             print("[JWT Debug] JWT token generated")
@@ -22,5 +44,3 @@ class JWTDebugMiddleware:
                 print(f"[JWT Debug] Access token: {response.data['access'][:15]}...")
             if 'refresh' in response.data:
                 print(f"[JWT Debug] Refresh token: {response.data['refresh'][:15]}...")
-        
-        return response
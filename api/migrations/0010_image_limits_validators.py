@@ -0,0 +1,35 @@
+# Generated by Django 5.2.3 on 2026-10-19 08:09
+
+import api.image_utils
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_remove_building_building_name_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='appuser',
+            name='profile_picture',
+            field=models.ImageField(blank=True, null=True, upload_to='profile_pictures/', validators=[api.image_utils.ImageLimitsValidator('profile_picture')]),
+        ),
+        migrations.AlterField(
+            model_name='building',
+            name='image',
+            field=models.ImageField(blank=True, null=True, upload_to='building_images/', validators=[api.image_utils.ImageLimitsValidator()]),
+        ),
+        migrations.AlterField(
+            model_name='buildingimage',
+            name='image',
+            field=models.ImageField(blank=True, help_text='Optional. Upload an image for the building (JPEG, PNG, GIF, WEBP)', null=True, upload_to='building_images/', validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png', 'gif', 'webp']), api.image_utils.ImageLimitsValidator()]),
+        ),
+        migrations.AlterField(
+            model_name='floor',
+            name='plan_image',
+            field=models.ImageField(upload_to='floor_plans/', validators=[api.image_utils.ImageLimitsValidator('floor_plan')]),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.3 on 2026-10-19 08:17
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def unread_subquery(Message, sender_type):
+    return Coalesce(Subquery(
+        Message.objects.filter(chat=OuterRef('pk'), sender_type=sender_type, is_read=False)
+        .order_by().values('chat').annotate(total=Count('id')).values('total'),
+        output_field=IntegerField()
+    ), 0)
+
+
+def backfill_unread_counters(apps, schema_editor):
+    Chat = apps.get_model('api', 'Chat')
+    Message = apps.get_model('api', 'Message')
+    Chat.objects.update(
+        unread_for_user=unread_subquery(Message, 'company'),
+        unread_for_company=unread_subquery(Message, 'user'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_image_limits_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='unread_for_company',
+            field=models.PositiveIntegerField(default=0, help_text='User messages the company has not read'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='unread_for_user',
+            field=models.PositiveIntegerField(default=0, help_text='Company messages the user has not read'),
+        ),
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.3 on 2026-10-19 08:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_last_message(apps, schema_editor):
+    Chat = apps.get_model('api', 'Chat')
+    Message = apps.get_model('api', 'Message')
+    latest = Message.objects.filter(chat=OuterRef('pk')).order_by('-timestamp', '-id').values('id')[:1]
+    chats = Chat.objects.annotate(latest_id=Subquery(latest)).filter(latest_id__isnull=False)
+
+    for chat_id, message_id in chats.values_list('id', 'latest_id').iterator():
+        message = Message.objects.get(id=message_id)
+        content = message.content
+        Chat.objects.filter(id=chat_id).update(
+            last_message_id=message.id,
+            last_message_preview=content[:50] + '...' if len(content) > 50 else content,
+            last_message_at=message.timestamp,
+            last_message_sender_type=message.sender_type,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_chat_unread_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=53),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_sender_type',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.3 on 2026-10-19 08:21
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def read_watermark(Message, sender_type):
+    return Coalesce(Subquery(
+        Message.objects.filter(chat=OuterRef('pk'), sender_type=sender_type, is_read=True)
+        .order_by().values('chat').annotate(last=Max('id')).values('last')
+    ), 0)
+
+
+def unread_subquery(Message, sender_type, watermark_field):
+    return Coalesce(Subquery(
+        Message.objects.filter(chat=OuterRef('pk'), sender_type=sender_type, id__gt=OuterRef(watermark_field))
+        .order_by().values('chat').annotate(total=Count('id')).values('total'),
+        output_field=IntegerField()
+    ), 0)
+
+
+def backfill_read_watermarks(apps, schema_editor):
+    """
+    Each side's watermark becomes its newest read message. Older messages that
+    were still flagged unread count as read from now on, so recount the counters.
+    """
+    Chat = apps.get_model('api', 'Chat')
+    Message = apps.get_model('api', 'Message')
+    Chat.objects.update(
+        user_last_read_message_id=read_watermark(Message, 'company'),
+        company_last_read_message_id=read_watermark(Message, 'user'),
+    )
+    Chat.objects.update(
+        unread_for_user=unread_subquery(Message, 'company', 'user_last_read_message_id'),
+        unread_for_company=unread_subquery(Message, 'user', 'company_last_read_message_id'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_chat_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='company_last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='user_last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.3 on 2026-10-19 08:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_chat_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['company', '-updated_at'], name='chat_company_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user', '-updated_at'], name='chat_user_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(condition=models.Q(('unread_for_company__gt', 0)), fields=['company'], name='chat_company_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'id'], name='message_chat_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'sender_type', 'id'], name='message_chat_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'timestamp'], name='message_chat_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# Full-text index over Message.content, kept up to date on insert, update and delete.
+# SQLite: an external content FTS5 table maintained by triggers.
+# PostgreSQL: a GIN expression index, which the database maintains itself.
+# The expressions here have to match the queries in api/chat_search.py.
+
+SQLITE_CREATE = [
+    """
+    CREATE VIRTUAL TABLE api_message_fts USING fts5(
+        content, content='api_message', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER api_message_fts_insert AFTER INSERT ON api_message BEGIN
+        INSERT INTO api_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_delete AFTER DELETE ON api_message BEGIN
+        INSERT INTO api_message_fts(api_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_update AFTER UPDATE OF content ON api_message BEGIN
+        INSERT INTO api_message_fts(api_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO api_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # Index the messages that already exist
+    "INSERT INTO api_message_fts(api_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS api_message_fts_insert",
+    "DROP TRIGGER IF EXISTS api_message_fts_delete",
+    "DROP TRIGGER IF EXISTS api_message_fts_update",
+    "DROP TABLE IF EXISTS api_message_fts",
+]
+
+POSTGRESQL_CREATE = [
+    "CREATE INDEX message_content_search_idx ON api_message USING GIN (to_tsvector('english', content))",
+]
+
+POSTGRESQL_DROP = [
+    "DROP INDEX IF EXISTS message_content_search_idx",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_CREATE[0])
+        except OperationalError:
+            # SQLite built without FTS5, api.chat_search falls back to a LIKE scan
+            return
+        for statement in SQLITE_CREATE[1:]:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        for statement in POSTGRESQL_CREATE:
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {'sqlite': SQLITE_DROP, 'postgresql': POSTGRESQL_DROP}.get(vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_chat_message_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
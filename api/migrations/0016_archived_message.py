@@ -0,0 +1,29 @@
+# Generated by Django 5.2.3 on 2026-10-19 08:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('sender_type', models.CharField(choices=[('user', 'User'), ('company', 'Company')], max_length=10)),
+                ('content', models.TextField()),
+                ('timestamp', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='api.chat')),
+            ],
+            options={
+                'ordering': ['timestamp'],
+                'indexes': [models.Index(fields=['chat', 'id'], name='archived_message_chat_id_idx'), models.Index(fields=['timestamp'], name='archived_message_ts_idx')],
+            },
+        ),
+    ]
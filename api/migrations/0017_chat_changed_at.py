@@ -0,0 +1,27 @@
+# Generated by Django 5.2.3 on 2026-10-19 09:13
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_archived_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user', 'changed_at'], name='chat_user_changed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['company', 'changed_at'], name='chat_company_changed_idx'),
+        ),
+    ]
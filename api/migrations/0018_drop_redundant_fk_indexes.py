@@ -0,0 +1,35 @@
+# Generated by Django 5.2.3 on 2026-10-19 09:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_chat_changed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedmessage',
+            name='chat',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='api.chat'),
+        ),
+        migrations.AlterField(
+            model_name='chat',
+            name='company',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='chats', to='api.company'),
+        ),
+        migrations.AlterField(
+            model_name='chat',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='chats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='chat',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='api.chat'),
+        ),
+    ]
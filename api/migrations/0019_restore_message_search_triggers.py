@@ -0,0 +1,28 @@
+import importlib
+
+from django.db import migrations
+
+# On SQLite, 0018 rebuilds api_message to drop the chat_id index, and a table rebuild
+# drops the triggers that keep api_message_fts up to date. Any later migration that
+# rebuilds api_message has to be followed by the same step.
+message_search = importlib.import_module('api.migrations.0015_message_search')
+
+
+def restore_search_triggers(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or 'api_message_fts' not in connection.introspection.table_names():
+        return
+    # The triggers, then a rebuild for the messages written while they were missing
+    for statement in message_search.SQLITE_DROP[:-1] + message_search.SQLITE_CREATE[1:]:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_drop_redundant_fk_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
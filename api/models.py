@@ -1,12 +1,16 @@
 from django.db import models
 from django.core.validators import FileExtensionValidator
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+from .image_utils import ImageLimitsValidator
 
 
 class AppUser(AbstractUser):
     email = models.EmailField(unique=True)
     phone_number = models.CharField(max_length=20, blank=True, null=True)
-    profile_picture = models.ImageField(upload_to='profile_pictures/', blank=True, null=True)
+    profile_picture = models.ImageField(upload_to='profile_pictures/', blank=True, null=True,
+                                        validators=[ImageLimitsValidator('profile_picture')])
     is_verified = models.BooleanField(default=False)
     date_joined = models.DateTimeField(auto_now_add=True)
     company = models.ForeignKey('Company', on_delete=models.SET_NULL, blank=True, null=True, 
@@ -38,7 +42,8 @@ class Building(models.Model):
     name = models.CharField(max_length=255)
     address = models.CharField(max_length=255, blank=True)
     description = models.TextField(blank=True)
-    image = models.ImageField(upload_to='building_images/', blank=True, null=True)  # Main image
+    image = models.ImageField(upload_to='building_images/', blank=True, null=True,
+                              validators=[ImageLimitsValidator()])  # Main image
     latitude = models.FloatField(help_text="Latitude coordinate")
     longitude = models.FloatField(help_text="Longitude coordinate")
     company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='buildings')
@@ -63,7 +68,10 @@ class BuildingImage(models.Model):
         upload_to='building_images/',
         blank=True, 
         null=True,
-        validators=[FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png', 'gif', 'webp'])],
+        validators=[
+            FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png', 'gif', 'webp']),
+            ImageLimitsValidator(),
+        ],
         help_text="Optional. Upload an image for the building (JPEG, PNG, GIF, WEBP)"
     )
     caption = models.CharField(max_length=255, blank=True)
@@ -79,7 +87,7 @@ class BuildingImage(models.Model):
 class Floor(models.Model):
     building = models.ForeignKey(Building, on_delete=models.CASCADE, related_name='floors')
     floor_number = models.PositiveIntegerField(help_text="0 = Ground floor, 1 = First floor, etc.")
-    plan_image = models.ImageField(upload_to='floor_plans/')
+    plan_image = models.ImageField(upload_to='floor_plans/', validators=[ImageLimitsValidator('floor_plan')])
 
     class Meta:
         unique_together = ('building', 'floor_number')
@@ -102,37 +110,117 @@ class Flat(models.Model):
 
 
 class Chat(models.Model):
-    user = models.ForeignKey(AppUser, on_delete=models.CASCADE, related_name='chats')
-    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='chats')
+    # No single-column indexes: the composite ones below start with these columns
+    user = models.ForeignKey(AppUser, on_delete=models.CASCADE, related_name='chats', db_index=False)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='chats', db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
+    # Denormalized unread counters, maintained by api.chat_service
+    unread_for_user = models.PositiveIntegerField(default=0, help_text="Company messages the user has not read")
+    unread_for_company = models.PositiveIntegerField(default=0, help_text="User messages the company has not read")
+    # Last message preview for inbox listings, maintained by api.chat_service
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, blank=True, null=True,
+                                     related_name='+')
+    last_message_preview = models.CharField(max_length=53, blank=True)
+    last_message_at = models.DateTimeField(blank=True, null=True)
+    last_message_sender_type = models.CharField(max_length=10, blank=True)
+    # Read watermarks: every message from the other side with id <= the watermark is read
+    user_last_read_message_id = models.PositiveBigIntegerField(default=0)
+    company_last_read_message_id = models.PositiveBigIntegerField(default=0)
+    # When the row last changed, for delta sync (see api.chat_sync). Stamped by save(),
+    # queryset updates set it themselves.
+    changed_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         unique_together = ('user', 'company')
         ordering = ['-updated_at']
+        indexes = [
+            # Inboxes: a company's or a user's chats, most recent first
+            models.Index(fields=['company', '-updated_at'], name='chat_company_updated_idx'),
+            models.Index(fields=['user', '-updated_at'], name='chat_user_updated_idx'),
+            # Only the chats the company still has to read, for the unread totals
+            models.Index(fields=['company'], condition=models.Q(unread_for_company__gt=0),
+                         name='chat_company_unread_idx'),
+            # Delta sync: a user's or a company's chats changed since a sync token
+            models.Index(fields=['user', 'changed_at'], name='chat_user_changed_idx'),
+            models.Index(fields=['company', 'changed_at'], name='chat_company_changed_idx'),
+        ]
 
     def __str__(self):
         return f"Chat between {self.user.username} and {self.company.name}"
 
+    def save(self, *args, **kwargs):
+        self.changed_at = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'changed_at'}
+        super().save(*args, **kwargs)
+
+    def last_read_message_id(self, reader_type):
+        """Read watermark of 'user' or 'company'"""
+        return getattr(self, f'{reader_type}_last_read_message_id')
+
 
 class Message(models.Model):
+    # On SQLite a migration that rebuilds this table drops the full-text search
+    # triggers of migration 0015, restore them afterwards as 0019 does
     SENDER_CHOICES = (
         ('user', 'User'),
         ('company', 'Company'),
     )
     
-    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
+    # Indexed by message_chat_id_idx and the other (chat, ...) indexes below
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages', db_index=False)
     sender_type = models.CharField(max_length=10, choices=SENDER_CHOICES)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # History pages: ?before= / ?after= cursors over a chat's message ids
+            models.Index(fields=['chat', 'id'], name='message_chat_id_idx'),
+            # Newest message per side and counting past a read watermark
+            models.Index(fields=['chat', 'sender_type', 'id'], name='message_chat_sender_idx'),
+            # Default ordering of chat.messages, and delta sync: messages written since a sync token
+            models.Index(fields=['chat', 'timestamp'], name='message_chat_timestamp_idx'),
+        ]
     
     def __str__(self):
         return f"Message in {self.chat} at {self.timestamp}"
 
+    @property
+    def is_read(self):
+        """
+        Derived from the recipient's read watermark on the chat.
+        Load messages through chat.messages to avoid a query per message.
+        """
+        reader_type = 'company' if self.sender_type == 'user' else 'user'
+        return self.id is not None and self.id <= self.chat.last_read_message_id(reader_type)
+
+
+class ArchivedMessage(models.Model):
+    """
+    Message moved out of the live table by api.chat_archive.
+    Keeps the original message id, so history cursors work across both tables.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='archived_messages', db_index=False)
+    sender_type = models.CharField(max_length=10, choices=Message.SENDER_CHOICES)
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['chat', 'id'], name='archived_message_chat_id_idx'),
+            # Retention purges walk the archive by age
+            models.Index(fields=['timestamp'], name='archived_message_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived message in {self.chat} at {self.timestamp}"
 
+    is_read = Message.is_read
@@ -0,0 +1,89 @@
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Cursor pagination over (chat_id, id) for a chat's message history.
+
+    - no cursor: the newest page
+    - ?before=<id>&limit=: the page of messages older than <id>
+    - ?after=<id>&limit=: the page of messages newer than <id>
+
+    Pages are always returned oldest first. has_more tells whether another
+    page exists in the direction that was requested.
+    ?include_archived=1 also pages through messages moved to the archive.
+    """
+    default_limit = getattr(settings, 'CHAT_MESSAGES_PAGE_SIZE', 30)
+    max_limit = getattr(settings, 'CHAT_MESSAGES_MAX_PAGE_SIZE', 100)
+
+    def get_cursor(self, request, name):
+        value = request.query_params.get(name)
+        if value in (None, ''):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise serializers.ValidationError({name: "Must be a message id."})
+
+    def get_limit(self, request):
+        value = request.query_params.get('limit')
+        if value in (None, ''):
+            return self.default_limit
+        try:
+            limit = int(value)
+        except ValueError:
+            raise serializers.ValidationError({'limit': "Must be a positive integer."})
+        if limit < 1:
+            raise serializers.ValidationError({'limit': "Must be a positive integer."})
+        return min(limit, self.max_limit)
+
+    def fetch(self, queryset, before, after, limit):
+        """One more than limit messages next to the cursor, nearest first"""
+        if after is not None:
+            return list(queryset.filter(id__gt=after).order_by('id')[:limit + 1])
+        if before is not None:
+            queryset = queryset.filter(id__lt=before)
+        return list(queryset.order_by('-id')[:limit + 1])
+
+    def paginate_queryset(self, queryset, request, view=None, archived=None):
+        """
+        archived is an optional second queryset (a chat's archived messages) merged
+        into the same pages. Archived messages keep their ids, so one cursor covers both.
+        """
+        before = self.get_cursor(request, 'before')
+        after = self.get_cursor(request, 'after')
+        if before is not None and after is not None:
+            raise serializers.ValidationError("Use either 'before' or 'after', not both.")
+        limit = self.get_limit(request)
+
+        page = self.fetch(queryset, before, after, limit)
+        if archived is not None:
+            page += self.fetch(archived, before, after, limit)
+            page.sort(key=lambda message: message.id, reverse=after is None)
+            page = page[:limit + 1]
+
+        self.has_more = len(page) > limit
+        page = page[:limit]
+        if after is None:
+            page.reverse()
+
+        self.direction = 'after' if after is not None else 'before'
+        self.page = page
+        return page
+
+    def include_archived(self, request):
+        return request.query_params.get('include_archived', '').lower() in ('1', 'true', 'yes')
+
+    def get_pagination_data(self):
+        return {
+            'has_more': self.has_more,
+            'direction': self.direction,
+            'next_before': self.page[0].id if self.page else None,
+            'next_after': self.page[-1].id if self.page else None,
+        }
+
+    def get_paginated_response(self, data):
+        return Response({'results': data, **self.get_pagination_data()})
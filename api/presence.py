@@ -0,0 +1,129 @@
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+
+
+def get_presence_ttl():
+    """Seconds a user stays online without a connection refreshing it"""
+    return getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+
+
+def get_typing_interval():
+    """Seconds between two chat.typing broadcasts for the same chat and side"""
+    return getattr(settings, 'CHAT_TYPING_INTERVAL', 3)
+
+
+class TTLStore:
+    """
+    In-memory key/value store whose entries expire after a per-entry TTL.
+    Expired entries are dropped lazily when they are read. Nothing is persisted:
+    each process holds its own copy, kept in sync by the events consumers
+    exchange over the channel layer.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + ttl)
+
+    def add(self, key, value, ttl):
+        """Set key only if it is missing or expired. Returns whether it was set."""
+        with self._lock:
+            now = self.clock()
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                return False
+            self._entries[key] = (value, now + ttl)
+            return True
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= self.clock():
+                del self._entries[key]
+                return default
+            return entry[0]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def items(self, prefix):
+        """Live (key, value) pairs of tuple keys starting with prefix"""
+        with self._lock:
+            now = self.clock()
+            expired = [key for key, (_, expires) in self._entries.items() if expires <= now]
+            for key in expired:
+                del self._entries[key]
+            return [(key, value) for key, (value, _) in self._entries.items() if key[0] == prefix]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Process-wide presence state. A user is online while some process has a live
+# ('online', user_id, origin) entry for it: the process's own while it holds a
+# connection of the user, copies of the other processes' from their presence.update
+# events. An entry no connection refreshes expires, also when its process died.
+store = TTLStore()
+# Identifies this process's entries in presence.update events
+ORIGIN = uuid.uuid4().hex
+# Open connections per user in this process, they keep this process's entry refreshed
+connections = Counter()
+
+
+def mark_online(user_id, company_ids, origin=ORIGIN):
+    store.set(('online', user_id, origin), list(company_ids), get_presence_ttl())
+
+
+def mark_offline(user_id, origin=ORIGIN):
+    """Drop the entry origin holds for user_id. Returns whether the user is still online."""
+    store.delete(('online', user_id, origin))
+    if origin == ORIGIN:
+        store.delete(('announced', user_id))
+    return is_online(user_id)
+
+
+def is_online(user_id):
+    return any(key[1] == user_id for key, _ in store.items('online'))
+
+
+def should_announce(user_id):
+    """
+    Whether an online presence.update is due for user_id.
+    Refreshes are rebroadcast at most twice per TTL, enough to keep remote stores from expiring.
+    """
+    return store.add(('announced', user_id), True, get_presence_ttl() / 2)
+
+
+def online_user_ids(user_ids):
+    """The subset of user_ids that are online"""
+    return sorted({key[1] for key, _ in store.items('online') if key[1] in user_ids})
+
+
+def online_company_ids(company_ids):
+    """The subset of company_ids with at least one representative online"""
+    online = set()
+    for _, represented in store.items('online'):
+        online.update(represented)
+    return sorted(online & set(company_ids))
+
+
+def should_broadcast_typing(chat_id, sender_type):
+    """Coalesce typing bursts: True at most once per interval for a chat and side"""
+    return store.add(('typing', chat_id, sender_type), True, get_typing_interval())
+
+
+def note_typing(chat_id, sender_type):
+    """Record a typing broadcast made by another connection or process"""
+    store.add(('typing', chat_id, sender_type), True, get_typing_interval())
@@ -0,0 +1,175 @@
+"""
+Token-bucket rate limits for message sends and the auth endpoints.
+
+A bucket holds up to `burst` tokens and refills evenly over `period` seconds, each
+request takes one. settings.RATE_LIMITS sets (burst, period) per scope, separately for
+the authenticated user and the client IP; a request must find a token in each of its
+buckets. Buckets are kept by settings.RATE_LIMIT_STORE: LocalBucketStore counts in this
+process only, CacheBucketStore shares them between workers through the default cache.
+"""
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+
+def refill(state, burst, period, now):
+    """Tokens in a bucket at now, from its (tokens, updated_at) state, None for a new bucket"""
+    if state is None:
+        return burst
+    tokens, updated_at = state
+    return min(burst, tokens + max(now - updated_at, 0) * burst / period)
+
+
+def wait_for_token(tokens, burst, period):
+    """Seconds until a bucket holding tokens has a whole one"""
+    return max(1 - tokens, 0) * period / burst
+
+
+class BucketStore:
+    """Keeps token buckets for RATE_LIMIT_STORE"""
+
+    def take(self, key, burst, period):
+        """Take a token from the bucket at key. Returns 0 if it had one, else the seconds to wait."""
+        raise NotImplementedError
+
+    async def atake(self, key, burst, period):
+        """take() for async code, stores that never block run it inline"""
+        return self.take(key, burst, period)
+
+
+class LocalBucketStore(BucketStore):
+    """
+    Buckets in this process's memory. Each worker counts on its own, so the effective
+    limit is the configured one times the number of workers. Buckets that refilled are
+    dropped once more than max_buckets are kept.
+    """
+    max_buckets = 10000
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, period):
+        with self._lock:
+            now = self.clock()
+            entry = self._buckets.get(key)
+            tokens = refill(entry and entry[:2], burst, period, now)
+            # An untouched bucket is full again after at most period seconds
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, now + period)
+                return wait_for_token(tokens, burst, period)
+            self._buckets[key] = (tokens - 1, now, now + period)
+            if len(self._buckets) > self.max_buckets:
+                self.prune(now)
+            return 0
+
+    def prune(self, now):
+        for key, (_, _, full_at) in list(self._buckets.items()):
+            if full_at <= now:
+                del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheBucketStore(BucketStore):
+    """
+    Buckets in the default cache, shared by every worker when it is (Redis with
+    CACHE_REDIS_URL). Concurrent requests of one client may both read the bucket
+    before either writes it back, so limits are approximate under races.
+    """
+
+    def state_key(self, key):
+        return f"ratelimit:{key}"
+
+    def update(self, state, burst, period):
+        """The new state of a bucket and the seconds to wait"""
+        now = time.time()
+        tokens = refill(state, burst, period, now)
+        if tokens < 1:
+            return (tokens, now), wait_for_token(tokens, burst, period)
+        return (tokens - 1, now), 0
+
+    def take(self, key, burst, period):
+        state, wait = self.update(cache.get(self.state_key(key)), burst, period)
+        cache.set(self.state_key(key), state, int(period) + 1)
+        return wait
+
+    async def atake(self, key, burst, period):
+        state, wait = self.update(await cache.aget(self.state_key(key)), burst, period)
+        await cache.aset(self.state_key(key), state, int(period) + 1)
+        return wait
+
+
+def get_rate_limits():
+    return getattr(settings, 'RATE_LIMITS', {})
+
+
+@functools.lru_cache
+def load_store(path):
+    return import_string(path)()
+
+
+def get_store():
+    return load_store(getattr(settings, 'RATE_LIMIT_STORE', 'api.ratelimit.LocalBucketStore'))
+
+
+def get_buckets(scope, user_id=None, ip=None):
+    """(key, burst, period) of the buckets a request of scope takes a token from"""
+    idents = {'user': user_id, 'ip': ip}
+    return [
+        (f"{scope}:{kind}:{idents[kind]}", burst, period)
+        for kind, (burst, period) in get_rate_limits().get(scope, {}).items()
+        if idents.get(kind) is not None
+    ]
+
+
+def check(scope, user_id=None, ip=None):
+    """Take a token for a request of scope. Returns 0 if allowed, else the seconds to wait."""
+    store = get_store()
+    return max((store.take(*bucket) for bucket in get_buckets(scope, user_id, ip)), default=0)
+
+
+async def acheck(scope, user_id=None, ip=None):
+    """check() for async code"""
+    store = get_store()
+    return max([await store.atake(*bucket) for bucket in get_buckets(scope, user_id, ip)], default=0)
+
+
+def get_scope_ip(scope):
+    """Client IP of an ASGI connection (behind a proxy, run daphne with --proxy-headers)"""
+    client = scope.get('client')
+    return client[0] if client else None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """DRF throttle taking a token for its scope, answered with 429 and Retry-After when empty"""
+    scope = None
+
+    def allow_request(self, request, view):
+        user = getattr(request, 'user', None)
+        user_id = user.pk if user is not None and user.is_authenticated else None
+        self.wait_seconds = check(self.scope, user_id, self.get_ident(request))
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class ChatSendThrottle(TokenBucketThrottle):
+    scope = 'chat_send'
+
+
+class LoginThrottle(TokenBucketThrottle):
+    scope = 'login'
+
+
+class RegisterThrottle(TokenBucketThrottle):
+    scope = 'register'
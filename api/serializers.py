@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from .models import Company, Building, Floor, Flat, AppUser, BuildingImage
 from rest_framework.validators import UniqueValidator
+from .fields import ValidatedImageField
 
 
 # User Serializers
@@ -11,6 +12,7 @@ class UserRegisterSerializer(serializers.ModelSerializer):
     )
     password = serializers.CharField(write_only=True, required=True)
     password2 = serializers.CharField(write_only=True, required=True)
+    profile_picture = ValidatedImageField(required=False, allow_null=True, image_kind='profile_picture')
 
     class Meta:
         model = AppUser
@@ -43,6 +45,8 @@ class UserRegisterSerializer(serializers.ModelSerializer):
 
 class UserDetailSerializer(serializers.ModelSerializer):
     company_name = serializers.SerializerMethodField(read_only=True)
+    profile_picture = ValidatedImageField(required=False, allow_null=True, image_kind='profile_picture',
+                                          negotiated=True)
     
     class Meta:
         model = AppUser
@@ -95,7 +99,7 @@ class CompanySerializer(serializers.ModelSerializer):
 
 # BuildingImage Serializer
 class BuildingImageSerializer(serializers.ModelSerializer):
-    image = serializers.ImageField(required=False)  # Make image optional
+    image = ValidatedImageField(required=False, negotiated=True)  # Make image optional
     
     class Meta:
         model = BuildingImage
@@ -118,6 +122,7 @@ class BuildingImageSerializer(serializers.ModelSerializer):
 # Building Serializer
 class BuildingSerializer(serializers.ModelSerializer):
     distance = serializers.FloatField(required=False, read_only=True)
+    image = ValidatedImageField(required=False, allow_null=True, negotiated=True)
     additional_images = BuildingImageSerializer(many=True, read_only=True)
     
     class Meta:
@@ -151,6 +156,8 @@ class BuildingSerializer(serializers.ModelSerializer):
 
 # Floor Serializer
 class FloorSerializer(serializers.ModelSerializer):
+    plan_image = ValidatedImageField(image_kind='floor_plan')
+
     class Meta:
         model = Floor
         fields = '__all__'
@@ -0,0 +1,103 @@
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import AppUser, Chat, Floor
+from .floor_tiles import schedule_floor_tiles, tiles_ready
+from .chat_events import notify_user_access_changed, notify_chat_access_changed
+from .channels_auth import mark_claims_changed
+
+
+@receiver(post_save, sender=Floor)
+def tile_floor_plan(sender, instance, **kwargs):
+    """
+    Queue background tiling whenever a floor gets a plan image without a tile pyramid
+    """
+    if instance.plan_image and not tiles_ready(instance):
+        schedule_floor_tiles(instance)
+
+
+USER_ACCESS_FIELDS = ('company_id', 'is_active', 'is_superuser')
+
+
+@receiver(pre_save, sender=AppUser)
+def remember_user_access(sender, instance, update_fields=None, raw=False, **kwargs):
+    """
+    Keep the access fields a user is saved over, most saves (last_login, profile edits) leave them alone
+    """
+    instance._previous_access = None
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and not {'company', 'is_active', 'is_superuser'} & set(update_fields):
+        return
+    instance._previous_access = AppUser.objects.filter(pk=instance.pk)\
+        .values_list(*USER_ACCESS_FIELDS).first()
+
+
+@receiver(post_save, sender=AppUser)
+def invalidate_user_chat_access(sender, instance, created, **kwargs):
+    """
+    Company or active status changes alter which chats a connected user may send to
+    """
+    if created:
+        return
+    previous = getattr(instance, '_previous_access', None)
+    if previous is None or previous == tuple(getattr(instance, field) for field in USER_ACCESS_FIELDS):
+        return
+    mark_claims_changed(instance.pk)
+    notify_user_access_changed(instance.pk)
+
+
+@receiver(post_delete, sender=AppUser)
+def invalidate_deleted_user_claims(sender, instance, **kwargs):
+    """
+    Tokens of a deleted user must not authenticate from their claims any more
+    """
+    mark_claims_changed(instance.pk)
+
+
+@receiver(m2m_changed, sender=AppUser.groups.through)
+def invalidate_group_chat_access(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    company_<id> group memberships grant access to that company's chats
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        mark_claims_changed(instance.pk)
+        notify_user_access_changed(instance.pk)
+    else:
+        # Group.user_set changed, pk_set holds the affected users
+        for user_id in pk_set or []:
+            mark_claims_changed(user_id)
+            notify_user_access_changed(user_id)
+
+
+@receiver(pre_save, sender=Chat)
+def remember_chat_participants(sender, instance, update_fields=None, raw=False, **kwargs):
+    """
+    Keep the participants a chat is saved over, they lose access if it is reassigned
+    """
+    instance._previous_participants = None
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and not {'user', 'company'} & set(update_fields):
+        return
+    instance._previous_participants = Chat.objects.filter(pk=instance.pk)\
+        .values_list('user_id', 'company_id').first()
+
+
+@receiver(post_save, sender=Chat)
+def invalidate_chat_access(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Connected consumers resolve new chats lazily, only changes need to be pushed
+    """
+    if created:
+        return
+    if update_fields is not None and not {'user', 'company', 'is_active'} & set(update_fields):
+        return
+    notify_chat_access_changed(instance, previous=getattr(instance, '_previous_participants', None))
+
+
+@receiver(post_delete, sender=Chat)
+def invalidate_deleted_chat_access(sender, instance, **kwargs):
+    notify_chat_access_changed(instance, deleted=True)
@@ -0,0 +1,544 @@
+import asyncio
+import io
+import json
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from server.asgi import application
+from . import chat_codec, floor_tiles, presence, ratelimit, signals
+from .auth import EmailTokenObtainPairSerializer
+from .chat_events import company_presence_group, group_send_many, user_group
+from .chat_service import send_message
+from .chat_sync import SyncCursor, sync_chats
+from .models import AppUser, Building, BuildingImage, Chat, Company, Floor, Message
+
+
+def access_token(user):
+    return str(EmailTokenObtainPairSerializer.get_token(user).access_token)
+
+
+def png_file(name, size=(64, 64)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'white').save(buffer, 'PNG')
+    return ContentFile(buffer.getvalue(), name=name)
+
+
+class MediaRootMixin:
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+
+class ChatTestMixin:
+    """A company with a representative and a user with a chat with it"""
+
+    def setUp(self):
+        self.company = Company.objects.create(name="Acme")
+        self.user = AppUser.objects.create_user(username='user', email='user@example.com', password='x')
+        self.representative = AppUser.objects.create_user(username='rep', email='rep@example.com',
+                                                          password='x', company=self.company)
+        self.chat = Chat.objects.create(user=self.user, company=self.company)
+
+
+class ChatConsumerTestMixin(ChatTestMixin):
+
+    async def connect(self, user, query=''):
+        token = await database_sync_to_async(access_token)(user)
+        communicator = WebsocketCommunicator(application, f'/ws/chat/?token={token}{query}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_event(self, communicator, event_type):
+        """The next event of event_type sent to the client, looking into batch frames"""
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            for event in frame['events'] if frame['type'] == 'batch' else [frame]:
+                if event['type'] == event_type:
+                    return event
+
+
+class ChatBatchingTests(ChatConsumerTestMixin, TransactionTestCase):
+    """Batch frames are only sent to clients that asked for them"""
+
+    async def send_burst(self, communicator):
+        for content in ("One", "Two", "Three"):
+            await communicator.send_json_to({'type': 'chat.message', 'chat_id': self.chat.id, 'content': content})
+        frames, received = [], 0
+        while received < 3:
+            frame = await communicator.receive_json_from(timeout=2)
+            frames.append(frame)
+            received += sum(event['type'] == 'chat.message' for event in frame.get('events', [frame]))
+        await communicator.disconnect()
+        return frames
+
+    async def test_single_frames_by_default(self):
+        communicator = await self.connect(self.user)
+        frames = await self.send_burst(communicator)
+        self.assertNotIn('batch', [frame['type'] for frame in frames])
+
+    async def test_batch_frames_on_opt_in(self):
+        communicator = await self.connect(self.user, '&batch=1')
+        frames = await self.send_burst(communicator)
+        self.assertIn('batch', [frame['type'] for frame in frames])
+
+
+class ChatMessagePackTests(ChatConsumerTestMixin, TransactionTestCase):
+    """chat.msgpack connections exchange the JSON protocol's events as MessagePack frames"""
+
+    async def test_message_round_trip(self):
+        token = await database_sync_to_async(access_token)(self.user)
+        communicator = WebsocketCommunicator(application, f'/ws/chat/?token={token}',
+                                             subprotocols=[chat_codec.SUBPROTOCOL])
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, chat_codec.SUBPROTOCOL)
+
+        await communicator.send_to(bytes_data=chat_codec.encode(
+            {'type': 'chat.message', 'chat_id': self.chat.id, 'content': "Packed"}))
+        while True:
+            frame = chat_codec.decode(await communicator.receive_from(timeout=2))
+            events = [event for event in (frame['events'] if frame['type'] == 'batch' else [frame])
+                      if event['type'] == 'chat.message']
+            if events:
+                break
+        await communicator.disconnect()
+
+        message = events[0]['message']
+        self.assertEqual((message['content'], message['sender_type']), ("Packed", 'user'))
+        # Timestamps travel as epoch milliseconds
+        self.assertIsInstance(message['timestamp'], int)
+        self.assertTrue(await Message.objects.filter(chat=self.chat, content="Packed").aexists())
+
+
+@override_settings(RATE_LIMITS={'chat_send': {'user': (1, 60)}})
+class ChatRateLimitTests(ChatConsumerTestMixin, TransactionTestCase):
+    """REST and WebSocket sends share the chat_send buckets"""
+
+    def setUp(self):
+        super().setUp()
+        ratelimit.get_store().clear()
+        self.addCleanup(ratelimit.get_store().clear)
+
+    def test_rest_send_answers_429(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f'/chats/{self.chat.id}/send_message/'
+        self.assertEqual(client.post(url, {'content': "One"}).status_code, 201)
+        response = client.post(url, {'content': "Two"})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        self.assertEqual(self.chat.messages.count(), 1)
+
+    async def test_websocket_send_answers_error_frame(self):
+        communicator = await self.connect(self.user)
+        for content in ("One", "Two"):
+            await communicator.send_json_to({'type': 'chat.message', 'chat_id': self.chat.id, 'content': content})
+        error = await self.receive_event(communicator, 'error')
+        await communicator.disconnect()
+        self.assertGreater(error['retry_after'], 0)
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 1)
+
+
+@override_settings(CHAT_WS_PING_INTERVAL=0.1, CHAT_WS_IDLE_TIMEOUT=0.3)
+class ChatHeartbeatTests(ChatConsumerTestMixin, TransactionTestCase):
+    """Silent connections are pinged and closed with 4009, answered pings keep them open"""
+
+    async def test_silent_connection_is_closed(self):
+        communicator = await self.connect(self.user)
+        pinged = False
+        while True:
+            output = await communicator.receive_output(timeout=2)
+            if output['type'] == 'websocket.close':
+                break
+            pinged = pinged or json.loads(output['text'])['type'] == 'ping'
+        self.assertTrue(pinged)
+        self.assertEqual(output['code'], 4009)
+
+    async def test_pong_keeps_connection_open(self):
+        communicator = await self.connect(self.user)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 1
+        pings = 0
+        while loop.time() < deadline:
+            output = await communicator.receive_output(timeout=2)
+            self.assertNotEqual(output['type'], 'websocket.close')
+            frame = json.loads(output['text'])
+            if frame['type'] == 'ping':
+                pings += 1
+                await communicator.send_json_to({'type': 'pong'})
+        self.assertGreater(pings, 1)
+
+        await communicator.send_json_to({'type': 'ping'})
+        await self.receive_event(communicator, 'pong')
+        await communicator.disconnect()
+
+
+class PresenceTests(ChatConsumerTestMixin, TransactionTestCase):
+    """A user is offline once no process has it online, not when one process loses it"""
+
+    def setUp(self):
+        super().setUp()
+        presence.store.clear()
+        presence.connections.clear()
+
+    async def test_offline_once_no_process_has_user_online(self):
+        user_connection = await self.connect(self.user)
+        representative_connection = await self.connect(self.representative)
+        online = await self.receive_event(user_connection, 'presence.update')
+        self.assertEqual((online['user_id'], online['status']), (self.representative.id, 'online'))
+
+        # Another process also holds a connection of the representative
+        presence.mark_online(self.representative.id, [self.company.id], origin='other')
+        await representative_connection.disconnect()
+        self.assertTrue(await user_connection.receive_nothing(timeout=0.2))
+        self.assertTrue(presence.is_online(self.representative.id))
+
+        # ... until it closes too
+        await group_send_many(get_channel_layer(), [company_presence_group(self.company.id)], {
+            'type': 'presence.update', 'user_id': self.representative.id,
+            'company_ids': [self.company.id], 'status': 'offline', 'origin': 'other'
+        })
+        offline = await self.receive_event(user_connection, 'presence.update')
+        self.assertEqual((offline['user_id'], offline['status']), (self.representative.id, 'offline'))
+        await user_connection.disconnect()
+
+    async def test_pong_keeps_user_online(self):
+        connection = await self.connect(self.user)
+        # The entry expired while the client only answered heartbeats
+        presence.store.delete(('online', self.user.id, presence.ORIGIN))
+        await connection.send_json_to({'type': 'pong'})
+        await connection.send_json_to({'type': 'ping'})
+        await self.receive_event(connection, 'pong')
+        self.assertTrue(presence.is_online(self.user.id))
+        await connection.disconnect()
+
+    def test_entries_expire(self):
+        now = [0]
+        with mock.patch.object(presence, 'store', presence.TTLStore(clock=lambda: now[0])):
+            presence.mark_online(self.user.id, [], origin='other')
+            self.assertTrue(presence.is_online(self.user.id))
+            now[0] = presence.get_presence_ttl() + 1
+            self.assertFalse(presence.is_online(self.user.id))
+
+
+class ChatReadTests(ChatConsumerTestMixin, TransactionTestCase):
+    """chat.read marks the side of the connection, whatever sender_type the client sends"""
+
+    def setUp(self):
+        super().setUp()
+        send_message(self.chat, 'user', "Hello")
+        send_message(self.chat, 'company', "Hi, how can we help?")
+
+    async def test_user_cannot_mark_company_side_read(self):
+        communicator = await self.connect(self.user)
+        await communicator.send_json_to({'type': 'chat.read', 'chat_id': self.chat.id, 'sender_type': 'user'})
+        error = await self.receive_event(communicator, 'error')
+        self.assertIn("sender_type", error['content'])
+        await communicator.disconnect()
+
+        chat = await Chat.objects.aget(id=self.chat.id)
+        self.assertEqual(chat.unread_for_company, 1)
+        self.assertEqual(chat.company_last_read_message_id, 0)
+        self.assertEqual(chat.unread_for_user, 1)
+
+    async def test_user_marks_own_side_read(self):
+        communicator = await self.connect(self.user)
+        await communicator.send_json_to({'type': 'chat.read', 'chat_id': self.chat.id})
+        confirmed = await self.receive_event(communicator, 'chat.read.confirmed')
+        self.assertEqual(confirmed['updated_count'], 1)
+        await communicator.disconnect()
+
+        chat = await Chat.objects.aget(id=self.chat.id)
+        self.assertEqual(chat.unread_for_user, 0)
+        self.assertEqual(chat.unread_for_company, 1)
+
+
+class ChatReassignmentTests(ChatTestMixin, TransactionTestCase):
+    """Reassigning a chat tells the participants it is taken from"""
+
+    async def test_previous_user_is_notified(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(user_group(self.user.id), channel_name)
+
+        other = await AppUser.objects.acreate(username='other', email='other@example.com')
+        self.chat.user = other
+        await database_sync_to_async(self.chat.save)()
+
+        event = await asyncio.wait_for(channel_layer.receive(channel_name), 2)
+        await channel_layer.group_discard(user_group(self.user.id), channel_name)
+        self.assertEqual(event['type'], 'auth.chat.updated')
+        self.assertEqual(event['user_id'], other.id)
+
+
+class UserAccessInvalidationTests(ChatTestMixin, TestCase):
+    def test_unrelated_save_keeps_claims(self):
+        with mock.patch.object(signals, 'notify_user_access_changed') as notify:
+            self.representative.first_name = "Rep"
+            self.representative.save()
+        notify.assert_not_called()
+
+    def test_company_change_invalidates_claims(self):
+        with mock.patch.object(signals, 'notify_user_access_changed') as notify:
+            self.representative.company = None
+            self.representative.save()
+        notify.assert_called_once_with(self.representative.pk)
+
+
+class CompanyChatListTests(ChatTestMixin, TestCase):
+    """Company-side chat lists take the same number of queries whatever the number of chats"""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            user = AppUser.objects.create_user(username=f'user{i}', email=f'user{i}@example.com', password='x')
+            chat = Chat.objects.create(user=user, company=self.company)
+            send_message(chat, 'user', f"Question {i}")
+        self.client = APIClient()
+        self.client.force_authenticate(self.representative)
+
+    def test_company_owner_chat_list(self):
+        with self.assertNumQueries(4):
+            response = self.client.get('/chat/company-owner/chats/')
+        self.assertEqual(len(response.data['chats']), 6)
+        self.assertEqual(response.data['unread_messages'], 5)
+
+    def test_company_chats(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/company-chats/')
+        self.assertEqual(response.data['count'], 6)
+        self.assertEqual({chat['user_email'] for chat in response.data['results']},
+                         {'user@example.com'} | {f'user{i}@example.com' for i in range(5)})
+
+    def test_company_owner_chat_detail_is_returned_read(self):
+        send_message(self.chat, 'user', "Hello")
+        response = self.client.get(f'/chat/company-owner/chat/{self.chat.id}/')
+        self.assertEqual(response.data['messages_marked_read'], 1)
+        self.assertEqual(response.data['chat']['unread_count'], 0)
+        self.assertTrue(all(message['is_read'] for message in response.data['messages']))
+
+
+class ChatQueryPlanTests(ChatTestMixin, TestCase):
+    def test_chat_queries_use_their_indexes(self):
+        send_message(self.chat, 'user', "Hello")
+        send_message(self.chat, 'company', "Hi")
+        call_command('explain_chat_queries', '--check', '--no-seqscan', stdout=io.StringIO())
+
+
+class ChatSearchTests(ChatTestMixin, TestCase):
+    """A message is found by search as soon as it is sent"""
+
+    def setUp(self):
+        super().setUp()
+        self.message = send_message(self.chat, 'user', "The elevator on the third floor is broken")
+        self.client = APIClient()
+        self.client.force_authenticate(self.representative)
+
+    def test_company_chats_search(self):
+        response = self.client.get('/company-chats/search/', {'q': 'elevator'})
+        self.assertEqual([hit['message_id'] for hit in response.data['results']], [self.message.id])
+
+    def test_company_owner_search(self):
+        response = self.client.get('/chat/company-owner/chats/search/', {'q': 'elev'})
+        self.assertEqual([hit['message_id'] for hit in response.data['results']], [self.message.id])
+
+
+class ChatSyncTests(ChatTestMixin, TestCase):
+    """Delta sync hands out every message once, late commits included"""
+
+    def sync(self, cursor):
+        chats = Chat.objects.filter(user=self.user)
+        _, messages, cursor, _ = sync_chats(chats, SyncCursor.from_token(cursor.token()))
+        return [message.content for message in messages], cursor
+
+    def test_messages_are_synced_once(self):
+        _, _, cursor, _ = sync_chats(Chat.objects.filter(user=self.user))
+        send_message(self.chat, 'company', "First")
+        send_message(self.chat, 'user', "Second")
+
+        contents, cursor = self.sync(cursor)
+        self.assertEqual(contents, ["First", "Second"])
+        contents, cursor = self.sync(cursor)
+        self.assertEqual(contents, [])
+
+    def test_late_commit_is_synced(self):
+        _, _, cursor, _ = sync_chats(Chat.objects.filter(user=self.user))
+        send_message(self.chat, 'company', "Committed first")
+        contents, cursor = self.sync(cursor)
+        self.assertEqual(contents, ["Committed first"])
+
+        # Written before the message above, but committed after the sync
+        late = send_message(self.chat, 'user', "Committed late")
+        Message.objects.filter(id=late.id).update(timestamp=timezone.now() - timedelta(seconds=1))
+        contents, cursor = self.sync(cursor)
+        self.assertEqual(contents, ["Committed late"])
+
+
+class ChatEventResumeTests(ChatTestMixin, TransactionTestCase):
+    """Messages sent while a long-poll or SSE client was away are replayed on its next request"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = AsyncClient()
+        self.headers = {'Authorization': f'Bearer {access_token(self.user)}'}
+
+    async def poll(self, cursor=None):
+        query = {'timeout': 0}
+        if cursor is not None:
+            query['cursor'] = cursor
+        response = await self.client.get('/chat/events/poll/', query, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    async def read_stream(self, response, until):
+        """SSE blocks of a streaming response, up to the first one containing until"""
+        blocks = []
+        async for chunk in response.streaming_content:
+            blocks.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+            if until in blocks[-1]:
+                break
+        await response.streaming_content.aclose()
+        return blocks
+
+    async def test_poll_replays_message_sent_between_polls(self):
+        data = await self.poll()
+        self.assertEqual(data['events'], [])
+
+        await database_sync_to_async(send_message)(self.chat, 'company', "While away")
+        data = await self.poll(data['cursor'])
+        self.assertEqual([event['message']['content'] for event in data['events']], ["While away"])
+
+        data = await self.poll(data['cursor'])
+        self.assertEqual(data['events'], [])
+
+    async def test_poll_rejects_invalid_cursor(self):
+        response = await self.client.get('/chat/events/poll/', {'timeout': 0, 'cursor': 'bogus'},
+                                         headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    async def test_stream_replays_from_last_event_id(self):
+        response = await self.client.get('/chat/events/stream/', headers=self.headers)
+        blocks = await self.read_stream(response, 'id: ')
+        last_event_id = blocks[-1].split('\n')[0].removeprefix('id: ')
+
+        await database_sync_to_async(send_message)(self.chat, 'company', "While reconnecting")
+        response = await self.client.get('/chat/events/stream/',
+                                         headers={**self.headers, 'Last-Event-ID': last_event_id})
+        blocks = await self.read_stream(response, 'event: chat.message')
+        self.assertIn("While reconnecting", blocks[-1])
+        self.assertTrue(blocks[-1].startswith('id: '))
+
+
+class BuildingImageUploadTests(MediaRootMixin, TestCase):
+    """A batch of building images is stored whole or not at all"""
+
+    def setUp(self):
+        super().setUp()
+        company = Company.objects.create(name="Acme")
+        self.building = Building.objects.create(name="Tower", company=company, latitude=0, longitude=0,
+                                                floors_count=1, flats_count=0)
+        self.client = APIClient()
+        self.client.force_authenticate(AppUser.objects.create_superuser(
+            username='admin', email='admin@example.com', password='admin'))
+
+    def upload(self, *images):
+        return self.client.post(f'/buildings/{self.building.pk}/add-images/',
+                                {'images': list(images)}, format='multipart')
+
+    def upload_file(self, name, size=(64, 64)):
+        return SimpleUploadedFile(name, png_file(name, size).read(), content_type='image/png')
+
+    def stored_files(self):
+        return default_storage.listdir('building_images')[1] if default_storage.exists('building_images') else []
+
+    def test_batch_is_stored(self):
+        response = self.upload(self.upload_file('one.png'), self.upload_file('two.png'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(BuildingImage.objects.filter(building=self.building).count(), 2)
+        self.assertEqual(len(self.stored_files()), 2)
+
+    def test_invalid_image_rejects_whole_batch(self):
+        broken = SimpleUploadedFile('broken.png', b'not an image', content_type='image/png')
+        response = self.upload(self.upload_file('one.png'), broken)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.data['images']), [1])
+        self.assertFalse(BuildingImage.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    def test_failed_insert_removes_stored_files(self):
+        with mock.patch.object(BuildingImage.objects, 'bulk_create', side_effect=RuntimeError("insert failed")), \
+                self.assertRaises(RuntimeError):
+            self.upload(self.upload_file('one.png'), self.upload_file('two.png'))
+        self.assertFalse(BuildingImage.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(IMAGE_LIMITS={'default': {'max_pixels': 100 * 100, 'downscale_megapixels': 1}})
+    def test_image_over_pixel_limit_is_rejected(self):
+        response = self.upload(self.upload_file('small.png'), self.upload_file('large.png', (200, 200)))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.data['images']), [1])
+        self.assertFalse(BuildingImage.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+
+class FloorTileTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        company = Company.objects.create(name="Acme")
+        building = Building.objects.create(name="Tower", company=company, latitude=0, longitude=0,
+                                           floors_count=1, flats_count=0)
+        self.floor = Floor.objects.create(building=building, floor_number=0, plan_image=png_file('plan.png'))
+        self.client = APIClient()
+
+    def test_tiles_queued_once_per_plan(self):
+        with self.captureOnCommitCallbacks() as callbacks, \
+                mock.patch.object(floor_tiles, '_build_floor_tiles_task'):
+            self.floor.plan_image = png_file('new-plan.png')
+            self.floor.save()
+            for _ in range(3):
+                response = self.client.get(f'/floors/{self.floor.pk}/tiles/')
+                self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(callbacks), 1)
+
+    def test_failed_build_is_reported_not_requeued(self):
+        version = floor_tiles.get_tile_version(self.floor)
+        with mock.patch.object(floor_tiles, 'build_floor_tiles', side_effect=OSError("truncated")), \
+                self.assertLogs('api.floor_tiles', 'ERROR'):
+            floor_tiles._build_floor_tiles_task(self.floor.pk, version)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.get(f'/floors/{self.floor.pk}/tiles/')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(callbacks, [])
+
+    def test_new_plan_build_removes_previous_version(self):
+        floor_tiles.build_floor_tiles(self.floor)
+        old_dir = floor_tiles.get_tiles_dir(self.floor)
+
+        self.floor.plan_image = png_file('new-plan.png')
+        self.floor.save()
+        floor_tiles.build_floor_tiles(self.floor)
+
+        self.assertTrue(floor_tiles.tiles_ready(self.floor))
+        self.assertFalse(default_storage.exists(old_dir))
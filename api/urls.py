@@ -5,13 +5,14 @@ from rest_framework_simplejwt.views import TokenRefreshView, TokenVerifyView
 from .views import (
     CompanyViewSet, BuildingViewSet, FloorViewSet, FlatViewSet,
     RegisterView, UserDetailView, AllUsersListView, logout_view, protected_example_view,
-    admin_panel_view, ProfileRedirectView, BuildingImageViewSet
+    admin_panel_view, ProfileRedirectView, BuildingImageViewSet, NegotiatedImageView
 )
-from .chat_views import ChatViewSet, CompanyChatListView, CompanyChatViewSet
+from .chat_views import ChatViewSet, CompanyChatListView, CompanyChatViewSet, ChatSyncView
 from .company_owner_chat_views import (
-    CompanyOwnerChatListView, CompanyOwnerChatDetailView,
+    CompanyOwnerChatListView, CompanyOwnerChatDetailView, CompanyOwnerChatSearchView,
     CompanyOwnerSendMessageView, CompanyOwnerGetUserListView
 )
+from .chat_stream_views import chat_event_stream, chat_event_poll
 from .auth import EmailTokenObtainPairView
 from .root_view import ApiRootView
 from .auth_instructions import AuthInstructionsView
@@ -44,11 +45,17 @@ auth_urlpatterns = [
 
 chat_urlpatterns = [
     path('companies-list/', CompanyChatListView.as_view(), name='chat-companies-list'),
+    # Chats and messages changed since a sync token, for clients resuming from the background
+    path('sync/', ChatSyncView.as_view(), name='chat-sync'),
     # Company Owner chat endpoints
     path('company-owner/chats/', CompanyOwnerChatListView.as_view(), name='company-owner-chats'),
+    path('company-owner/chats/search/', CompanyOwnerChatSearchView.as_view(), name='company-owner-chat-search'),
     path('company-owner/chat/<int:pk>/', CompanyOwnerChatDetailView.as_view(), name='company-owner-chat-detail'),
     path('company-owner/chat/<int:chat_id>/send/', CompanyOwnerSendMessageView.as_view(), name='company-owner-send-message'),
     path('company-owner/users/', CompanyOwnerGetUserListView.as_view(), name='company-owner-users-with-chats'),
+    # Fallbacks for clients without WebSockets (Server-Sent Events / long-poll)
+    path('events/stream/', chat_event_stream, name='chat-event-stream'),
+    path('events/poll/', chat_event_poll, name='chat-event-poll'),
 ]
 
 urlpatterns = [
@@ -59,4 +66,5 @@ urlpatterns = [
     path('example/protected/', protected_example_view, name='protected-example'),
     path('auth/help/', AuthInstructionsView.as_view(), name='auth-instructions'),
     path('admin/panel/', admin_panel_view, name='admin-panel'),
+    path('images/<path:name>', NegotiatedImageView.as_view(), name='negotiated-image'),
 ]
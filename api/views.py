@@ -1,16 +1,22 @@
-from rest_framework import viewsets, filters, generics, status, permissions
+from rest_framework import viewsets, filters, generics, status, permissions, serializers
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework_simplejwt.tokens import RefreshToken
+import logging
 import math
 from django.db.models import F, ExpressionWrapper, FloatField, Q, Max, Prefetch, Count
 from django.contrib.auth import logout
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
 from django.views import View
 from django.views.generic import TemplateView
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404
 from django.shortcuts import redirect
+from django.utils.cache import patch_vary_headers
 from django.urls import reverse
 from django.conf import settings
 from django_filters.rest_framework import DjangoFilterBackend
@@ -25,14 +31,60 @@ class ProfileRedirectView(View):
         return redirect(reverse('api-root'))
 
 from .models import Company, Building, Floor, Flat, AppUser, BuildingImage
+from .image_negotiation import choose_format, get_or_create_variant, get_original_content_type
 from .serializers import (
     CompanySerializer, BuildingSerializer, FloorSerializer, FlatSerializer,
     UserRegisterSerializer, UserDetailSerializer, BuildingImageSerializer,
     AdminUserListSerializer
 )
 from .permissions import IsAdminOrReadOnly, IsOwnerOrAdmin
+from .channels_auth import deny_token
+from .ratelimit import RegisterThrottle
 from .company_owner_permissions import IsCompanyOwnerForCompanyBuildings
 from .company_owner_utils import is_company_owner, get_company_owner_stats
+from .image_utils import (
+    ImageLimitsValidator, get_image_limits, probe_images, check_image_limits, downscale_image,
+    save_uploads, delete_stored_files, probe_image
+)
+from .floor_tiles import (
+    get_tile_version, get_tile_path, get_tile_size, get_tile_format, get_max_level,
+    tiles_ready, schedule_floor_tiles, get_build_state, TILES_FAILED
+)
+
+logger = logging.getLogger(__name__)
+
+
+class NegotiatedImageView(View):
+    """
+    Serves an uploaded image in the best format the client advertises in Accept:
+    AVIF, then WebP, then the original JPEG/PNG. Converted files are cached on disk
+    next to the original.
+    """
+    allowed_prefixes = ('building_images/', 'profile_pictures/', 'floor_plans/')
+
+    def get(self, request, name):
+        if not name.startswith(self.allowed_prefixes) or '..' in name.split('/'):
+            raise Http404("Image not found")
+        if not default_storage.exists(name):
+            raise Http404("Image not found")
+
+        served_name = name
+        content_type = get_original_content_type(name)
+        fmt = choose_format(request.headers.get('Accept'))
+        if fmt:
+            try:
+                variant_name = get_or_create_variant(name, fmt)
+            except (OSError, ValueError):
+                logger.exception("Image conversion failed for %s", name)
+                variant_name = None
+            if variant_name:
+                served_name = variant_name
+                content_type = fmt[1]
+
+        response = FileResponse(default_storage.open(served_name, 'rb'), content_type=content_type)
+        patch_vary_headers(response, ['Accept'])
+        response['Cache-Control'] = f"public, max-age={getattr(settings, 'IMAGE_NEGOTIATION_MAX_AGE', 86400)}"
+        return response
 
 
 # Custom permission class (legacy - use classes from permissions.py instead)
@@ -54,6 +106,7 @@ class RegisterView(generics.CreateAPIView):
     queryset = AppUser.objects.all()
     permission_classes = (AllowAny,)
     serializer_class = UserRegisterSerializer
+    throttle_classes = (RegisterThrottle,)
     
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -124,6 +177,11 @@ def logout_view(request):
                 "message": "Refresh token is required",
             }, status=status.HTTP_400_BAD_REQUEST)
             
+        # The access token of this request stops working for the chat WebSocket
+        # and event streams right away, not only when it expires
+        if request.auth is not None:
+            deny_token(request.auth)
+
         # Blacklist the token
         try:
             token = RefreshToken(refresh_token)
@@ -312,22 +370,64 @@ class BuildingViewSet(viewsets.ModelViewSet):
                 )
                 created_images.append(building_image)
         else:
-            # Process each uploaded image
-            for i, image in enumerate(images):
-                caption = captions[i] if i < len(captions) else ""
-                order = int(orders[i]) if i < len(orders) and orders[i].isdigit() else i
-                
-                building_image = BuildingImage.objects.create(
-                    building=building,
-                    image=image,
-                    caption=caption,
-                    order=order
-                )
-                created_images.append(building_image)
-        
+            created_images = self._create_images_batch(building, images, captions, orders)
+
         serializer = BuildingImageSerializer(created_images, many=True)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    def _create_images_batch(self, building, images, captions, orders):
+        """
+        Validate, store and insert a batch of uploaded images.
+        Headers are probed concurrently, files are written with a bounded thread pool
+        and all rows are inserted with one bulk_create. On any failure the whole batch
+        is rolled back, including the files already written to storage.
+        """
+        # Validate every image up front so nothing is written for an invalid batch
+        validator = BuildingImageSerializer()
+        field = BuildingImage._meta.get_field('image')
+        # Header limits are checked below from the concurrent probe results
+        field_validators = [v for v in field.validators if not isinstance(v, ImageLimitsValidator)]
+        limits = get_image_limits()
+        probes = probe_images(images)
+        errors = {}
+        for i, (image, probe) in enumerate(zip(images, probes)):
+            image_errors = check_image_limits(probe, limits)
+            try:
+                validator.validate_image(image)
+                for field_validator in field_validators:
+                    field_validator(image)
+            except serializers.ValidationError as e:
+                image_errors.extend(e.detail)
+            except DjangoValidationError as e:
+                image_errors.extend(e.messages)
+            if image_errors:
+                errors[i] = image_errors
+        if errors:
+            raise serializers.ValidationError({'images': errors})
+
+        images = [downscale_image(image, limits, probe=probe) for image, probe in zip(images, probes)]
+
+        # Build unsaved instances and their target file names
+        instances = []
+        named_uploads = []
+        for i, image in enumerate(images):
+            caption = captions[i] if i < len(captions) else ""
+            order = int(orders[i]) if i < len(orders) and orders[i].isdigit() else i
+            instance = BuildingImage(building=building, caption=caption, order=order)
+            instances.append(instance)
+            named_uploads.append((field.generate_filename(instance, image.name), image))
+
+        # Write files concurrently, then insert all rows in one transaction
+        saved_names = save_uploads(field.storage, named_uploads)
+        try:
+            with transaction.atomic():
+                for instance, name in zip(instances, saved_names):
+                    instance.image = name
+                return BuildingImage.objects.bulk_create(instances)
+        except Exception:
+            delete_stored_files(field.storage, saved_names)
+            raise
+
 
 class BuildingImageViewSet(viewsets.ModelViewSet):
     queryset = BuildingImage.objects.all()
@@ -347,6 +447,66 @@ class FloorViewSet(viewsets.ModelViewSet):
     ordering_fields = ['floor_number', 'building__name']
     permission_classes = [IsAdminOrReadOnly]  # Using our custom permission class
 
+    @action(detail=True, methods=['get'], url_path='tiles')
+    def tiles(self, request, pk=None):
+        """
+        Describe the deep-zoom tile pyramid of the floor plan.
+        Returns 202 while the pyramid is still being built in the background,
+        422 when building it from the plan image failed.
+        """
+        floor = self.get_object()
+        version = get_tile_version(floor)
+        if version is None:
+            return Response({'error': 'Floor has no plan image'}, status=status.HTTP_404_NOT_FOUND)
+
+        if not tiles_ready(floor):
+            if get_build_state(floor) == TILES_FAILED:
+                return Response({'ready': False, 'version': version,
+                                 'error': 'Tiles could not be built from the floor plan image'},
+                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            schedule_floor_tiles(floor)
+            return Response({'ready': False, 'version': version}, status=status.HTTP_202_ACCEPTED)
+
+        with floor.plan_image.open('rb') as plan_file:
+            probe = probe_image(plan_file)
+        width, height = probe[1], probe[2]
+        tile_url = request.build_absolute_uri(
+            reverse('floor-tile', args=[floor.pk, version, 0, 0, 0])
+        ).replace('/0/0/0/', '/{z}/{x}/{y}/')
+
+        return Response({
+            'ready': True,
+            'version': version,
+            'width': width,
+            'height': height,
+            'tile_size': get_tile_size(),
+            'overlap': 0,
+            'format': get_tile_format(),
+            'min_level': 0,
+            'max_level': get_max_level(width, height),
+            'tile_url': tile_url,
+        })
+
+    @action(detail=True, methods=['get'], url_name='tile',
+            url_path=r'tiles/(?P<version>[0-9a-f]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)')
+    def tile(self, request, pk=None, version=None, z=None, x=None, y=None):
+        """
+        Serve a single tile by (floor, z, x, y). The URL carries the plan version,
+        so a tile never changes once published and can be cached as immutable.
+        """
+        floor = self.get_object()
+        if version != get_tile_version(floor):
+            raise Http404("Unknown tile version")
+
+        path = get_tile_path(floor, version, int(z), int(x), int(y))
+        if not default_storage.exists(path):
+            raise Http404("Tile not found")
+
+        content_type = 'image/jpeg' if get_tile_format() in ('jpg', 'jpeg') else f'image/{get_tile_format()}'
+        response = FileResponse(default_storage.open(path, 'rb'), content_type=content_type)
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
 
 class FlatViewSet(viewsets.ModelViewSet):
     queryset = Flat.objects.all()
@@ -14,6 +14,7 @@ django.setup()
 
 # Import models after Django setup
 from api.models import AppUser, Company, Chat, Message
+from api.chat_service import reconcile_unread_counters, refresh_last_message
 
 def create_company_owner_chat():
     """
@@ -62,8 +63,7 @@ def create_company_owner_chat():
                 chat=chat,
                 sender_type='user',
                 content="Hello, I'm interested in your property at 123 Main Street. Is it still available?",
-                timestamp=timezone.now() - timezone.timedelta(days=1, hours=2),
-                is_read=True
+                timestamp=timezone.now() - timezone.timedelta(days=1, hours=2)
             ),
             
             # Company replies
@@ -71,8 +71,7 @@ def create_company_owner_chat():
                 chat=chat,
                 sender_type='company',
                 content="Hi there! Yes, the property at 123 Main Street is still available. Would you like to schedule a viewing?",
-                timestamp=timezone.now() - timezone.timedelta(days=1, hours=1),
-                is_read=True
+                timestamp=timezone.now() - timezone.timedelta(days=1, hours=1)
             ),
             
             # User responds
@@ -80,8 +79,7 @@ def create_company_owner_chat():
                 chat=chat,
                 sender_type='user',
                 content="Great! I'd love to see it. What times do you have available this week?",
-                timestamp=timezone.now() - timezone.timedelta(hours=20),
-                is_read=True
+                timestamp=timezone.now() - timezone.timedelta(hours=20)
             ),
             
             # Company responds
@@ -89,8 +87,7 @@ def create_company_owner_chat():
                 chat=chat,
                 sender_type='company',
                 content="We have slots available on Thursday at 3pm and Friday at 10am. Which would work better for you?",
-                timestamp=timezone.now() - timezone.timedelta(hours=19),
-                is_read=True
+                timestamp=timezone.now() - timezone.timedelta(hours=19)
             ),
             
             # User's most recent message - unread
@@ -98,8 +95,7 @@ def create_company_owner_chat():
                 chat=chat,
                 sender_type='user',
                 content="Friday at 10am works perfectly for me. Can you confirm the address again and let me know if there's parking available nearby?",
-                timestamp=timezone.now() - timezone.timedelta(hours=2),
-                is_read=False
+                timestamp=timezone.now() - timezone.timedelta(hours=2)
             ),
         ]
         
@@ -111,6 +107,17 @@ def create_company_owner_chat():
         chat.updated_at = timezone.now() - timezone.timedelta(hours=2)
         chat.save()
         
+        # Everything up to the company's last reply has been read by both sides,
+        # the user's most recent message is left unread for the company
+        Chat.objects.filter(id=chat.id).update(
+            user_last_read_message_id=messages[3].id,
+            company_last_read_message_id=messages[2].id
+        )
+        
+        # Messages were saved directly, so rebuild the chat's unread counters and preview
+        reconcile_unread_counters(Chat.objects.filter(id=chat.id))
+        refresh_last_message(chat)
+        
         print(f"Created {len(messages)} messages in the chat")
         print("Test chat created successfully!")
         print("\nNow you can test the company owner chat functionality:")
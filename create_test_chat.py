@@ -11,6 +11,7 @@ django.setup()
 
 # Import models
 from api.models import Company, AppUser, Chat, Message
+from api.chat_service import send_message
 
 # Get the admin user
 try:
@@ -46,12 +47,7 @@ try:
         print(f"Using existing chat with ID: {chat.id}")
     
     # Create a test message
-    message = Message.objects.create(
-        chat=chat,
-        sender_type='user',
-        content='This is a test message from script.',
-        is_read=False
-    )
+    message = send_message(chat, 'user', 'This is a test message from script.')
     print(f"Created test message: '{message.content}'")
     
     print("\nTEST INFORMATION:")
@@ -2,6 +2,8 @@
 ASGI config for server project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests go to Django, WebSocket connections are authenticated with a JWT
+and routed to the chat consumer.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +15,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
 
-application = get_asgi_application()
+# Initialize Django before importing anything that touches models
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+
+from api.channels_auth import JWTAuthMiddleware  # noqa: E402
+from api.routing import websocket_urlpatterns  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': django_asgi_app,
+    'websocket': JWTAuthMiddleware(URLRouter(websocket_urlpatterns)),
+})
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -31,6 +32,9 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
+    # ASGI server, provides an ASGI runserver for WebSocket support
+    'daphne',
+
     # Jazzmin admin (alternative to unfold)
     'jazzmin',
     
@@ -49,6 +53,7 @@ INSTALLED_APPS = [
     'django_filters',
     'corsheaders',
     'drf_yasg',
+    'channels',
     
     # Local apps
     'api.apps.ApiConfig',
@@ -84,6 +89,46 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'server.wsgi.application'
+ASGI_APPLICATION = 'server.asgi.application'
+
+
+# Channels
+# The in-memory layer only works within a single process. Set CHANNEL_LAYER_REDIS_URL
+# (requires channels-redis) or override CHANNEL_LAYERS to share events between processes.
+
+CHANNEL_LAYER_REDIS_URL = os.environ.get('CHANNEL_LAYER_REDIS_URL')
+
+if CHANNEL_LAYER_REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [CHANNEL_LAYER_REDIS_URL],
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
+    }
+
+# Cache
+# WebSocket and event stream auth trust access token claims and keep revoked tokens
+# and users with changed claims in the default cache (see api.channels_auth).
+# The local-memory cache only covers one process: set CACHE_REDIS_URL (requires redis)
+# so logouts and permission changes reach every worker.
+
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        }
+    }
 
 
 # Database
@@ -137,6 +182,35 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Image uploads
+IMAGE_UPLOAD_MAX_WORKERS = 4  # Threads used to probe and write batch image uploads
+
+# Limits enforced from the image header before any upload is decoded.
+# max_pixels rejects the upload, larger than downscale_megapixels is downscaled.
+# Pillow's decompression bomb guard refuses anything over twice Image.MAX_IMAGE_PIXELS
+# (about 179 megapixels) regardless, max_pixels above that have no effect.
+IMAGE_LIMITS = {
+    'default': {'max_pixels': 40_000_000, 'downscale_megapixels': 16},
+    'profile_picture': {'max_pixels': 25_000_000, 'downscale_megapixels': 2},
+    'floor_plan': {'max_pixels': 178_000_000, 'downscale_megapixels': 178},
+}
+
+# Deep-zoom tiles generated in the background for floor plans.
+# Each tiling worker holds a decoded plan: about 1.25 x 4 bytes per pixel, e.g. 0.9 GB
+# for a 180 megapixel plan. Size FLOOR_PLAN_TILE_WORKERS to the memory of the process.
+FLOOR_PLAN_TILE_SIZE = 256
+FLOOR_PLAN_TILE_FORMAT = 'png'
+FLOOR_PLAN_TILE_WORKERS = 1
+# A queued build is not queued again for this long, a failed one is retried after FLOOR_PLAN_TILE_RETRY_AFTER
+FLOOR_PLAN_TILE_PENDING_TIMEOUT = 3600
+FLOOR_PLAN_TILE_RETRY_AFTER = 3600
+
+# Serve building and profile images as AVIF/WebP when the client's Accept header allows it
+IMAGE_NEGOTIATION_ENABLED = True
+IMAGE_NEGOTIATION_FORMATS = ['avif', 'webp']
+IMAGE_NEGOTIATION_QUALITY = 80
+IMAGE_NEGOTIATION_MAX_AGE = 86400
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
@@ -155,6 +229,66 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
 }
 
+# Chat message history is cursor paginated (?before=<id>&limit= / ?after=<id>)
+CHAT_MESSAGES_PAGE_SIZE = 30
+CHAT_MESSAGES_MAX_PAGE_SIZE = 100
+
+# Full-text message search (?q=&limit=)
+CHAT_SEARCH_LIMIT = 20
+CHAT_SEARCH_MAX_LIMIT = 50
+
+# Message archival (manage.py archive_chat_messages / purge_archived_messages).
+# Messages of inactive chats older than CHAT_ARCHIVE_AFTER_DAYS move to the archive
+# table, archived messages older than CHAT_RETENTION_DAYS are deleted (None keeps them).
+CHAT_ARCHIVE_AFTER_DAYS = 180
+CHAT_ARCHIVE_BATCH_SIZE = 500
+CHAT_RETENTION_DAYS = None
+
+# Presence and typing indicators over the chat WebSocket, kept in memory only.
+# Any frame from the client refreshes presence, answering the server pings (CHAT_WS_PING_INTERVAL) is enough.
+CHAT_PRESENCE_TTL = 60
+CHAT_TYPING_INTERVAL = 3
+
+# Chat WebSocket fan-out: frames are queued per connection and written by one task.
+# For clients that opt in (?batch=1 or the chat.msgpack subprotocol), frames queued within
+# CHAT_WS_BATCH_WINDOW seconds go out as one "batch" frame; a connection whose queue
+# fills up is closed with 4008.
+CHAT_WS_SEND_QUEUE_SIZE = 100
+CHAT_WS_BATCH_WINDOW = 0.01
+CHAT_WS_MAX_BATCH = 50
+
+# Heartbeat: the server sends {"type": "ping"} after CHAT_WS_PING_INTERVAL quiet seconds,
+# clients answer {"type": "pong"}. A connection that sends nothing for CHAT_WS_IDLE_TIMEOUT
+# seconds leaves its groups and is closed with 4009 (None disables it).
+CHAT_WS_PING_INTERVAL = 25
+CHAT_WS_IDLE_TIMEOUT = 60
+
+# SSE (/api/chat/events/stream/) and long-poll (/api/chat/events/poll/) fallbacks.
+# Streams send a keepalive comment when idle and end after CHAT_STREAM_MAX_SECONDS,
+# EventSource clients reconnect by themselves.
+CHAT_STREAM_KEEPALIVE = 15
+CHAT_STREAM_MAX_SECONDS = 300
+CHAT_LONG_POLL_TIMEOUT = 25
+CHAT_LONG_POLL_MAX_TIMEOUT = 55
+
+# Delta sync (/api/chat/sync/): most messages per response, clients page with has_more
+CHAT_SYNC_MAX_MESSAGES = 500
+# Changes are ordered by write time, a sync token only settles this many seconds behind
+# now. Has to exceed the longest chat write transaction plus the clock skew between workers.
+CHAT_SYNC_SETTLE_SECONDS = 2
+
+# Token-bucket rate limits (api.ratelimit): (burst, period) lets burst requests through at
+# once, refilled evenly over period seconds. Set per scope for the authenticated user
+# and the client IP, a scope or key that is left out is not limited. chat_send covers
+# REST and WebSocket sends. LocalBucketStore counts per process, use
+# 'api.ratelimit.CacheBucketStore' with CACHE_REDIS_URL to share buckets between workers.
+RATE_LIMITS = {
+    'chat_send': {'user': (30, 60), 'ip': (120, 60)},
+    'login': {'ip': (10, 60)},
+    'register': {'ip': (5, 3600)},
+}
+RATE_LIMIT_STORE = 'api.ratelimit.LocalBucketStore'
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # Only for development, set specific origins in production
 CORS_ALLOW_CREDENTIALS = True